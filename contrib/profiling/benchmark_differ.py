@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+benchmark_differ.py [options] [git_repository]
+
+Benchmarks the diff generators in reviewboard.diffviewer.
+
+By default, this diffs a large, generated file. If the path to a git
+repository is given, it instead diffs every file modified in its most
+recent commits, which makes for a more realistic corpus.
+
+Each differ is run in a forked child process, so the peak memory reported
+is that of the diff alone, rather than that of all the runs before it.
+"""
+
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..')))
+
+from reviewboard.diffviewer.histogramdiff import HistogramDiffer
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+from reviewboard.diffviewer.smdiff import SMDiffer
+
+
+DIFFERS = [
+    ('sm', SMDiffer),
+    ('myers', MyersDiffer),
+    ('histogram', HistogramDiffer),
+]
+
+
+def generate_files(num_lines, seed=0):
+    """Generates an original and modified file.
+
+    The files look like generated code: lots of unique lines, with many
+    repeated braces and blank lines in between, and scattered edits.
+    """
+    rand = random.Random(seed)
+    a = []
+
+    for i in xrange(num_lines):
+        kind = rand.randint(0, 9)
+
+        if kind < 6:
+            a.append('    value_%d = compute(%d, "%x");' %
+                     (i, rand.randint(0, 1000), rand.getrandbits(32)))
+        elif kind < 8:
+            a.append('}')
+        else:
+            a.append('')
+
+    b = list(a)
+
+    for i in xrange(num_lines / 50):
+        pos = rand.randint(0, len(b) - 1)
+        op = rand.randint(0, 2)
+
+        if op == 0:
+            b.insert(pos, '    inserted_%d();' % i)
+        elif op == 1:
+            del b[pos]
+        else:
+            b[pos] = '    changed_%d();' % i
+
+    return a, b
+
+
+def git(repository, *args):
+    p = subprocess.Popen(('git',) + args, cwd=repository,
+                         stdout=subprocess.PIPE)
+    data = p.communicate()[0]
+
+    if p.returncode != 0:
+        raise RuntimeError('git %s failed' % ' '.join(args))
+
+    return data
+
+
+def load_revisions(repository, max_commits, max_files):
+    """Loads pairs of file revisions from a git repository.
+
+    Every text file modified in the last max_commits commits is loaded,
+    up to max_files files.
+    """
+    pairs = []
+    commits = git(repository, 'rev-list', '--no-merges',
+                  '--max-count=%d' % max_commits, 'HEAD').split()
+
+    for commit in commits:
+        changes = git(repository, 'diff-tree', '-r', '--no-commit-id',
+                      '--diff-filter=M', commit)
+
+        for line in changes.splitlines():
+            # :old_mode new_mode old_sha new_sha status\tpath
+            info = line.split('\t')[0].split()
+            old = git(repository, 'cat-file', 'blob', info[2])
+            new = git(repository, 'cat-file', 'blob', info[3])
+
+            if '\0' in old or '\0' in new:
+                continue
+
+            pairs.append((old.splitlines(), new.splitlines()))
+
+            if len(pairs) == max_files:
+                return pairs
+
+    return pairs
+
+
+def run_differ(differ_cls, pairs):
+    """Runs a differ over every pair of files in a child process.
+
+    Returns a tuple of the elapsed time, the increase in peak memory
+    (in kilobytes), the number of opcodes and the number of lines in
+    changed chunks.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_fd)
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        num_opcodes = 0
+        num_changed = 0
+
+        for a, b in pairs:
+            for tag, i1, i2, j1, j2 in differ_cls(a, b).get_opcodes():
+                num_opcodes += 1
+
+                if tag != 'equal':
+                    num_changed += max(i2 - i1, j2 - j1)
+
+        elapsed = time.time() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, '%f %d %d %d' % (elapsed, peak_rss - start_rss,
+                                           num_opcodes, num_changed))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1024)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+
+    elapsed, peak_kb, num_opcodes, num_changed = result.split()
+
+    return float(elapsed), int(peak_kb), int(num_opcodes), int(num_changed)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [git_repository]')
+    parser.add_option('-n', '--num-lines', type='int', default=20000,
+                      help='the number of lines in the generated file')
+    parser.add_option('-r', '--runs', type='int', default=3,
+                      help='the number of runs to take the best of')
+    parser.add_option('-c', '--commits', type='int', default=500,
+                      help='the number of commits to load from the '
+                           'repository')
+    parser.add_option('-f', '--files', type='int', default=1000,
+                      help='the maximum number of files to load from the '
+                           'repository')
+    parser.add_option('-d', '--differs', default=None,
+                      help='a comma-separated list of differs to run')
+    options, args = parser.parse_args()
+
+    if args:
+        pairs = load_revisions(args[0], options.commits, options.files)
+        num_lines = sum([len(a) for a, b in pairs])
+        print '%d file revisions, %d original lines, best of %d runs' % \
+              (len(pairs), num_lines, options.runs)
+    else:
+        a, b = generate_files(options.num_lines)
+        pairs = [(a, b)]
+        print '%d original lines, %d modified lines, best of %d runs' % \
+              (len(a), len(b), options.runs)
+
+    if options.differs:
+        names = options.differs.split(',')
+    else:
+        names = [name for name, differ_cls in DIFFERS]
+
+    print '%-10s %10s %12s %10s %10s' % ('differ', 'time (s)', 'peak (KB)',
+                                         'opcodes', 'changed')
+
+    for name, differ_cls in DIFFERS:
+        if name not in names:
+            continue
+
+        results = [run_differ(differ_cls, pairs)
+                   for i in xrange(options.runs)]
+        elapsed = min([result[0] for result in results])
+        peak_kb = min([result[1] for result in results])
+
+        print '%-10s %10.3f %12d %10d %10d' % (name, elapsed, peak_kb,
+                                               results[0][2], results[0][3])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+benchmark_git_objects.py [options] git_repository
+
+Benchmarks reading blobs from a local Git repository.
+
+Reading objects in-process with reviewboard.scmtools.gitobjects is
+compared against running git cat-file once per object, and against a
+long-running git cat-file --batch process.
+"""
+
+import gc
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..')))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reviewboard.settings')
+
+from reviewboard.scmtools.git import CatFilePool
+from reviewboard.scmtools.gitobjects import GitObjectReader
+
+
+def run_subprocess(git_dir, shas):
+    results = []
+
+    for sha in shas:
+        p = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'cat-file',
+                              'blob', sha],
+                             stdout=subprocess.PIPE)
+        results.append(p.communicate()[0])
+
+    return results
+
+
+def run_batch(git_dir, shas):
+    pool = CatFilePool(git_dir, '--batch')
+
+    try:
+        return [pool.request(sha)[1] for sha in shas]
+    finally:
+        pool.close()
+
+
+def run_reader(git_dir, shas):
+    reader = GitObjectReader(git_dir)
+    return [reader.read_object(sha)[1] for sha in shas]
+
+
+ENGINES = [
+    ('subprocess', run_subprocess),
+    ('batch', run_batch),
+    ('reader', run_reader),
+]
+
+
+def find_git_dir(path):
+    if os.path.isdir(os.path.join(path, '.git')):
+        return os.path.join(path, '.git')
+
+    return path
+
+
+def load_blobs(git_dir, max_blobs):
+    """Returns the SHA1s of up to max_blobs blobs in the repository."""
+    p = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'rev-list',
+                          '--objects', '--all'],
+                         stdout=subprocess.PIPE)
+    names = [line.split(' ', 1)[0] for line in p.communicate()[0].splitlines()]
+
+    p = subprocess.Popen(['git', '--git-dir=%s' % git_dir, 'cat-file',
+                          '--batch-check'],
+                         stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE)
+    output = p.communicate(''.join(['%s\n' % name for name in names]))[0]
+    shas = []
+
+    for line in output.splitlines():
+        parts = line.split()
+
+        if len(parts) == 3 and parts[1] == 'blob':
+            shas.append(parts[0])
+
+            if len(shas) == max_blobs:
+                break
+
+    return shas
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] git_repository')
+    parser.add_option('-n', '--num-blobs', type='int', default=2000,
+                      help='the maximum number of blobs to read')
+    parser.add_option('-r', '--runs', type='int', default=3,
+                      help='the number of runs to take the best of')
+    parser.add_option('-e', '--engines', default=None,
+                      help='a comma-separated list of engines to run')
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('A git repository must be given')
+
+    git_dir = find_git_dir(args[0])
+    shas = load_blobs(git_dir, options.num_blobs)
+
+    if options.engines:
+        names = options.engines.split(',')
+    else:
+        names = [name for name, run in ENGINES]
+
+    print '%d blobs, best of %d runs' % (len(shas), options.runs)
+    print '%-10s %10s %10s %12s' % ('engine', 'time (s)', 'ms/blob', 'bytes')
+
+    expected = None
+
+    for name, run in ENGINES:
+        if name not in names:
+            continue
+
+        elapsed = None
+
+        for i in xrange(options.runs):
+            # Each run starts from scratch, so the reader's caches and the
+            # batch process don't carry over between runs.
+            results = None
+            gc.collect()
+            gc.disable()
+
+            try:
+                start = time.time()
+                results = run(git_dir, shas)
+                run_elapsed = time.time() - start
+            finally:
+                gc.enable()
+
+            if elapsed is None or run_elapsed < elapsed:
+                elapsed = run_elapsed
+
+        if expected is None:
+            expected = results
+        elif results != expected:
+            print '%s returned different contents!' % name
+
+        print '%-10s %10.3f %10.3f %12d' % (
+            name, elapsed, elapsed * 1000 / max(len(shas), 1),
+            sum([len(data) for data in results]))
+
+
+if __name__ == '__main__':
+    main()
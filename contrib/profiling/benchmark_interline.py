@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+benchmark_interline.py [options] [git_repository]
+
+Benchmarks finding the changed regions within replaced lines.
+
+The region engine in reviewboard.diffviewer.interline is compared against
+the old approach of running a character-based SequenceMatcher over each
+pair of lines.
+
+By default, this uses generated pairs of lines. If the path to a git
+repository is given, it instead uses every pair of replaced lines in the
+files modified in its most recent commits.
+"""
+
+import gc
+import os
+import random
+import sys
+import time
+from difflib import SequenceMatcher
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..')))
+
+from benchmark_differ import load_revisions
+from reviewboard.diffviewer.interline import get_line_changed_regions, \
+                                             get_lines_changed_regions
+from reviewboard.diffviewer.smdiff import SMDiffer
+
+
+def sequencematcher_regions(oldline, newline):
+    """Finds the changed regions the way the diff viewer used to."""
+    differ = SequenceMatcher(None, oldline, newline)
+
+    if differ.ratio() < 0.6:
+        return (None, None)
+
+    oldchanges = []
+    newchanges = []
+    back = (0, 0)
+
+    for tag, i1, i2, j1, j2 in differ.get_opcodes():
+        if tag == "equal":
+            if (i2 - i1 < 3) or (j2 - j1 < 3):
+                back = (j2 - j1, i2 - i1)
+            continue
+
+        oldstart, oldend = i1 - back[0], i2
+        newstart, newend = j1 - back[1], j2
+
+        if oldchanges != [] and oldstart <= oldchanges[-1][1] < oldend:
+            oldchanges[-1] = (oldchanges[-1][0], oldend)
+        elif not oldline[oldstart:oldend].isspace():
+            oldchanges.append((oldstart, oldend))
+
+        if newchanges != [] and newstart <= newchanges[-1][1] < newend:
+            newchanges[-1] = (newchanges[-1][0], newend)
+        elif not newline[newstart:newend].isspace():
+            newchanges.append((newstart, newend))
+
+        back = (0, 0)
+
+    return (oldchanges, newchanges)
+
+
+def run_per_line(find_regions):
+    def run(chunks):
+        results = []
+
+        for oldlines, newlines in chunks:
+            for oldline, newline in zip(oldlines, newlines):
+                if oldline and newline and oldline != newline:
+                    results.append(find_regions(oldline, newline))
+                else:
+                    results.append(([], []))
+
+        return results
+
+    return run
+
+
+def run_batched(chunks):
+    results = []
+
+    for oldlines, newlines in chunks:
+        results.extend(get_lines_changed_regions(oldlines, newlines))
+
+    return results
+
+
+ENGINES = [
+    ('sm', run_per_line(sequencematcher_regions)),
+    ('interline', run_per_line(get_line_changed_regions)),
+    ('batched', run_batched),
+]
+
+
+def generate_chunks(num_chunks, seed=0):
+    """Generates chunks of replaced lines.
+
+    Most lines have a word or two changed. Some are rewritten completely,
+    and some chunks repeat the same change on several lines.
+    """
+    rand = random.Random(seed)
+    words = ['value', 'result', 'self', 'compute', 'items', 'None', 'return',
+             'index', 'data', 'count', 'name', 'options']
+    chunks = []
+
+    for i in xrange(num_chunks):
+        oldlines = []
+        newlines = []
+
+        for j in xrange(rand.randint(1, 8)):
+            line = ['    %s = %s(%s, %d)' % (rand.choice(words),
+                                            rand.choice(words),
+                                            rand.choice(words),
+                                            rand.randint(0, 1000))]
+            line += [' + %s.%s' % (rand.choice(words), rand.choice(words))
+                     for k in xrange(rand.randint(0, 4))]
+            oldline = ''.join(line)
+            kind = rand.randint(0, 9)
+
+            if kind < 7:
+                old_word = rand.choice(line[0].split())
+                newline = oldline.replace(old_word, rand.choice(words), 1)
+            elif kind < 9:
+                newline = '    %s.%s()' % (rand.choice(words),
+                                           rand.choice(words))
+            else:
+                newline = oldline + '  # %s' % rand.choice(words)
+
+            oldlines.append(oldline)
+            newlines.append(newline)
+
+            if rand.randint(0, 4) == 0:
+                oldlines.append(oldline)
+                newlines.append(newline)
+
+        chunks.append((oldlines, newlines))
+
+    return chunks
+
+
+def load_chunks(repository, max_commits, max_files):
+    """Loads the chunks of replaced lines from a git repository."""
+    chunks = []
+
+    for a, b in load_revisions(repository, max_commits, max_files):
+        for tag, i1, i2, j1, j2 in SMDiffer(a, b).get_opcodes():
+            if tag == 'replace':
+                chunks.append((a[i1:i2], b[j1:j2]))
+
+    return chunks
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [git_repository]')
+    parser.add_option('-n', '--num-chunks', type='int', default=5000,
+                      help='the number of chunks to generate')
+    parser.add_option('-r', '--runs', type='int', default=3,
+                      help='the number of runs to take the best of')
+    parser.add_option('-c', '--commits', type='int', default=500,
+                      help='the number of commits to load from the '
+                           'repository')
+    parser.add_option('-f', '--files', type='int', default=1000,
+                      help='the maximum number of files to load from the '
+                           'repository')
+    parser.add_option('-e', '--engines', default=None,
+                      help='a comma-separated list of engines to run')
+    options, args = parser.parse_args()
+
+    if args:
+        chunks = load_chunks(args[0], options.commits, options.files)
+    else:
+        chunks = generate_chunks(options.num_chunks)
+
+    num_pairs = sum([min(len(oldlines), len(newlines))
+                     for oldlines, newlines in chunks])
+    print '%d chunks, %d pairs of lines, best of %d runs' % \
+          (len(chunks), num_pairs, options.runs)
+
+    if options.engines:
+        names = options.engines.split(',')
+    else:
+        names = [name for name, run in ENGINES]
+
+    print '%-10s %10s %10s %10s' % ('engine', 'time (s)', 'regions',
+                                    'too different')
+
+    for name, run in ENGINES:
+        if name not in names:
+            continue
+
+        elapsed = None
+        results = None
+
+        for i in xrange(options.runs):
+            # As with timeit, the garbage collector is kept out of the
+            # timings, since when it happens to run is mostly luck.
+            results = None
+            gc.collect()
+            gc.disable()
+
+            try:
+                start = time.time()
+                results = run(chunks)
+                run_elapsed = time.time() - start
+            finally:
+                gc.enable()
+
+            if elapsed is None or run_elapsed < elapsed:
+                elapsed = run_elapsed
+
+        num_regions = sum([len(oldregions)
+                           for oldregions, newregions in results
+                           if oldregions])
+        num_different = len([oldregions
+                             for oldregions, newregions in results
+                             if oldregions is None])
+
+        print '%-10s %10.3f %10d %10d' % (name, elapsed, num_regions,
+                                          num_different)
+
+
+if __name__ == '__main__':
+    main()
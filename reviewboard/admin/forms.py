@@ -578,6 +578,101 @@ class DiffSettingsForm(SiteSettingsForm):
                     "changed lines."),
         initial=5)
 
+    diffviewer_diff_compat_version = forms.TypedChoiceField(
+        label=_("Diff algorithm"),
+        help_text=_("The algorithm used to find the changes in newly "
+                    "uploaded diffs. Histogram diffs often line up moved "
+                    "and rewritten blocks of code better than Myers diffs. "
+                    "Existing diffs keep the algorithm they were uploaded "
+                    "with."),
+        choices=(
+            (1, _("Myers")),
+            (2, _("Histogram")),
+        ),
+        coerce=int)
+
+    diffviewer_max_diff_cost = forms.IntegerField(
+        label=_("Maximum diff cost"),
+        help_text=_("The number of steps the diff algorithm will take to "
+                    "find the smallest set of changes in a region of a "
+                    "file before settling for a larger one. Lower values "
+                    "make large, heavily changed files faster to diff. "
+                    "Enter 0 for no limit."),
+        required=False,
+        min_value=0)
+
+    diffviewer_max_diff_time = forms.IntegerField(
+        label=_("Maximum diff time"),
+        help_text=_("The number of seconds a file may take to diff before "
+                    "the diff algorithm settles for a larger set of "
+                    "changes. Enter 0 for no limit."),
+        required=False,
+        min_value=0)
+
+    diffviewer_max_parallel_files = forms.IntegerField(
+        label=_("Files to diff at once"),
+        help_text=_("The number of files in a diff that are fetched and "
+                    "diffed at the same time when loading a whole diff. "
+                    "Enter 1 to handle one file at a time."),
+        required=False,
+        min_value=1)
+
+    diffviewer_max_repository_fetches = forms.IntegerField(
+        label=_("Maximum fetches per repository"),
+        help_text=_("The number of files each Review Board process may "
+                    "fetch from a single repository at the same time. "
+                    "Enter 0 for no limit."),
+        required=False,
+        min_value=0)
+
+    diffviewer_file_cache_dir = forms.CharField(
+        label=_("File cache directory"),
+        help_text=_("A local directory in which to keep the original "
+                    "contents of files fetched from repositories, so they "
+                    "don't have to be fetched again when the cache server "
+                    "runs out of memory. The web server must be able to "
+                    "write to it. Leave blank to disable."),
+        required=False,
+        widget=forms.TextInput(attrs={'size': '60'}))
+
+    diffviewer_file_cache_size = forms.IntegerField(
+        label=_("File cache size"),
+        help_text=_("The amount of disk space, in megabytes, the file cache "
+                    "may use."),
+        required=False,
+        min_value=0)
+
+    diffviewer_patch_cache_size = forms.IntegerField(
+        label=_("Patched file cache size"),
+        help_text=_("The amount of memory, in megabytes, each Review Board "
+                    "process uses to keep recently patched files around. "
+                    "Enter 0 to disable."),
+        required=False,
+        min_value=0)
+
+    diffviewer_patch_cache_shared = forms.BooleanField(
+        label=_("Share patched files between processes"),
+        help_text=_("Store patched files in the cache server as well, so "
+                    "that other processes and servers don't need to patch "
+                    "them again. This uses more of the cache server's "
+                    "memory."),
+        required=False)
+
+    diffviewer_prerender_diffs = forms.BooleanField(
+        label=_("Pre-render new diffs"),
+        help_text=_("Fetch, diff and render the files in new diffs, and their "
+                    "interdiffs, as soon as they're uploaded, so that the "
+                    "first reviewer doesn't have to wait."),
+        required=False)
+
+    diffviewer_prerender_in_process = forms.BooleanField(
+        label=_("Pre-render diffs in the web server"),
+        help_text=_("Pre-render diffs in a background thread of each web "
+                    "server process. If this is off, run "
+                    "\"rb-site manage /path/to/site prerenderdiffs\" "
+                    "periodically, such as from cron, to pre-render them."),
+        required=False)
+
     diffviewer_paginate_by = forms.IntegerField(
         label=_("Paginate by"),
         help_text=_("The number of files to display per page in the diff "
@@ -606,6 +701,20 @@ class DiffSettingsForm(SiteSettingsForm):
 
         super(DiffSettingsForm, self).load()
 
+    def clean_diffviewer_file_cache_dir(self):
+        """Validates that the file cache directory is usable, if set."""
+        file_cache_dir = self.cleaned_data['diffviewer_file_cache_dir']
+
+        if file_cache_dir:
+            if not os.path.isdir(file_cache_dir):
+                raise forms.ValidationError(_("This is not a directory."))
+
+            if not os.access(file_cache_dir, os.W_OK):
+                raise forms.ValidationError(
+                    _("This path is not writable by the web server."))
+
+        return file_cache_dir
+
     def save(self):
         self.siteconfig.set('diffviewer_include_space_patterns',
             re.split(r",\s*", self.cleaned_data['include_space_patterns']))
@@ -634,6 +743,17 @@ class DiffSettingsForm(SiteSettingsForm):
                 ),
                 'classes': ('wide',),
                 'fields': ('diffviewer_context_num_lines',
+                           'diffviewer_diff_compat_version',
+                           'diffviewer_max_diff_cost',
+                           'diffviewer_max_diff_time',
+                           'diffviewer_max_parallel_files',
+                           'diffviewer_max_repository_fetches',
+                           'diffviewer_file_cache_dir',
+                           'diffviewer_file_cache_size',
+                           'diffviewer_patch_cache_size',
+                           'diffviewer_patch_cache_shared',
+                           'diffviewer_prerender_diffs',
+                           'diffviewer_prerender_in_process',
                            'diffviewer_paginate_by',
                            'diffviewer_paginate_orphans')
             }
@@ -124,9 +124,20 @@ defaults.update({
     'auth_x509_username_regex':            '',
     'auth_x509_autocreate_users':          False,
     'diffviewer_context_num_lines':        5,
+    'diffviewer_diff_compat_version':      1,
+    'diffviewer_file_cache_dir':           '',
+    'diffviewer_file_cache_size':          1024,
     'diffviewer_include_space_patterns':   [],
+    'diffviewer_max_diff_cost':            0,
+    'diffviewer_max_diff_time':            0,
+    'diffviewer_max_parallel_files':       4,
+    'diffviewer_max_repository_fetches':   4,
     'diffviewer_paginate_by':              20,
     'diffviewer_paginate_orphans':         10,
+    'diffviewer_patch_cache_shared':       False,
+    'diffviewer_patch_cache_size':         32,
+    'diffviewer_prerender_diffs':          False,
+    'diffviewer_prerender_in_process':     False,
     'diffviewer_syntax_highlighting':      True,
     'diffviewer_syntax_highlighting_threshold': 0,
     'diffviewer_show_trailing_whitespace': True,
@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.test import TestCase
+from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.admin import checks
+from reviewboard.admin.forms import DiffSettingsForm
 
 
 class UpdateTests(TestCase):
@@ -37,3 +39,31 @@ class UpdateTests(TestCase):
         response = self.client.get("/")
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "admin/manual_updates_required.html")
+
+
+class DiffSettingsFormTests(TestCase):
+    """Tests for the diff viewer settings form"""
+
+    def testBelowMinimums(self):
+        """Testing DiffSettingsForm with values below each field's minimum"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        old_patterns = siteconfig.get('diffviewer_include_space_patterns')
+        siteconfig.set('diffviewer_include_space_patterns', [])
+
+        data = {
+            'diffviewer_max_diff_cost': '-1',
+            'diffviewer_max_diff_time': '-1',
+            'diffviewer_patch_cache_size': '-1',
+            'diffviewer_max_parallel_files': '0',
+            'diffviewer_max_repository_fetches': '-1',
+            'diffviewer_file_cache_size': '-1',
+        }
+
+        try:
+            form = DiffSettingsForm(siteconfig, data)
+            self.assertFalse(form.is_valid())
+        finally:
+            siteconfig.set('diffviewer_include_space_patterns', old_patterns)
+
+        for field in data:
+            self.assertTrue(field in form.errors)
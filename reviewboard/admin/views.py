@@ -10,6 +10,8 @@ from djblets.siteconfig.views import site_settings as djblets_site_settings
 
 from reviewboard.admin.checks import check_updates_required
 from reviewboard.admin.cache_stats import get_cache_stats, get_has_cache_stats
+from reviewboard.diffviewer.filecache import get_file_cache_stats
+from reviewboard.diffviewer.prerender import get_prerender_stats
 from reviewboard.reviews.models import Group, DefaultReviewer
 from reviewboard.scmtools.models import Repository
 
@@ -26,6 +28,7 @@ def dashboard(request, template_name="admin/dashboard.html"):
         'defaultreviewer_count': DefaultReviewer.objects.count(),
         'repository_count': Repository.objects.count(),
         'has_cache_stats': get_has_cache_stats(),
+        'prerender_stats': get_prerender_stats(),
         'title': _("Dashboard"),
         'root_path': settings.SITE_ROOT + "admin/db/"
     }))
@@ -35,13 +38,15 @@ def dashboard(request, template_name="admin/dashboard.html"):
 def cache_stats(request, template_name="admin/cache_stats.html"):
     """
     Displays statistics on the cache. This includes such pieces of
-    information as memory used, cache misses, and uptime.
+    information as memory used, cache misses, and uptime, along with the
+    hit rate and disk usage of the file cache.
     """
     cache_stats = get_cache_stats()
 
     return render_to_response(template_name, RequestContext(request, {
         'cache_hosts': cache_stats,
         'cache_backend': cache.__module__,
+        'file_cache_stats': get_file_cache_stats(),
         'title': _("Server Cache"),
         'root_path': settings.SITE_ROOT + "admin/db/"
     }))
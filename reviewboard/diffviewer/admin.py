@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from reviewboard.diffviewer.models import FileDiff, DiffSet, DiffSetHistory
+from reviewboard.diffviewer.models import FileDiff, DiffSet, DiffSetHistory, \
+                                         PrerenderJob
 
 
 class FileDiffAdmin(admin.ModelAdmin):
@@ -22,6 +23,10 @@ class FileDiffInline(admin.StackedInline):
     model = FileDiff
     extra = 0
 
+    # The diffs are left out so that a diffset's page doesn't need to load
+    # every FileDiffData, or list the whole table for each file.
+    exclude = ('diff64', 'parent_diff64', 'diff_hash', 'parent_diff_hash')
+
 
 class DiffSetAdmin(admin.ModelAdmin):
     list_display = ('__unicode__', 'revision', 'timestamp')
@@ -41,6 +46,15 @@ class DiffSetHistoryAdmin(admin.ModelAdmin):
     ordering = ('-timestamp',)
 
 
+class PrerenderJobAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'status', 'time_added', 'time_started',
+                    'duration', 'num_files')
+    list_filter = ('status',)
+    raw_id_fields = ('diffset', 'interdiffset')
+    ordering = ('-time_added',)
+
+
 admin.site.register(FileDiff, FileDiffAdmin)
 admin.site.register(DiffSet, DiffSetAdmin)
 admin.site.register(DiffSetHistory, DiffSetHistoryAdmin)
+admin.site.register(PrerenderJob, PrerenderJobAdmin)
@@ -0,0 +1,128 @@
+import threading
+
+
+class SizedLRUCache(object):
+    """An in-memory cache that evicts the least recently used items.
+
+    Rather than holding a fixed number of items, the cache holds items up
+    to a maximum total size, normally in bytes. This makes it suitable for
+    caching file contents, where a few large files would otherwise push out
+    everything else.
+
+    The cache is safe to use from multiple threads.
+    """
+    # Indexes into the linked list entries.
+    PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        # The entries form a circular doubly linked list, with the most
+        # recently used entry right after the root.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Returns the value for a key, marking it as recently used.
+
+        If the key isn't in the cache, default is returned.
+        """
+        self._lock.acquire()
+
+        try:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._unlink(entry)
+            self._link(entry)
+
+            return entry[self.VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size=None):
+        """Stores a value in the cache.
+
+        The size defaults to the length of the value. Values larger than
+        the cache as a whole are not stored. Storing a value evicts the
+        least recently used items until everything fits.
+        """
+        if size is None:
+            size = len(value)
+
+        self._lock.acquire()
+
+        try:
+            entry = self._entries.pop(key, None)
+
+            if entry is not None:
+                self._unlink(entry)
+                self.size -= entry[self.SIZE]
+
+            if size > self.max_size:
+                return
+
+            entry = [None, None, key, value, size]
+            self._entries[key] = entry
+            self._link(entry)
+            self.size += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def set_max_size(self, max_size):
+        """Changes the maximum size, evicting items if needed."""
+        self._lock.acquire()
+
+        try:
+            self.max_size = max_size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes everything from the cache."""
+        self._lock.acquire()
+
+        try:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None, 0]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        root = self._root
+        first = root[self.NEXT]
+        entry[self.PREV] = root
+        entry[self.NEXT] = first
+        first[self.PREV] = entry
+        root[self.NEXT] = entry
+
+    def _unlink(self, entry):
+        entry[self.PREV][self.NEXT] = entry[self.NEXT]
+        entry[self.NEXT][self.PREV] = entry[self.PREV]
+
+    def _evict(self):
+        root = self._root
+
+        while self.size > self.max_size:
+            entry = root[self.PREV]
+            self._unlink(entry)
+            del self._entries[entry[self.KEY]]
+            self.size -= entry[self.SIZE]
@@ -1,9 +1,12 @@
 import fnmatch
+import logging
 import os
 import re
 import subprocess
+import sys
 import tempfile
-from difflib import SequenceMatcher
+import threading
+import time
 
 try:
     import pygments
@@ -13,6 +16,9 @@ try:
 except ImportError:
     pass
 
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
 from django.utils.html import escape
 from django.utils.http import urlquote
 from django.utils.safestring import mark_safe
@@ -20,17 +26,55 @@ from django.utils.translation import ugettext as _
 
 from djblets.log import log_timed
 from djblets.siteconfig.models import SiteConfiguration
-from djblets.util.misc import cache_memoize
+from djblets.util.misc import cache_memoize, make_cache_key
 
 from reviewboard.accounts.models import Profile
 from reviewboard.admin.checks import get_can_enable_syntax_highlighting
+from reviewboard.diffviewer.cache import SizedLRUCache
+from reviewboard.diffviewer.filecache import get_file_cache
+from reviewboard.diffviewer.histogramdiff import HistogramDiffer
+from reviewboard.diffviewer.interline import get_line_changed_regions, \
+                                             get_lines_changed_regions
 from reviewboard.diffviewer.myersdiff import MyersDiffer
+from reviewboard.diffviewer.patcher import PatchError, apply_patch
 from reviewboard.diffviewer.smdiff import SMDiffer
-from reviewboard.scmtools.core import PRE_CREATION, HEAD
+from reviewboard.scmtools.core import PRE_CREATION, HEAD, UNKNOWN, \
+                                      run_in_threads
+from reviewboard.scmtools.errors import FileNotFoundError
 
 
 DEFAULT_DIFF_COMPAT_VERSION = 1
 
+# Patched files are cached in each process, keyed on the content of the
+# file and the diff, so that the diff viewer, interdiffs, comment fragments
+# and e-mails can all share the result of a patch. The size is set from the
+# site configuration before each use.
+_patched_file_cache = SizedLRUCache(0)
+
+# Pygments lexer classes for filenames, keyed on the base name, with each
+# entry counting as 1 towards the size.
+_lexer_class_cache = SizedLRUCache(1000)
+
+# Semaphores limiting how many files each process fetches from a repository
+# at once, keyed on the repository ID. Each value is a tuple of the limit
+# and the semaphore, so the semaphore can be replaced if the limit changes.
+_repository_semaphores = {}
+_repository_semaphores_lock = threading.Lock()
+
+# Fetches of original files in progress in this process, keyed on the
+# cache key. Other threads wanting the same file wait for the result rather
+# than fetching it again.
+_file_fetches = {}
+_file_fetches_lock = threading.Lock()
+
+# How long, in seconds, a file that wasn't found in the repository is
+# remembered as missing.
+FILE_NOT_FOUND_EXPIRATION = 60
+
+# How long, in seconds, a process fetching a file holds the lock telling
+# other processes to wait for it. This is also the longest they'll wait.
+FILE_FETCH_LOCK_EXPIRATION = 60
+
 NEW_FILE_STR = _("New File")
 NEW_CHANGE_STR = _("New Change")
 
@@ -158,15 +202,22 @@ class NoWrapperHtmlFormatter(HtmlFormatter):
 
 
 def Differ(a, b, ignore_space=False,
-           compat_version=DEFAULT_DIFF_COMPAT_VERSION):
+           compat_version=DEFAULT_DIFF_COMPAT_VERSION,
+           max_cost=0, max_time=0):
     """
     Factory wrapper for returning a differ class based on the compat version
     and flags specified.
+
+    max_cost and max_time limit how much work the differ will do before
+    settling for a non-minimal diff. Differs that don't support a limit
+    ignore them.
     """
     if compat_version == 0:
         return SMDiffer(a, b)
     elif compat_version == 1:
-        return MyersDiffer(a, b, ignore_space)
+        return MyersDiffer(a, b, ignore_space, max_cost, max_time)
+    elif compat_version == 2:
+        return HistogramDiffer(a, b, ignore_space, max_cost, max_time)
     else:
         raise DiffCompatError(
             "Invalid diff compatibility version (%s) passed to Differ" %
@@ -196,15 +247,70 @@ def convert_line_endings(data):
 
 
 def patch(diff, file, filename):
-    """Apply a diff to a file.  Delegates out to `patch` because noone
-       except Larry Wall knows how to patch."""
-
-    log_timer = log_timed("Patching file %s" % filename)
+    """Apply a diff to a file.
 
+    The result is cached by the content of the file and the diff, first in
+    memory and then, if enabled, in the shared cache.
+    """
     if diff.strip() == "":
         # Someone uploaded an unchanged file. Return the one we're patching.
         return file
 
+    siteconfig = SiteConfiguration.objects.get_current()
+    _patched_file_cache.set_max_size(
+        (siteconfig.get('diffviewer_patch_cache_size') or 0) * 1024 * 1024)
+
+    key = get_patched_file_cache_key(diff, file)
+    data = _patched_file_cache.get(key)
+
+    if data is None:
+        if siteconfig.get('diffviewer_patch_cache_shared'):
+            # See get_original_file for why this is wrapped in a list.
+            data = cache_memoize(key,
+                                 lambda: [_apply_diff(diff, file, filename)],
+                                 large_data=True)[0]
+        else:
+            data = _apply_diff(diff, file, filename)
+
+        _patched_file_cache.set(key, data)
+
+    return data
+
+
+def get_patched_file_cache_key(diff, file):
+    """Returns the cache key for the result of applying a diff to a file."""
+    return "patched-file:%s:%s" % (sha_constructor(file).hexdigest(),
+                                   sha_constructor(diff).hexdigest())
+
+
+def _apply_diff(diff, file, filename):
+    """Apply a diff to a file without any caching.
+
+    The diff is applied in-process using our own patcher. If it can't be
+    applied that way, we delegate out to `patch`, because noone except
+    Larry Wall knows how to patch.
+    """
+    log_timer = log_timed("Patching file %s" % filename)
+
+    diff = convert_line_endings(diff)
+
+    try:
+        try:
+            return apply_patch(diff, convert_line_endings(file))
+        except PatchError, e:
+            logging.warning("Unable to apply the patch to '%s' in-process, "
+                            "falling back on patch: %s" % (filename, e))
+            return _patch_with_subprocess(diff, file, filename, e)
+    finally:
+        log_timer.done()
+
+
+def _patch_with_subprocess(diff, file, filename, patch_error):
+    """Apply a diff to a file using the `patch` command.
+
+    patch_error is the PatchError from the in-process patcher, which is
+    included in the error report if `patch` fails as well.
+    """
     # Prepare the temporary directory if none is available
     tempdir = tempfile.mkdtemp(prefix='reviewboard.')
 
@@ -213,8 +319,6 @@ def patch(diff, file, filename):
     f.write(convert_line_endings(file))
     f.close()
 
-    diff = convert_line_endings(diff)
-
     # XXX: catch exception if Popen fails?
     newfile = '%s-new' % oldfile
     p = subprocess.Popen(['patch', '-o', newfile, oldfile],
@@ -231,15 +335,12 @@ def patch(diff, file, filename):
         f.write(diff)
         f.close()
 
-        log_timer.done()
-
-        # FIXME: This doesn't provide any useful error report on why the patch
-        # failed to apply, which makes it hard to debug.  We might also want to
-        # have it clean up if DEBUG=False
+        # FIXME: We might want to have it clean up if DEBUG=False
         raise Exception(_("The patch to '%s' didn't apply cleanly. The temporary " +
                           "files have been left in '%s' for debugging purposes.\n" +
+                          "%s\n" +
                           "`patch` returned: %s") %
-                        (filename, tempdir, patch_output))
+                        (filename, tempdir, patch_error, patch_output))
 
     f = open(newfile, "r")
     data = f.read()
@@ -249,56 +350,9 @@ def patch(diff, file, filename):
     os.unlink(newfile)
     os.rmdir(tempdir)
 
-    log_timer.done()
-
     return data
 
 
-def get_line_changed_regions(oldline, newline):
-    if oldline is None or newline is None:
-        return (None, None)
-
-    # Use the SequenceMatcher directly. It seems to give us better results
-    # for this. We should investigate steps to move to the new differ.
-    differ = SequenceMatcher(None, oldline, newline)
-
-    # This thresholds our results -- we don't want to show inter-line diffs if
-    # most of the line has changed, unless those lines are very short.
-
-    # FIXME: just a plain, linear threshold is pretty crummy here.  Short
-    # changes in a short line get lost.  I haven't yet thought of a fancy
-    # nonlinear test.
-    if differ.ratio() < 0.6:
-        return (None, None)
-
-    oldchanges = []
-    newchanges = []
-    back = (0, 0)
-
-    for tag, i1, i2, j1, j2 in differ.get_opcodes():
-        if tag == "equal":
-            if (i2 - i1 < 3) or (j2 - j1 < 3):
-                back = (j2 - j1, i2 - i1)
-            continue
-
-        oldstart, oldend = i1 - back[0], i2
-        newstart, newend = j1 - back[1], j2
-
-        if oldchanges != [] and oldstart <= oldchanges[-1][1] < oldend:
-            oldchanges[-1] = (oldchanges[-1][0], oldend)
-        elif not oldline[oldstart:oldend].isspace():
-            oldchanges.append((oldstart, oldend))
-
-        if newchanges != [] and newstart <= newchanges[-1][1] < newend:
-            newchanges[-1] = (newchanges[-1][0], newend)
-        elif not newline[newstart:newend].isspace():
-            newchanges.append((newstart, newend))
-
-        back = (0, 0)
-
-    return (oldchanges, newchanges)
-
-
 def convert_to_utf8(s, enc):
     """
     Returns the passed string as a unicode string. If conversion to UTF-8
@@ -336,10 +390,20 @@ def get_original_file(filediff):
     data = ""
 
     if filediff.source_revision != PRE_CREATION:
-        def fetch_file(file, revision):
+        def fetch_file():
             log_timer = log_timed("Fetching file '%s' r%s from %s" %
                                   (file, revision, repository))
-            data = tool.get_file(file, revision)
+            semaphore = _get_repository_semaphore(repository)
+
+            if semaphore:
+                semaphore.acquire()
+
+            try:
+                data = tool.get_file(file, revision)
+            finally:
+                if semaphore:
+                    semaphore.release()
+
             data = convert_line_endings(data)
             log_timer.done()
             return data
@@ -348,20 +412,18 @@ def get_original_file(filediff):
         tool = repository.get_scmtool()
         file = filediff.source_file
         revision = filediff.source_revision
+        key = _get_original_file_key(filediff)
+        file_cache = _get_original_file_cache(revision)
 
-        key = "%s:%s:%s" % (filediff.diffset.repository.path, urlquote(file),
-                            revision)
+        if file_cache:
+            data = file_cache.get(key)
+        else:
+            data = None
 
-        # We wrap the result of get_file in a list and then return the first
-        # element after getting the result from the cache. This prevents the
-        # cache backend from converting to unicode, since we're no longer
-        # passing in a string and the cache backend doesn't recursively look
-        # through the list in order to convert the elements inside.
-        #
-        # Basically, this fixes the massive regressions introduced by the
-        # Django unicode changes.
-        data = cache_memoize(key, lambda: [fetch_file(file, revision)],
-                             large_data=True)[0]
+        if data is None:
+            data = _fetch_file_once(
+                key, lambda: _cache_original_file(key, revision, fetch_file),
+                file, revision)
 
     # If there's a parent diff set, apply it to the buffer.
     if filediff.parent_diff:
@@ -370,10 +432,221 @@ def get_original_file(filediff):
     return data
 
 
+def _get_original_file_key(filediff):
+    return "%s:%s:%s" % (filediff.diffset.repository.path,
+                         urlquote(filediff.source_file),
+                         filediff.source_revision)
+
+
+def _get_original_file_cache(revision):
+    """Returns the disk cache for a file at a revision, if it can be kept.
+
+    A file at a specific revision never changes, so it can be kept on
+    local disk, where it won't be pushed out of memory by other data.
+    """
+    if revision in (HEAD, UNKNOWN):
+        return None
+
+    return get_file_cache()
+
+
+def _cache_original_file(key, revision, fetch):
+    """Returns a file from the cache server, storing it there if needed.
+
+    fetch is only called if the file isn't in the cache server. The file
+    is also written to the disk cache.
+    """
+    # We wrap the result of get_file in a list and then return the first
+    # element after getting the result from the cache. This prevents the
+    # cache backend from converting to unicode, since we're no longer
+    # passing in a string and the cache backend doesn't recursively look
+    # through the list in order to convert the elements inside.
+    #
+    # Basically, this fixes the massive regressions introduced by the
+    # Django unicode changes.
+    data = cache_memoize(key, lambda: [fetch()], large_data=True)[0]
+    file_cache = _get_original_file_cache(revision)
+
+    if file_cache:
+        file_cache.set(key, data)
+
+    return data
+
+
+def _fetch_file_once(key, fetch, file, revision):
+    """Fetches a file, sharing the work with anything else fetching it.
+
+    If another thread in this process is already fetching the file, this
+    waits for it and returns its result, or raises its exception. Between
+    processes, a lock in the cache server makes the others wait for the
+    first to finish, after which they find the file in the cache.
+
+    Files that weren't found are remembered for a short while, so that
+    FileNotFoundError is raised without asking the repository again.
+    """
+    _file_fetches_lock.acquire()
+
+    try:
+        pending = _file_fetches.get(key)
+        is_leader = (pending is None)
+
+        if is_leader:
+            pending = {
+                'event': threading.Event(),
+                'data': None,
+                'exc_info': None,
+            }
+            _file_fetches[key] = pending
+    finally:
+        _file_fetches_lock.release()
+
+    if not is_leader:
+        pending['event'].wait()
+        exc_info = pending['exc_info']
+
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return pending['data']
+
+    try:
+        try:
+            pending['data'] = _fetch_file_with_lock(key, fetch, file,
+                                                    revision)
+        except:
+            pending['exc_info'] = sys.exc_info()
+            raise
+    finally:
+        _file_fetches_lock.acquire()
+
+        try:
+            del _file_fetches[key]
+        finally:
+            _file_fetches_lock.release()
+
+        pending['event'].set()
+
+    return pending['data']
+
+
+def _fetch_file_with_lock(key, fetch, file, revision):
+    """Fetches a file, letting only one process at a time fetch it.
+
+    This is used by _fetch_file_once.
+    """
+    not_found_key = make_cache_key('%s:not-found' % key)
+    lock_key = make_cache_key('%s:fetch-lock' % key)
+
+    if cache.get(not_found_key):
+        raise FileNotFoundError(file, revision)
+
+    if not cache.add(lock_key, True, FILE_FETCH_LOCK_EXPIRATION):
+        # Another process is fetching the file. Once it's done, the file
+        # will be in the cache, unless it wasn't found or the fetch failed.
+        deadline = time.time() + FILE_FETCH_LOCK_EXPIRATION
+
+        while cache.get(lock_key) and time.time() < deadline:
+            time.sleep(0.1)
+
+        if cache.get(not_found_key):
+            raise FileNotFoundError(file, revision)
+
+        return fetch()
+
+    try:
+        try:
+            return fetch()
+        except FileNotFoundError:
+            cache.set(not_found_key, True, FILE_NOT_FOUND_EXPIRATION)
+            raise
+    finally:
+        cache.delete(lock_key)
+
+
+def _get_repository_semaphore(repository):
+    """Returns the semaphore limiting fetches from a repository.
+
+    Returns None if there's no limit.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    limit = siteconfig.get('diffviewer_max_repository_fetches')
+
+    if not limit:
+        return None
+
+    _repository_semaphores_lock.acquire()
+
+    try:
+        entry = _repository_semaphores.get(repository.id)
+
+        if entry is None or entry[0] != limit:
+            entry = (limit, threading.BoundedSemaphore(limit))
+            _repository_semaphores[repository.id] = entry
+
+        return entry[1]
+    finally:
+        _repository_semaphores_lock.release()
+
+
 def get_patched_file(buffer, filediff):
     return patch(filediff.diff, buffer, filediff.dest_file)
 
 
+def get_lexer_class_for_filename(filename):
+    """Returns the Pygments lexer class used to highlight a file.
+
+    Finding a lexer means matching the filename against the patterns of
+    every lexer Pygments has, so the result is remembered for each base
+    name. Returns None if no lexer handles the file.
+    """
+    basename = os.path.basename(filename)
+    lexer_cls = _lexer_class_cache.get(basename, False)
+
+    if lexer_cls is False:
+        # XXX Guessing is preferable but really slow, especially on XML
+        #     files.
+        try:
+            lexer_cls = get_lexer_for_filename(basename).__class__
+        except ValueError:
+            lexer_cls = None
+
+        _lexer_class_cache.set(basename, lexer_cls, 1)
+
+    return lexer_cls
+
+
+def apply_pygments(data, filename):
+    """Returns the lines of a file, highlighted for the given filename.
+
+    The result is cached by the content of the file, the lexer and the
+    version of Pygments, so a file is highlighted only once no matter how
+    many diffs it appears in. Returns None if no lexer handles the file.
+    """
+    lexer_cls = get_lexer_class_for_filename(filename)
+
+    if lexer_cls is None:
+        return None
+
+    key = "highlight:%s:%s:%s" % (sha_constructor(data).hexdigest(),
+                                  lexer_cls.__name__, pygments.__version__)
+
+    return cache_memoize(key, lambda: _highlight(data, lexer_cls),
+                         large_data=True)
+
+
+def _highlight(data, lexer_cls):
+    lexer = lexer_cls(stripnl=False, encoding='utf-8')
+
+    try:
+        # This is only available in 0.7 and higher
+        lexer.add_filter('codetagify')
+    except AttributeError:
+        pass
+
+    return pygments.highlight(data, lexer,
+                              NoWrapperHtmlFormatter()).splitlines()
+
+
 def register_interesting_lines_for_filename(differ, filename):
     """Registers regexes for interesting lines to a differ based on filename.
 
@@ -399,11 +672,11 @@ def register_interesting_lines_for_filename(differ, filename):
 
 def get_chunks(diffset, filediff, interfilediff, force_interdiff,
                enable_syntax_highlighting):
-    def diff_line(vlinenum, oldlinenum, newlinenum, oldline, newline,
-                  oldmarkup, newmarkup):
+    def diff_line(vlinenum, oldlinenum, newlinenum, oldmarkup, newmarkup,
+                  regions):
         # This function accesses the variable meta, defined in an outer context.
-        if oldline and newline and oldline != newline:
-            oldregion, newregion = get_line_changed_regions(oldline, newline)
+        if regions:
+            oldregion, newregion = regions
         else:
             oldregion = newregion = []
 
@@ -491,23 +764,6 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
         else:
             last_header_index[0] = last_index
 
-    def apply_pygments(data, filename):
-        # XXX Guessing is preferable but really slow, especially on XML
-        #     files.
-        #if filename.endswith(".xml"):
-        lexer = get_lexer_for_filename(filename, stripnl=False,
-                                       encoding='utf-8')
-        #else:
-        #    lexer = guess_lexer_for_filename(filename, data, stripnl=False)
-
-        try:
-            # This is only available in 0.7 and higher
-            lexer.add_filter('codetagify')
-        except AttributeError:
-            pass
-
-        return pygments.highlight(data, lexer, NoWrapperHtmlFormatter()).splitlines()
-
 
     # There are three ways this function is called:
     #
@@ -593,13 +849,8 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
         tool = repository.get_scmtool()
         source_file = tool.normalize_path_for_display(filediff.source_file)
         dest_file = tool.normalize_path_for_display(filediff.dest_file)
-        try:
-            # TODO: Try to figure out the right lexer for these files
-            #       once instead of twice.
-            markup_a = apply_pygments(old or '', source_file)
-            markup_b = apply_pygments(new or '', dest_file)
-        except ValueError:
-            pass
+        markup_a = apply_pygments(old or '', source_file)
+        markup_b = apply_pygments(new or '', dest_file)
 
     if not markup_a:
         markup_a = NEWLINES_RE.split(escape(old))
@@ -618,7 +869,9 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
             break
 
     differ = Differ(a, b, ignore_space=ignore_space,
-                    compat_version=diffset.diffcompat)
+                    compat_version=diffset.diffcompat,
+                    max_cost=siteconfig.get('diffviewer_max_diff_cost'),
+                    max_time=siteconfig.get('diffviewer_max_diff_time'))
 
     # Register any regexes for interesting lines we may want to show.
     register_interesting_lines_for_filename(differ, file)
@@ -636,15 +889,30 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
             "Generating diff chunks for filediff id %s (%s)" %
             (filediff.id, filediff.source_file))
 
-    for tag, i1, i2, j1, j2, meta in opcodes_with_metadata(differ):
+    opcodes = opcodes_with_metadata(differ)
+
+    # If the differ ran out of budget, the changes it found are correct
+    # but may be larger than they need to be. Flag the chunks so the
+    # viewer can say so.
+    for tag, i1, i2, j1, j2, meta in opcodes:
+        if differ.approximate:
+            meta['approximate'] = True
+
         oldlines = markup_a[i1:i2]
         newlines = markup_b[j1:j2]
         numlines = max(len(oldlines), len(newlines))
 
+        # Only replaced lines can have changed regions. They're found for
+        # the whole chunk at once.
+        if tag == 'replace':
+            regions = get_lines_changed_regions(a[i1:i2], b[j1:j2])
+        else:
+            regions = []
+
         lines = map(diff_line,
                     xrange(linenum, linenum + numlines),
                     xrange(i1 + 1, i2 + 1), xrange(j1 + 1, j2 + 1),
-                    a[i1:i2], b[j1:j2], oldlines, newlines)
+                    oldlines, newlines, regions)
 
         if tag == 'equal' and numlines > collapse_threshold:
             last_range_start = numlines - context_num_lines
@@ -731,29 +999,25 @@ def opcodes_with_metadata(differ):
         group = (tag, i1, i2, j1, j2, meta)
         groups.append(group)
 
-        # Store delete/insert ranges for later lookup. We will be building
-        # keys that in most cases will be unique for the particular block
-        # of text being inserted/deleted. There is a chance of collision,
-        # so we store a list of matching groups under that key.
-        #
-        # Later, we will loop through the keys and attempt to find insert
-        # keys/groups that match remove keys/groups.
+        # Index the deleted lines for later lookup. A move range can only
+        # ever start at the first deleted occurrence of a line, so that's
+        # all we store, along with its group. This keeps lookups constant
+        # time, no matter how often a line (such as a brace) repeats.
         if tag == 'delete':
             for i in xrange(i1, i2):
                 line = differ.a[i].strip()
 
-                if line:
-                    removes.setdefault(line, []).append((i, group))
+                if line and line not in removes:
+                    removes[line] = (i, group)
         elif tag == 'insert':
             inserts.append(group)
 
     # We now need to figure out all the moved locations.
     #
-    # At this point, we know all the inserted groups, and all the individually
-    # deleted lines. We'll be going through and finding consecutive groups
-    # of matching inserts/deletes that represent a move block.
-    #
-    # The algorithm will be documented as we go in the code.
+    # At this point, we know all the inserted groups, and the first deleted
+    # occurrence of each line. We'll be going through and finding
+    # consecutive runs of matching inserts/deletes that represent a move
+    # block.
     #
     # We start by looping through all the inserted groups.
     for itag, ii1, ii2, ij1, ij2, imeta in inserts:
@@ -763,19 +1027,15 @@ def opcodes_with_metadata(differ):
         # i_move_cur is the current location inside the insert group
         # (from ij1 through ij2).
         #
-        # i_move_range is the current range of consecutive lines that we'll
-        # use for a move. Each line in this range has a corresponding
-        # consecutive delete line.
+        # i_move_start is the start of the current range of consecutive
+        # inserted lines that each match some deleted line.
         #
-        # r_move_ranges represents deleted move ranges. The key is a
-        # string in the form of "{i1}-{i2}-{j1}-{j2}", with those positions
-        # taken from the remove group for the line. The value
-        # is an array of tuples of (r_start, r_end, r_group). These values
-        # are used to quickly locate deleted lines we've found that match
-        # the inserted lines, so we can assemble ranges later.
+        # r_move_range is the deleted range that those lines moved from,
+        # as a tuple of (r_start, r_end, r_group), where r_end is
+        # inclusive.
         i_move_cur = ij1
-        i_move_range = (i_move_cur, i_move_cur)
-        r_move_ranges = {} # key -> [(start, end, group)]
+        i_move_start = i_move_cur
+        r_move_range = None
 
         # Loop through every location from ij1 through ij2 until we've
         # reached the end.
@@ -789,116 +1049,70 @@ def opcodes_with_metadata(differ):
                 # The inserted line at this location has a corresponding
                 # removed line.
                 #
-                # If there's already some information on removed line ranges
-                # for this particular move block we're processing then we'll
-                # update the range.
+                # If this is the first line of the range, the deleted range
+                # starts at the first removed line that matches it.
+                # Otherwise, we keep the deleted range we have.
                 #
-                # The way we do that is to find each removed line that
-                # matches this inserted line, and for each of those find
-                # out if there's an existing move range that the found
-                # removed line immediately follows. If there is, we update
-                # the existing range.
-                #
-                # If there isn't any move information for this line, we'll
-                # simply add it to the move ranges.
-                for ri, rgroup in removes.get(iline, []):
-                    key = "%s-%s-%s-%s" % rgroup[1:5]
-
-                    if r_move_ranges:
-                        for i, r_move_range in \
-                            enumerate(r_move_ranges.get(key, [])):
-                            # If the remove information for the line is next in
-                            # the sequence for this calculated move range...
-                            if ri == r_move_range[1] + 1:
-                                r_move_ranges[key][i] = (r_move_range[0], ri,
-                                                         rgroup)
-                                break
-                    else:
-                        # We don't have any move ranges yet, so it's time to
-                        # build one based on any removed lines we find that
-                        # match the inserted line.
-                        r_move_ranges[key] = [(ri, ri, rgroup)]
+                # Either way, the deleted range is then extended over each
+                # following line in the same delete group that matches
+                # this inserted line. Usually that's a single line, but a
+                # run of identical deleted lines is consumed all at once.
+                if r_move_range is None:
+                    r_start, rgroup = removes[iline]
+                    r_end = r_start
+                else:
+                    r_start, r_end, rgroup = r_move_range
+
+                r_upper = rgroup[2]
+
+                while (r_end + 1 < r_upper and
+                       differ.a[r_end + 1].strip() == iline):
+                    r_end += 1
+
+                r_move_range = (r_start, r_end, rgroup)
 
                 # On to the next line in the sequence...
                 i_move_cur += 1
             else:
-                # We've reached the very end of the insert group. See if
-                # we have anything that looks like a move.
-                if r_move_ranges:
-                    r_move_range = None
-
-                    # Go through every range of lines we've found and
-                    # find the longest.
+                # We've reached the end of a range of matching lines. See if
+                # we have anything that looks like a move, and whether it's
+                # one we want to include or filter out. Some moves are not
+                # impressive enough to display. For example, a small portion
+                # of a comment, or whitespace-only changes.
+                if (r_move_range and
+                    is_valid_move_range(
+                        differ.a[r_move_range[0]:r_move_range[1]])):
+                    r_start, r_end, rgroup = r_move_range
+
+                    # Build the insert and remove ranges as actual lists of
+                    # positions, rather than a beginning and end. These will
+                    # be provided to the renderer.
                     #
-                    # The longest move range wins. If we find two ranges that
-                    # are equal, though, we'll ignore both. The idea is that
-                    # if we have two identical moves, then it's probably
-                    # common enough code that we don't want to show the move.
-                    # An example might be some standard part of a comment
-                    # block, with no real changes in content.
+                    # The ranges expected by the renderers are 1-based,
+                    # whereas our calculations for this algorithm are
+                    # 0-based, so we add 1 to the numbers.
                     #
-                    # Note that with the current approach, finding duplicate
-                    # moves doesn't cause us to reset the winning range
-                    # to the second-highest identical match. We may want to
-                    # do that down the road, but it means additional state,
-                    # and this is hopefully uncommon enough to not be a real
-                    # problem.
-                    for ranges in r_move_ranges.itervalues():
-                        for r1, r2, rgroup in ranges:
-                            if not r_move_range:
-                                r_move_range = (r1, r2, rgroup)
-                            else:
-                                len1 = r_move_range[2] - r_move_range[1]
-                                len2 = r2 - r1
-
-                                if len1 < len2:
-                                    r_move_range = (r1, r2, rgroup)
-                                elif len1 == len2:
-                                    # If there are two that are the same, it
-                                    # may be common code that we don't want to
-                                    # see moves for. Comments, for example.
-                                    r_move_range = None
-
-                    # If we have a move range, see if it's one we want to
-                    # include or filter out. Some moves are not impressive
-                    # enough to display. For example, a small portion of a
-                    # comment, or whitespace-only changes.
-                    if (r_move_range and
-                        is_valid_move_range(
-                            differ.a[r_move_range[0]:r_move_range[1]])):
-
-                        # Rebuild the insert and remove ranges based on
-                        # where we are now and which range we won.
-                        #
-                        # The new ranges will be actual lists of positions,
-                        # rather than a beginning and end. These will be
-                        # provided to the renderer.
-                        #
-                        # The ranges expected by the renderers are 1-based,
-                        # whereas our calculations for this algorithm are
-                        # 0-based, so we add 1 to the numbers.
-                        #
-                        # The upper boundaries passed to the range() function
-                        # must actually be one higher than the value we want.
-                        # So, for r_move_range, we actually increment by 2.
-                        # We only increment i_move_cur by one, because
-                        # i_move_cur already factored in the + 1 by being
-                        # at the end of the while loop.
-                        i_move_range = range(i_move_range[0] + 1,
-                                             i_move_cur + 1)
-                        r_move_range = range(r_move_range[0] + 1,
-                                             r_move_range[1] + 2)
-
-                        rmeta = rgroup[-1]
-                        rmeta.setdefault('moved', {}).update(
-                            dict(zip(r_move_range, i_move_range)))
-                        imeta.setdefault('moved', {}).update(
-                            dict(zip(i_move_range, r_move_range)))
+                    # The upper boundaries passed to the range() function
+                    # must actually be one higher than the value we want.
+                    # So, for r_end, we actually increment by 2. We only
+                    # increment i_move_cur by one, because i_move_cur is
+                    # already one past the end of the inserted range.
+                    #
+                    # If the deleted range is shorter than the inserted one,
+                    # only the inserted lines at the start are paired up.
+                    i_move_range = range(i_move_start + 1, i_move_cur + 1)
+                    r_range = range(r_start + 1, r_end + 2)
+
+                    rmeta = rgroup[-1]
+                    rmeta.setdefault('moved', {}).update(
+                        dict(zip(r_range, i_move_range)))
+                    imeta.setdefault('moved', {}).update(
+                        dict(zip(i_move_range, r_range)))
 
                 # Reset the state for the next range.
                 i_move_cur += 1
-                i_move_range = (i_move_cur, i_move_cur)
-                r_move_ranges = {}
+                i_move_start = i_move_cur
+                r_move_range = None
 
     return groups
 
@@ -912,6 +1126,77 @@ def get_revision_str(revision):
         return "Revision %s" % revision
 
 
+def get_chunks_cache_key(filediff, interfilediff, force_interdiff,
+                         enable_syntax_highlighting):
+    """Returns the cache key for the chunks of a file in a diff.
+
+    The key is a digest of everything the chunks are generated from, rather
+    than the IDs of the FileDiffs. This lets a file that's unchanged in a
+    new revision of a diff use the chunks already generated for the
+    previous revision.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    diffset = filediff.diffset
+
+    parts = [
+        diffset.repository_id,
+        diffset.repository.encoding,
+        diffset.diffcompat,
+        force_interdiff,
+        siteconfig.get('diffviewer_context_num_lines'),
+        siteconfig.get('diffviewer_include_space_patterns'),
+        siteconfig.get('diffviewer_max_diff_cost'),
+        siteconfig.get('diffviewer_max_diff_time'),
+    ]
+
+    if enable_syntax_highlighting:
+        parts.append(
+            siteconfig.get('diffviewer_syntax_highlighting_threshold'))
+
+    for f in (filediff, interfilediff):
+        if f:
+            parts += [
+                f.source_file,
+                f.dest_file,
+                f.source_revision,
+                _get_diff_digest(f, False),
+                _get_diff_digest(f, True),
+            ]
+        else:
+            parts.append(None)
+
+    key = "diff-sidebyside-"
+
+    if enable_syntax_highlighting:
+        key += "hl-"
+
+    return key + sha_constructor(
+        '\0'.join([smart_str(part) for part in parts])).hexdigest()
+
+
+def _get_diff_digest(filediff, parent):
+    """Returns the SHA1 of a FileDiff's diff or parent diff.
+
+    Diffs stored in FileDiffData are already keyed by their SHA1, so only
+    diffs still stored on the FileDiff itself are read and hashed. The
+    FileDiffData is never loaded.
+    """
+    if parent:
+        diff_hash = filediff.parent_diff_hash_id
+    else:
+        diff_hash = filediff.diff_hash_id
+
+    if diff_hash:
+        return diff_hash
+
+    if parent:
+        diff = filediff.parent_diff
+    else:
+        diff = filediff.diff
+
+    return sha_constructor(diff or "").hexdigest()
+
+
 def get_diff_files(diffset, filediff=None, interdiffset=None,
                    enable_syntax_highlighting=True,
                    load_chunks=True):
@@ -947,12 +1232,6 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
                filediff.source_file == interfilediff.source_file:
                 interdiff_map[interfilediff.source_file] = interfilediff
 
-    key_prefix = "diff-sidebyside-"
-
-    if enable_syntax_highlighting:
-        key_prefix += "hl-"
-
-
     # In order to support interdiffs properly, we need to display diffs
     # on every file in the union of both diffsets. Iterating over one diffset
     # or the other doesn't suffice.
@@ -998,9 +1277,17 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
             # First, find out if we want to even process this one.
             # We only process if there's a difference in files.
 
-            if (filediff and interfilediff and
-                filediff.diff == interfilediff.diff):
-                continue
+            if filediff and interfilediff:
+                # Identical diffs share the same stored data, so comparing
+                # the hashes saves loading both diffs when we can.
+                if filediff.diff_hash_id and interfilediff.diff_hash_id:
+                    unchanged = \
+                        filediff.diff_hash_id == interfilediff.diff_hash_id
+                else:
+                    unchanged = filediff.diff == interfilediff.diff
+
+                if unchanged:
+                    continue
 
             source_revision = "Diff Revision %s" % diffset.revision
 
@@ -1041,30 +1328,15 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
             'index': len(files),
         }
 
-        if load_chunks:
-            chunks = []
-
-            if not filediff.binary and not filediff.deleted:
-                key = key_prefix
-
-                if not force_interdiff:
-                    key += str(filediff.id)
-                elif interfilediff:
-                    key += "interdiff-%s-%s" % (filediff.id, interfilediff.id)
-                else:
-                    key += "interdiff-%s-none" % filediff.id
+        files.append(file)
 
-                chunks = cache_memoize(
-                    key,
-                    lambda: list(get_chunks(filediff.diffset,
-                                            filediff, interfilediff,
-                                            force_interdiff,
-                                            enable_syntax_highlighting)),
-                    large_data=True)
+    if load_chunks:
+        _load_chunks(files, enable_syntax_highlighting)
 
-            file['chunks'] = chunks
+        for file in files:
             file['changed_chunk_indexes'] = []
             file['whitespace_only'] = True
+            file['approximate'] = False
 
             for j, chunk in enumerate(file['chunks']):
                 chunk['index'] = j
@@ -1076,9 +1348,10 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
                     if not meta.get('whitespace_chunk', False):
                         file['whitespace_only'] = False
 
-            file['num_changes'] = len(file['changed_chunk_indexes'])
+                    if meta.get('approximate', False):
+                        file['approximate'] = True
 
-        files.append(file)
+            file['num_changes'] = len(file['changed_chunk_indexes'])
 
     def cmp_file(x, y):
         # Sort based on basepath in asc order
@@ -1101,6 +1374,223 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
     return files
 
 
+def _load_chunks(files, enable_syntax_highlighting):
+    """Loads the chunks for each file in a list from get_diff_files.
+
+    Chunks come from the cache where possible. Otherwise, if the site
+    allows it, the files are fetched, patched and diffed several at a
+    time, since most of that time is spent waiting on the repository or
+    on patch. The chunks for each file are stored in file['chunks'], so
+    the order of the list is unchanged.
+    """
+    def load_file_chunks(item):
+        file, key = item
+        filediff = file['filediff']
+
+        if key is None:
+            file['chunks'] = []
+        else:
+            file['chunks'] = cache_memoize(
+                key,
+                lambda: list(get_chunks(filediff.diffset,
+                                        filediff, file['interfilediff'],
+                                        file['force_interdiff'],
+                                        enable_syntax_highlighting)),
+                large_data=True)
+
+    # Each file's cache key is only computed once, since it hashes the
+    # diffs.
+    keys = []
+
+    for file in files:
+        filediff = file['filediff']
+
+        if filediff.binary or filediff.deleted:
+            keys.append(None)
+        else:
+            keys.append(get_chunks_cache_key(filediff, file['interfilediff'],
+                                             file['force_interdiff'],
+                                             enable_syntax_highlighting))
+
+    # Repositories that can fetch many files at once are given the files
+    # for every chunk that isn't cached up front, rather than one at a time
+    # as each file's chunks are generated. Other repositories' files
+    # don't need to be checked.
+    filediffs = []
+
+    for file, key in zip(files, keys):
+        filediff = file['filediff']
+
+        if (key is not None and
+            _supports_batch_fetches(filediff) and
+            not cache.has_key(make_cache_key(key))):
+            filediffs.append(filediff)
+
+            if file['interfilediff']:
+                filediffs.append(file['interfilediff'])
+
+    _prefetch_batches(_get_prefetchable_filediffs(filediffs))
+
+    siteconfig = SiteConfiguration.objects.get_current()
+    max_threads = min(siteconfig.get('diffviewer_max_parallel_files') or 1,
+                      len(files))
+
+    if max_threads > 1:
+        for file in files:
+            for filediff in (file['filediff'], file['interfilediff']):
+                if filediff and not _prepare_for_thread(filediff):
+                    max_threads = 1
+
+    if max_threads <= 1:
+        for item in zip(files, keys):
+            load_file_chunks(item)
+    else:
+        run_in_threads(load_file_chunks, zip(files, keys), max_threads)
+
+
+def _prepare_for_thread(filediff):
+    """Prepares a FileDiff for having its chunks generated in a thread.
+
+    Everything get_chunks needs from the database is loaded up front, so
+    that the threads don't each need a database connection.
+
+    Returns False if the FileDiff's repository can't be accessed from
+    more than one thread at a time.
+    """
+    diffset = filediff.diffset
+    tool_cls = diffset.repository.tool.get_scmtool_class()
+
+    # Accessing the diffs' data loads it and caches it on the FileDiff.
+    if filediff.diff_hash_id:
+        filediff.diff_hash
+
+    if filediff.parent_diff_hash_id:
+        filediff.parent_diff_hash
+
+    return tool_cls.supports_parallel_fetches
+
+
+def prefetch_original_files(filediffs):
+    """Fetches the original files for a list of FileDiffs ahead of time.
+
+    The files end up in the same caches get_original_file uses, so that
+    generating the chunks for each file afterward doesn't have to wait on
+    the repository.
+
+    Repositories that can fetch many files with one command are given all
+    of their uncached files at once. The rest are fetched several at a
+    time, up to the site's diffviewer_max_parallel_files setting. Fetches
+    to each repository are still limited by
+    diffviewer_max_repository_fetches.
+
+    Files that can't be fetched are logged and skipped. The error will
+    come up again when the file itself is displayed.
+    """
+    filediffs = _prefetch_batches(_get_prefetchable_filediffs(filediffs))
+
+    siteconfig = SiteConfiguration.objects.get_current()
+    max_threads = min(siteconfig.get('diffviewer_max_parallel_files') or 1,
+                      len(filediffs))
+
+    if max_threads <= 1:
+        return
+
+    for filediff in filediffs:
+        if not _prepare_for_thread(filediff):
+            return
+
+    def prefetch(filediff):
+        try:
+            get_original_file(filediff)
+        except Exception, e:
+            logging.warning("Unable to prefetch %s r%s: %s" %
+                            (filediff.source_file, filediff.source_revision,
+                             e))
+
+    log_timer = log_timed("Prefetching %d original files" % len(filediffs))
+    run_in_threads(prefetch, filediffs, max_threads)
+    log_timer.done()
+
+
+def _get_prefetchable_filediffs(filediffs):
+    """Returns the FileDiffs in a list that have original files to fetch."""
+    return [filediff for filediff in filediffs
+            if (filediff.source_revision != PRE_CREATION and
+                not filediff.binary and not filediff.deleted)]
+
+
+def _prefetch_batches(filediffs):
+    """Fetches uncached files from repositories that support batch fetches.
+
+    Each repository's files are fetched with a single call to get_files.
+    Returns the FileDiffs that are left to fetch one at a time.
+    """
+    remaining = []
+    batches = {}
+
+    for filediff in filediffs:
+        if _supports_batch_fetches(filediff):
+            batches.setdefault(filediff.diffset.repository_id,
+                               []).append(filediff)
+        else:
+            remaining.append(filediff)
+
+    for batch in batches.itervalues():
+        uncached = []
+        keys = []
+
+        for filediff in batch:
+            key = _get_original_file_key(filediff)
+            file_cache = _get_original_file_cache(filediff.source_revision)
+
+            if (not cache.has_key(make_cache_key(key)) and
+                not (file_cache and file_cache.has_key(key))):
+                uncached.append(filediff)
+                keys.append(key)
+
+        if len(uncached) < 2:
+            remaining.extend(uncached)
+            continue
+
+        repository = uncached[0].diffset.repository
+        log_timer = log_timed("Fetching %d files from %s" %
+                              (len(uncached), repository))
+        semaphore = _get_repository_semaphore(repository)
+
+        if semaphore:
+            semaphore.acquire()
+
+        try:
+            try:
+                contents = repository.get_scmtool().get_files(
+                    [(filediff.source_file, filediff.source_revision)
+                     for filediff in uncached])
+            except Exception, e:
+                # The files are fetched one at a time instead, so that the
+                # ones that can be fetched still are.
+                logging.warning("Unable to fetch %d files from %s at once: "
+                                "%s" % (len(uncached), repository, e))
+                remaining.extend(uncached)
+                contents = []
+        finally:
+            if semaphore:
+                semaphore.release()
+
+            log_timer.done()
+
+        for filediff, key, data in zip(uncached, keys, contents):
+            data = convert_line_endings(data)
+            _cache_original_file(key, filediff.source_revision,
+                                 lambda: data)
+
+    return remaining
+
+
+def _supports_batch_fetches(filediff):
+    tool = filediff.diffset.repository.tool
+    return tool.get_scmtool_class().supports_batch_fetches
+
+
 def get_file_chunks_in_range(context, filediff, interfilediff,
                              first_line, num_lines):
     """
@@ -0,0 +1,366 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
+from djblets.siteconfig.models import SiteConfiguration
+from djblets.util.misc import make_cache_key
+
+
+# The counters kept in the cache server for the file cache statistics.
+STAT_NAMES = ('hits', 'misses', 'writes', 'evictions', 'corrupt')
+
+# How long the counters are kept in the cache server. This is the longest
+# time memcached accepts.
+STATS_TIMEOUT = 30 * 24 * 60 * 60
+
+# Each process counts in memory, and adds its counts to the ones in the
+# cache server after this many updates or seconds, whichever comes first.
+STATS_FLUSH_COUNT = 100
+STATS_FLUSH_INTERVAL = 30
+
+_file_caches = {}
+_file_caches_lock = threading.Lock()
+
+_pending_stats = {}
+_pending_stats_count = 0
+_stats_last_flushed = time.time()
+_stats_lock = threading.Lock()
+
+
+class FileCache(object):
+    """A cache of file contents on local disk, evicting the least recently
+    used files.
+
+    This is meant for data that never changes once it's been stored, such
+    as the contents of a file at a given revision. Each file is stored
+    along with a checksum of its contents, and files that don't match
+    their checksum are thrown away.
+
+    The directory can be shared by several processes. Each process keeps
+    an estimate of the size of the directory, and when that goes over the
+    maximum size, the least recently used files are removed until the
+    directory is back under it.
+
+    Errors reading or writing the directory are logged, and treated as
+    cache misses.
+    """
+    # Evicting stops once the directory is this fraction of the maximum
+    # size, so that it doesn't have to be scanned on every write.
+    EVICT_TO_RATIO = 0.9
+
+    # How often, in seconds, the directory is rescanned to pick up files
+    # written by other processes.
+    RESCAN_INTERVAL = 10 * 60
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        self._last_scanned = 0
+
+    def get(self, key):
+        """Returns the data for a key, or None if it's not in the cache."""
+        filename = self._get_filename(key)
+
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            _incr_stat('misses')
+            return None
+
+        try:
+            try:
+                checksum = f.readline().rstrip('\n')
+                data = f.read()
+            finally:
+                f.close()
+        except IOError, e:
+            logging.warning("Unable to read %s from the file cache: %s" %
+                            (filename, e))
+            _incr_stat('misses')
+            return None
+
+        if sha_constructor(data).hexdigest() != checksum:
+            logging.warning("Removing corrupt file %s from the file cache" %
+                            filename)
+            _incr_stat('corrupt')
+            _incr_stat('misses')
+            self._remove(filename)
+            return None
+
+        # The modification time marks when the file was last used.
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        _incr_stat('hits')
+
+        return data
+
+    def set(self, key, data):
+        """Stores data for a key.
+
+        Data larger than the cache as a whole is not stored.
+        """
+        header = '%s\n' % sha_constructor(data).hexdigest()
+        size = len(header) + len(data)
+
+        if size > self.max_size:
+            return
+
+        filename = self._get_filename(key)
+        dirname = os.path.dirname(filename)
+
+        try:
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # Another process may have just created it.
+                    if not os.path.isdir(dirname):
+                        raise
+
+            # The file is written under a temporary name and moved into
+            # place, so that other processes never see part of a file.
+            fd, tmpfilename = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+
+            try:
+                f = os.fdopen(fd, 'wb')
+
+                try:
+                    f.write(header)
+                    f.write(data)
+                finally:
+                    f.close()
+
+                if os.name == 'nt' and os.path.exists(filename):
+                    os.unlink(filename)
+
+                os.rename(tmpfilename, filename)
+            except:
+                self._remove(tmpfilename)
+                raise
+        except (IOError, OSError), e:
+            logging.warning("Unable to write %s to the file cache: %s" %
+                            (filename, e))
+            return
+
+        _incr_stat('writes')
+        self._add_size(size)
+
+    def has_key(self, key):
+        """Returns whether a key is in the cache, without reading its data."""
+        return os.path.exists(self._get_filename(key))
+
+    def get_usage(self):
+        """Returns the number of files and total size of the cache."""
+        num_files = 0
+        total_size = 0
+
+        for mtime, size, filename in self._scan():
+            num_files += 1
+            total_size += size
+
+        return num_files, total_size
+
+    def _get_filename(self, key):
+        # Keys contain repository paths, which may not be ASCII.
+        name = sha_constructor(smart_str(key)).hexdigest()
+        return os.path.join(self.path, name[:2], name)
+
+    def _add_size(self, size):
+        self._lock.acquire()
+
+        try:
+            now = time.time()
+
+            if (self._size is None or
+                now - self._last_scanned >= self.RESCAN_INTERVAL):
+                self._size = sum([entry[1] for entry in self._scan()])
+                self._last_scanned = now
+            else:
+                self._size += size
+
+            if self._size > self.max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        entries = self._scan()
+        entries.sort()
+        self._size = sum([entry[1] for entry in entries])
+        self._last_scanned = time.time()
+        target_size = self.max_size * self.EVICT_TO_RATIO
+        num_evicted = 0
+
+        for mtime, size, filename in entries:
+            if self._size <= target_size:
+                break
+
+            if self._remove(filename):
+                self._size -= size
+                num_evicted += 1
+
+        if num_evicted:
+            _incr_stat('evictions', num_evicted)
+
+    def _scan(self):
+        """Returns (mtime, size, filename) tuples for every cached file."""
+        entries = []
+
+        try:
+            dirnames = os.listdir(self.path)
+        except OSError:
+            return entries
+
+        for dirname in dirnames:
+            dirname = os.path.join(self.path, dirname)
+
+            try:
+                names = os.listdir(dirname)
+            except OSError:
+                continue
+
+            for name in names:
+                if name.startswith('.tmp'):
+                    continue
+
+                filename = os.path.join(dirname, name)
+
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, filename))
+
+        return entries
+
+    def _remove(self, filename):
+        try:
+            os.unlink(filename)
+            return True
+        except OSError:
+            return False
+
+
+def get_file_cache():
+    """Returns the file cache configured for the site.
+
+    Returns None if the file cache is disabled.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    path = siteconfig.get('diffviewer_file_cache_dir')
+    max_size = \
+        (siteconfig.get('diffviewer_file_cache_size') or 0) * 1024 * 1024
+
+    if not path or not max_size:
+        return None
+
+    _file_caches_lock.acquire()
+
+    try:
+        file_cache = _file_caches.get(path)
+
+        if file_cache is None:
+            file_cache = FileCache(path, max_size)
+            _file_caches[path] = file_cache
+        else:
+            file_cache.max_size = max_size
+
+        return file_cache
+    finally:
+        _file_caches_lock.release()
+
+
+def get_file_cache_stats():
+    """Returns statistics on the file cache.
+
+    The hit, miss, write, eviction and corruption counts are shared by all
+    processes, and are kept in the cache server, so they're reset along
+    with it. Other processes' most recent counts may not be included yet.
+    Returns None if the file cache is disabled.
+    """
+    file_cache = get_file_cache()
+
+    if file_cache is None:
+        return None
+
+    _flush_stats()
+
+    keys = dict([(name, _get_stat_key(name)) for name in STAT_NAMES])
+    values = cache.get_many(keys.values())
+    stats = dict([(name, values.get(key, 0))
+                  for name, key in keys.iteritems()])
+
+    stats['lookups'] = stats['hits'] + stats['misses']
+
+    if stats['lookups']:
+        stats['hit_rate'] = 100 * stats['hits'] / stats['lookups']
+    else:
+        stats['hit_rate'] = 0
+
+    stats['path'] = file_cache.path
+    stats['max_size'] = file_cache.max_size
+    stats['num_files'], stats['size'] = file_cache.get_usage()
+
+    return stats
+
+
+def _get_stat_key(name):
+    return make_cache_key('diffviewer-file-cache-stats:%s' % name)
+
+
+def _incr_stat(name, delta=1):
+    global _pending_stats_count
+
+    _stats_lock.acquire()
+
+    try:
+        _pending_stats[name] = _pending_stats.get(name, 0) + delta
+        _pending_stats_count += 1
+
+        flush = (_pending_stats_count >= STATS_FLUSH_COUNT or
+                 time.time() - _stats_last_flushed >= STATS_FLUSH_INTERVAL)
+    finally:
+        _stats_lock.release()
+
+    if flush:
+        _flush_stats()
+
+
+def _flush_stats():
+    """Adds this process's counts to the ones in the cache server."""
+    global _pending_stats, _pending_stats_count, _stats_last_flushed
+
+    _stats_lock.acquire()
+
+    try:
+        stats = _pending_stats
+        _pending_stats = {}
+        _pending_stats_count = 0
+        _stats_last_flushed = time.time()
+    finally:
+        _stats_lock.release()
+
+    for name, delta in stats.iteritems():
+        key = _get_stat_key(name)
+
+        try:
+            try:
+                cache.incr(key, delta)
+            except ValueError:
+                # The counter isn't in the cache yet. If another process
+                # adds it first, these counts are lost, which is fine for
+                # statistics.
+                cache.add(key, delta, STATS_TIMEOUT)
+        except Exception, e:
+            logging.warning("Unable to update file cache statistics: %s" % e)
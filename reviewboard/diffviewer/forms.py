@@ -3,6 +3,7 @@ import os
 from django import forms
 from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext as _
+from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.diffviewer.diffutils import DEFAULT_DIFF_COMPAT_VERSION
 from reviewboard.diffviewer.models import DiffSet, FileDiff
@@ -88,10 +89,17 @@ class UploadDiffForm(forms.Form):
                 if f.origChangesetId:
                     parent_changeset_id = f.origChangesetId
 
+        # New diffs are generated with the site's chosen differ. Existing
+        # diffs keep the version they were created with, so that comments
+        # stay on the lines they were made on.
+        siteconfig = SiteConfiguration.objects.get_current()
+        diffcompat = (siteconfig.get('diffviewer_diff_compat_version') or
+                      DEFAULT_DIFF_COMPAT_VERSION)
+
         diffset = DiffSet(name=diff_file.name, revision=0,
                           basedir=basedir,
                           history=diffset_history,
-                          diffcompat=DEFAULT_DIFF_COMPAT_VERSION)
+                          diffcompat=diffcompat)
         diffset.repository = self.repository
         diffset.save()
 
@@ -132,28 +140,47 @@ class UploadDiffForm(forms.Form):
 
     def _process_files(self, file, basedir, check_existance=False):
         tool = self.repository.get_scmtool()
+        files = []
+        files_to_check = []
+
+        parser = tool.get_parser(file)
+
+        try:
+            parsed_files = parser.parse()
+        finally:
+            parser.close()
 
-        for f in tool.get_parser(file.read()).parse():
+        for f in parsed_files:
             f2, revision = tool.parse_diff_revision(f.origFile, f.origInfo)
             if f2.startswith("/"):
                 filename = f2
             else:
                 filename = os.path.join(basedir, f2).replace("\\", "/")
 
-            # FIXME: this would be a good place to find permissions errors
-            if (revision != PRE_CREATION and
+            if (check_existance and
+                revision != PRE_CREATION and
                 revision != UNKNOWN and
                 not f.binary and
-                not f.deleted and
-                (check_existance and
-                 not tool.file_exists(filename, revision))):
-                raise FileNotFoundError(filename, revision)
+                not f.deleted):
+                files_to_check.append((filename, revision))
 
             f.origFile = filename
             f.origInfo = revision
 
-            yield f
+            files.append(f)
+
+        # The files are all checked at once, which is much faster than
+        # checking them one by one on most repositories.
+        #
+        # FIXME: this would be a good place to find permissions errors
+        if files_to_check:
+            results = tool.file_exists_many(files_to_check)
+
+            for (filename, revision), exists in zip(files_to_check, results):
+                if not exists:
+                    raise FileNotFoundError(filename, revision)
 
+        return files
 
     def _compare_files(self, filename1, filename2):
         """
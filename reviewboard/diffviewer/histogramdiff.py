@@ -0,0 +1,202 @@
+import time
+from array import array
+
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+
+
+class HistogramDiffer(MyersDiffer):
+    """
+    An implementation of the histogram diff algorithm, based on the one in
+    JGit and git.
+
+    Histogram diff is an extension of patience diff. It repeatedly finds the
+    longest run of lines in common between the two files that contains the
+    rarest possible line, and splits the files around it. Matching on rare
+    lines first means that blank lines and braces don't get paired up with
+    each other across unrelated changes, which gives more readable chunks.
+    On source files, where most lines are unique, it's also much faster
+    than searching for a minimal diff.
+
+    Regions made up only of lines that are too common to be useful are
+    handed off to MyersDiffer's search instead.
+
+    Lines are turned into codes, and opcodes and interesting lines are
+    generated, just as they are in MyersDiffer.
+    """
+    # Lines that appear more often than this in a region are never used to
+    # split it.
+    MAX_CHAIN_LENGTH = 64
+
+    def _gen_diff_data(self):
+        """
+        Generate all the diff data needed to return opcodes or the diff ratio.
+        This is only called once during the liftime of a HistogramDiffer
+        instance.
+        """
+        if self.a_data and self.b_data:
+            return
+
+        self.a_data = self.DiffData(self._gen_diff_codes(self.a, False))
+        self.b_data = self.DiffData(self._gen_diff_codes(self.b, True))
+
+        # Nothing is discarded, so that any regions handed off to _lcs
+        # use the same line numbers we do.
+        for data in (self.a_data, self.b_data):
+            data.undiscarded = data.data
+            data.undiscarded_lines = data.length
+            data.real_indexes = array('l', xrange(data.length))
+
+        self._init_search()
+
+        self._histogram_diff(0, self.a_data.length, 0, self.b_data.length)
+        self._shift_chunks(self.a_data, self.b_data)
+        self._shift_chunks(self.b_data, self.a_data)
+
+    def _histogram_diff(self, a_lower, a_upper, b_lower, b_upper):
+        """
+        Marks the modified lines between the given ranges of the two files.
+
+        Regions still to be split are kept on a stack rather than handled
+        recursively, since one split per line is possible on large files.
+        """
+        a = self.a_data.data
+        b = self.b_data.data
+        regions = [(a_lower, a_upper, b_lower, b_upper)]
+
+        while regions:
+            a_lower, a_upper, b_lower, b_upper = regions.pop()
+
+            # Skip past equal lines at the start and end.
+            while a_lower < a_upper and b_lower < b_upper and \
+                  a[a_lower] == b[b_lower]:
+                a_lower += 1
+                b_lower += 1
+
+            while a_upper > a_lower and b_upper > b_lower and \
+                  a[a_upper - 1] == b[b_upper - 1]:
+                a_upper -= 1
+                b_upper -= 1
+
+            if a_lower == a_upper or b_lower == b_upper or \
+               (self.deadline and time.time() >= self.deadline):
+                # Either there's nothing but inserted or deleted lines, or
+                # we're out of time. _lcs knows how to handle both.
+                self._lcs(a_lower, a_upper, b_lower, b_upper, False)
+                continue
+
+            has_common, lcs = self._find_lcs(a_lower, a_upper,
+                                             b_lower, b_upper)
+
+            if not has_common:
+                # The two regions have nothing in common, so it's all one
+                # big replace.
+                self._mark_modified(self.a_data, a_lower, a_upper)
+                self._mark_modified(self.b_data, b_lower, b_upper)
+            elif lcs is None:
+                # Every line in common is too common to split on, so fall
+                # back on a regular search. This also takes care of giving
+                # up once we're out of time.
+                self._lcs(a_lower, a_upper, b_lower, b_upper,
+                          self.minimal_diff)
+            else:
+                lcs_a_lower, lcs_a_upper, lcs_b_lower, lcs_b_upper = lcs
+                regions.append((lcs_a_upper, a_upper, lcs_b_upper, b_upper))
+                regions.append((a_lower, lcs_a_lower, b_lower, lcs_b_lower))
+
+    def _find_lcs(self, a_lower, a_upper, b_lower, b_upper):
+        """
+        Finds the longest run of lines in common between the two ranges
+        that contains the rarest lines.
+
+        Returns a tuple of (has_common, lcs). has_common is False if the
+        ranges share no lines at all. lcs is a tuple of the ranges of the
+        run, (a_lower, a_upper, b_lower, b_upper), or None if no run could
+        be found using lines that are rare enough.
+        """
+        a = self.a_data.data
+        b = self.b_data.data
+
+        # Build the histogram of the lines in the old range. Each code maps
+        # to the line numbers it appears on, in order.
+        occurrences = {}
+        i = a_lower
+
+        for code in a[a_lower:a_upper]:
+            try:
+                occurrences[code].append(i)
+            except KeyError:
+                occurrences[code] = [i]
+
+            i += 1
+
+        get_positions = occurrences.get
+
+        has_common = False
+        lcs = None
+        lcs_length = 0
+        lcs_count = self.MAX_CHAIN_LENGTH + 1
+        b_pos = b_lower
+
+        while b_pos < b_upper:
+            b_next = b_pos + 1
+            positions = get_positions(b[b_pos])
+
+            if positions is not None:
+                has_common = True
+                count = len(positions)
+
+                if count <= lcs_count:
+                    i = 0
+
+                    while i < count:
+                        match_a_lower = positions[i]
+                        match_a_upper = match_a_lower + 1
+                        match_b_lower = b_pos
+                        match_b_upper = b_pos + 1
+                        match_count = count
+
+                        # Extend the match in both directions, keeping
+                        # track of the rarest line in it.
+                        while match_a_lower > a_lower and \
+                              match_b_lower > b_lower and \
+                              a[match_a_lower - 1] == b[match_b_lower - 1]:
+                            match_a_lower -= 1
+                            match_b_lower -= 1
+
+                            if match_count > 1:
+                                match_count = min(match_count,
+                                    len(occurrences[a[match_a_lower]]))
+
+                        while match_a_upper < a_upper and \
+                              match_b_upper < b_upper and \
+                              a[match_a_upper] == b[match_b_upper]:
+                            if match_count > 1:
+                                match_count = min(match_count,
+                                    len(occurrences[a[match_a_upper]]))
+
+                            match_a_upper += 1
+                            match_b_upper += 1
+
+                        # There's no point in looking for matches starting
+                        # within this one.
+                        if b_next < match_b_upper:
+                            b_next = match_b_upper
+
+                        if lcs_length < match_a_upper - match_a_lower or \
+                           match_count < lcs_count:
+                            lcs = (match_a_lower, match_a_upper,
+                                   match_b_lower, match_b_upper)
+                            lcs_length = match_a_upper - match_a_lower
+                            lcs_count = match_count
+
+                        i += 1
+
+                        while i < count and positions[i] < match_a_upper:
+                            i += 1
+
+            b_pos = b_next
+
+        if lcs_count > self.MAX_CHAIN_LENGTH:
+            lcs = None
+
+        return has_common, lcs
@@ -0,0 +1,149 @@
+import re
+from difflib import SequenceMatcher
+
+
+# Lines are compared a token at a time, rather than a character at a time.
+# A token is a word, a run of whitespace or a single punctuation character.
+# Bytes outside of ASCII are treated as part of a word, so that multi-byte
+# UTF-8 characters are never split up.
+TOKEN_RE = re.compile(r'[\w\x80-\xff]+|\s+|[^\w\s\x80-\xff]')
+
+# The minimum fraction of the two lines that must be in common for the
+# changed regions to be shown. Below this, the lines are treated as
+# completely different.
+#
+# FIXME: just a plain, linear threshold is pretty crummy here.  Short
+# changes in a short line get lost.  I haven't yet thought of a fancy
+# nonlinear test.
+MIN_RATIO = 0.6
+
+
+def get_line_changed_regions(oldline, newline):
+    """Returns the regions that changed between two versions of a line.
+
+    This returns a tuple of lists of (start, end) character ranges in the
+    old and new lines. If the lines have too little in common for the
+    regions to be useful, (None, None) is returned instead.
+    """
+    if oldline is None or newline is None:
+        return (None, None)
+
+    total_len = len(oldline) + len(newline)
+
+    if total_len == 0:
+        return ([], [])
+
+    # Every check is done on the number of characters the lines have in
+    # common, as a fraction of their combined length. The cheapest
+    # bounds on that are checked first, so the full comparison is only
+    # run on lines that might pass.
+    min_matched = MIN_RATIO * total_len / 2
+
+    if min(len(oldline), len(newline)) < min_matched:
+        return (None, None)
+
+    old_tokens = TOKEN_RE.findall(oldline)
+    new_tokens = TOKEN_RE.findall(newline)
+
+    # No alignment of the tokens can match more characters than the
+    # tokens the two lines have in common.
+    counts = {}
+
+    for token in old_tokens:
+        counts[token] = counts.get(token, 0) + 1
+
+    common_len = 0
+
+    for token in new_tokens:
+        count = counts.get(token)
+
+        if count:
+            counts[token] = count - 1
+            common_len += len(token)
+
+    if common_len < min_matched:
+        return (None, None)
+
+    differ = SequenceMatcher(None, old_tokens, new_tokens)
+    old_offsets = _get_offsets(old_tokens)
+    new_offsets = _get_offsets(new_tokens)
+    matched_len = 0
+
+    for i, j, n in differ.get_matching_blocks():
+        matched_len += old_offsets[i + n] - old_offsets[i]
+
+    if matched_len < min_matched:
+        return (None, None)
+
+    oldchanges = []
+    newchanges = []
+    back = (0, 0)
+
+    for tag, i1, i2, j1, j2 in differ.get_opcodes():
+        i1 = old_offsets[i1]
+        i2 = old_offsets[i2]
+        j1 = new_offsets[j1]
+        j2 = new_offsets[j2]
+
+        if tag == "equal":
+            if (i2 - i1 < 3) or (j2 - j1 < 3):
+                back = (j2 - j1, i2 - i1)
+            continue
+
+        oldstart, oldend = i1 - back[0], i2
+        newstart, newend = j1 - back[1], j2
+
+        if oldchanges != [] and oldstart <= oldchanges[-1][1] < oldend:
+            oldchanges[-1] = (oldchanges[-1][0], oldend)
+        elif not oldline[oldstart:oldend].isspace():
+            oldchanges.append((oldstart, oldend))
+
+        if newchanges != [] and newstart <= newchanges[-1][1] < newend:
+            newchanges[-1] = (newchanges[-1][0], newend)
+        elif not newline[newstart:newend].isspace():
+            newchanges.append((newstart, newend))
+
+        back = (0, 0)
+
+    return (oldchanges, newchanges)
+
+
+def get_lines_changed_regions(oldlines, newlines):
+    """Returns the changed regions for each pair of lines in a chunk.
+
+    This returns a list with one (oldregions, newregions) tuple for each
+    pair of lines, as returned by get_line_changed_regions. Lines that are
+    missing, empty or unchanged have no regions. Pairs of lines that appear
+    more than once in the chunk are only compared once.
+    """
+    results = []
+    seen = {}
+
+    for oldline, newline in zip(oldlines, newlines):
+        if not oldline or not newline or oldline == newline:
+            results.append(([], []))
+            continue
+
+        key = (oldline, newline)
+
+        try:
+            regions = seen[key]
+        except KeyError:
+            regions = get_line_changed_regions(oldline, newline)
+            seen[key] = regions
+
+        results.append(regions)
+
+    return results
+
+
+def _get_offsets(tokens):
+    """Returns the character offset of each token, plus the total length."""
+    offsets = [0]
+    offset = 0
+
+    for token in tokens:
+        offset += len(token)
+        offsets.append(offset)
+
+    return offsets
@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Q
+
+from reviewboard.diffviewer.models import FileDiff
+
+
+class Command(NoArgsCommand):
+    help = "Moves existing diffs into compressed, deduplicated storage."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='The number of file diffs to migrate at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        queryset = FileDiff.objects.filter(
+            Q(diff_hash__isnull=True) |
+            (Q(parent_diff_hash__isnull=True) & ~Q(parent_diff64=''))
+        ).order_by('pk')
+
+        total = queryset.count()
+        processed = 0
+        migrated = 0
+        last_pk = 0
+
+        print "Condensing %d file diffs..." % total
+
+        while True:
+            filediffs = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+
+            if not filediffs:
+                break
+
+            migrated += self._migrate_batch(filediffs)
+            processed += len(filediffs)
+            last_pk = filediffs[-1].pk
+
+            print "Processed %d of %d file diffs" % (processed, total)
+
+        print "Condensed %d file diffs." % migrated
+
+    @transaction.commit_on_success
+    def _migrate_batch(self, filediffs):
+        """
+        Migrates a batch of FileDiffs in a single transaction.
+
+        Returns the number of FileDiffs that were migrated. FileDiffs with
+        empty diffs have nothing to migrate and are skipped.
+        """
+        migrated = 0
+
+        for filediff in filediffs:
+            if filediff.migrate_diff_data():
+                filediff.save()
+                migrated += 1
+
+        return migrated
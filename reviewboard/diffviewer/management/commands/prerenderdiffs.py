@@ -0,0 +1,17 @@
+from django.core.management.base import NoArgsCommand
+
+from reviewboard import initialize
+from reviewboard.diffviewer.prerender import process_prerender_jobs
+
+
+class Command(NoArgsCommand):
+    help = "Pre-renders any diffs waiting in the pre-render queue."
+
+    def handle_noargs(self, **options):
+        # The cache serials used in fragment cache keys are generated
+        # here, so this must be done before rendering anything.
+        initialize()
+
+        num_jobs = process_prerender_jobs()
+
+        print "Ran %d pre-render jobs." % num_jobs
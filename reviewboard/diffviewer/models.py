@@ -1,10 +1,64 @@
+import zlib
 from datetime import datetime
 
-from django.db import models
+from django.db import IntegrityError, models
+from django.utils.hashcompat import sha_constructor
 from django.utils.translation import ugettext_lazy as _
-from djblets.util.fields import Base64Field
+from djblets.util.fields import Base64DecodedValue, Base64Field
 
 from reviewboard.scmtools.models import Repository
+from reviewboard.signals import initializing
+
+
+class FileDiffDataManager(models.Manager):
+    """
+    A manager for FileDiffData.
+
+    This takes care of storing each unique diff only once.
+    """
+    def get_or_create_from_data(self, data):
+        """
+        Returns the FileDiffData for the given diff, creating it if
+        it doesn't exist yet.
+        """
+        # The data is wrapped so that Base64Field doesn't mistake it for
+        # encoded data coming from the database, since the primary key
+        # is already set.
+        binary_hash = sha_constructor(data).hexdigest()
+        binary = Base64DecodedValue(zlib.compress(data))
+
+        try:
+            return self.get_or_create(binary_hash=binary_hash,
+                                      defaults={'binary': binary})[0]
+        except IntegrityError:
+            # Another upload of the same diff stored it after we looked for
+            # it. Its row may not be visible in this transaction yet, but
+            # it holds the same data, so only the key is needed.
+            return self.model(binary_hash=binary_hash, binary=binary)
+
+
+class FileDiffData(models.Model):
+    """
+    The contents of a diff, shared by all FileDiffs with that same diff.
+
+    Diffs are keyed by the SHA1 of their contents and stored compressed, so
+    a file that's unchanged across many revisions of a diff is only stored
+    once.
+    """
+    binary_hash = models.CharField(_("hash"), max_length=40, primary_key=True)
+    binary = Base64Field(_("compressed data"))
+
+    objects = FileDiffDataManager()
+
+    @property
+    def data(self):
+        return zlib.decompress(self.binary)
+
+    def __unicode__(self):
+        return self.binary_hash
+
+    class Meta:
+        verbose_name_plural = "File diff data"
 
 
 class FileDiff(models.Model):
@@ -32,16 +86,78 @@ class FileDiff(models.Model):
                                        max_length=512)
     dest_detail = models.CharField(_("destination file details"),
                                    max_length=512)
-    diff = Base64Field(_("diff"), db_column="diff_base64")
+    diff64 = Base64Field(_("legacy diff"), db_column="diff_base64",
+                         blank=True)
+    diff_hash = models.ForeignKey(FileDiffData, null=True, blank=True,
+                                  related_name="filediffs",
+                                  verbose_name=_("diff"))
     binary = models.BooleanField(_("binary file"), default=False)
-    parent_diff = Base64Field(_("parent diff"), db_column="parent_diff_base64",
-                              blank=True)
+    parent_diff64 = Base64Field(_("legacy parent diff"),
+                                db_column="parent_diff_base64", blank=True)
+    parent_diff_hash = models.ForeignKey(FileDiffData, null=True, blank=True,
+                                         related_name="parent_filediffs",
+                                         verbose_name=_("parent diff"))
     status = models.CharField(_("status"), max_length=1, choices=STATUSES)
 
     @property
     def deleted(self):
         return self.status == 'D'
 
+    def _get_diff(self):
+        if self.diff_hash_id:
+            return self.diff_hash.data
+
+        return self.diff64
+
+    def _set_diff(self, diff):
+        # See FileDiffDataManager.get_or_create_from_data.
+        self.diff64 = Base64DecodedValue(diff)
+        self.diff_hash = None
+
+    diff = property(_get_diff, _set_diff)
+
+    def _get_parent_diff(self):
+        if self.parent_diff_hash_id:
+            return self.parent_diff_hash.data
+
+        return self.parent_diff64
+
+    def _set_parent_diff(self, parent_diff):
+        self.parent_diff64 = Base64DecodedValue(parent_diff)
+        self.parent_diff_hash = None
+
+    parent_diff = property(_get_parent_diff, _set_parent_diff)
+
+    def migrate_diff_data(self):
+        """
+        Moves the diff and parent diff out of this row and into FileDiffData.
+
+        Returns whether anything was moved, in which case the FileDiff
+        needs to be saved. Older FileDiffs keep their diffs in the row
+        until they're migrated, either by being saved or by the
+        condensediffs management command.
+        """
+        migrated = False
+
+        if self.diff64:
+            self.diff_hash = \
+                FileDiffData.objects.get_or_create_from_data(self.diff64)
+            self.diff64 = ""
+            migrated = True
+
+        if self.parent_diff64:
+            self.parent_diff_hash = \
+                FileDiffData.objects.get_or_create_from_data(
+                    self.parent_diff64)
+            self.parent_diff64 = ""
+            migrated = True
+
+        return migrated
+
+    def save(self, **kwargs):
+        self.migrate_diff_data()
+        super(FileDiff, self).save(**kwargs)
+
     def __unicode__(self):
         return u"%s (%s) -> %s (%s)" % (self.source_file, self.source_revision,
                                         self.dest_file, self.dest_detail)
@@ -92,6 +208,54 @@ class DiffSet(models.Model):
         ordering = ['revision', 'timestamp']
 
 
+class PrerenderJob(models.Model):
+    """
+    A request to generate and cache the diff viewer's output for a diffset,
+    or an interdiff, ahead of time.
+
+    This is done after a diff is uploaded or published, so that the first
+    person to view it doesn't have to wait for files to be fetched and
+    diffed.
+    """
+    PENDING = 'P'
+    RUNNING = 'R'
+    DONE = 'D'
+    FAILED = 'F'
+
+    STATUSES = (
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+
+    diffset = models.ForeignKey(DiffSet, related_name="prerender_jobs",
+                                verbose_name=_("diff set"))
+    interdiffset = models.ForeignKey(DiffSet, null=True, blank=True,
+                                     related_name="interdiff_prerender_jobs",
+                                     verbose_name=_("interdiff set"))
+    status = models.CharField(_("status"), max_length=1, choices=STATUSES,
+                              default=PENDING, db_index=True)
+    time_added = models.DateTimeField(_("time added"), default=datetime.now)
+    time_started = models.DateTimeField(_("time started"), null=True,
+                                        blank=True)
+    time_finished = models.DateTimeField(_("time finished"), null=True,
+                                         blank=True)
+    duration = models.FloatField(_("duration (seconds)"), null=True,
+                                 blank=True)
+    num_files = models.IntegerField(_("number of files"), default=0)
+    error = models.TextField(_("error"), blank=True)
+
+    def __unicode__(self):
+        if self.interdiffset_id:
+            return u"%s - %s" % (self.diffset, self.interdiffset)
+        else:
+            return unicode(self.diffset)
+
+    class Meta:
+        ordering = ['time_added']
+
+
 class DiffSetHistory(models.Model):
     """
     A collection of diffsets.
@@ -107,3 +271,17 @@ class DiffSetHistory(models.Model):
 
     class Meta:
         verbose_name_plural = "Diff set histories"
+
+
+def connect_signals(**kwargs):
+    """
+    Listens to the ``initializing`` signal and connects the signals used
+    to pre-render new diffs. This is done so as to guarantee that django
+    is loaded first.
+    """
+    from reviewboard.diffviewer import prerender
+
+    prerender.connect_signals()
+
+
+initializing.connect(connect_signals)
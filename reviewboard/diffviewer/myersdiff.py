@@ -1,6 +1,14 @@
+import time
+from array import array
+
+
 class MyersDiffer:
     """
     An implementation of Eugene Myers's O(ND) Diff algorithm based on GNU diff.
+
+    Lines are converted to integer codes up-front, and all per-line state
+    is kept in compact arrays rather than lists and dicts of Python objects.
+    This keeps memory use down on very large files.
     """
     SNAKE_LIMIT = 20
 
@@ -15,12 +23,27 @@ class MyersDiffer:
         def __init__(self, data):
             self.data = data
             self.length = len(data)
-            self.modified = {}
-            self.undiscarded = []
+
+            # A bitmap of modified lines, one byte per line. There's an
+            # extra entry at the end that's never set, which serves as the
+            # sentinel for both line -1 and line "length".
+            self.modified = array('B', [0]) * (self.length + 1)
+            self.undiscarded = array('l')
             self.undiscarded_lines = 0
-            self.real_indexes = []
+            self.real_indexes = array('l')
 
-    def __init__(self, a, b, ignore_space=False):
+    def __init__(self, a, b, ignore_space=False, max_cost=0, max_time=0):
+        """
+        If max_cost is set, each search for the shortest middle snake gives
+        up once it reaches that edit cost, much like GNU diff does on large
+        files. If max_time is set, once that many seconds have passed since
+        the diff was started, everything not yet compared is treated as
+        changed. Either way, the result is still a correct diff, but not
+        necessarily a minimal one, and the approximate attribute is set to
+        True.
+
+        A value of 0 means there's no limit.
+        """
         if type(a) != type(b):
             raise TypeError
 
@@ -34,16 +57,20 @@ class MyersDiffer:
         self.interesting_line_regexes = []
         self.interesting_lines = [{}, {}]
         self.interesting_line_table = {}
+        self.max_cost = max_cost
+        self.max_time = max_time
+        self.approximate = False
 
         # SMS State
         self.max_lines = 0
         self.fdiag = None
         self.bdiag = None
+        self.deadline = None
 
     def ratio(self):
         self._gen_diff_data()
-        a_equals = self.a_data.length - len(self.a_data.modified)
-        b_equals = self.b_data.length - len(self.b_data.modified)
+        a_equals = self.a_data.length - self.a_data.modified.count(1)
+        b_equals = self.b_data.length - self.b_data.modified.count(1)
 
         return 1.0 * (a_equals + b_equals) / \
                      (self.a_data.length + self.b_data.length)
@@ -78,18 +105,21 @@ class MyersDiffer:
         """
         self._gen_diff_data()
 
+        a_length = self.a_data.length
+        b_length = self.b_data.length
+        a_modified = self.a_data.modified
+        b_modified = self.b_data.modified
+
         a_line = b_line = 0
         last_group = None
 
         # Go through the entire set of lines on both the old and new files
-        while a_line < self.a_data.length or b_line < self.b_data.length:
+        while a_line < a_length or b_line < b_length:
             a_start = a_line
             b_start = b_line
 
-            if a_line < self.a_data.length and \
-               not self.a_data.modified.get(a_line, False) and \
-               b_line < self.b_data.length and \
-               not self.b_data.modified.get(b_line, False):
+            if a_line < a_length and not a_modified[a_line] and \
+               b_line < b_length and not b_modified[b_line]:
                 # Equal
                 a_changed = b_changed = 1
                 tag = "equal"
@@ -101,17 +131,15 @@ class MyersDiffer:
                 # Count every old line that's been modified, and the
                 # remainder of old lines if we've reached the end of the new
                 # file.
-                while a_line < self.a_data.length and \
-                      (b_line >= self.b_data.length or \
-                       self.a_data.modified.get(a_line, False)):
+                while a_line < a_length and \
+                      (b_line >= b_length or a_modified[a_line]):
                     a_line += 1
 
                 # Count every new line that's been modified, and the
                 # remainder of new lines if we've reached the end of the old
                 # file.
-                while b_line < self.b_data.length and \
-                      (a_line >= self.a_data.length or \
-                       self.b_data.modified.get(b_line, False)):
+                while b_line < b_length and \
+                      (a_line >= a_length or b_modified[b_line]):
                     b_line += 1
 
                 a_changed = a_line - a_start
@@ -148,7 +176,7 @@ class MyersDiffer:
 
 
         if not last_group:
-            last_group = ("equal", 0, self.a_data.length, 0, self.b_data.length)
+            last_group = ("equal", 0, a_length, 0, b_length)
 
         yield last_group
 
@@ -164,28 +192,40 @@ class MyersDiffer:
         self.b_data = self.DiffData(self._gen_diff_codes(self.b, True))
 
         self._discard_confusing_lines()
+        self._init_search()
+
+        self._lcs(0, self.a_data.undiscarded_lines,
+                  0, self.b_data.undiscarded_lines,
+                  self.minimal_diff)
+        self._shift_chunks(self.a_data, self.b_data)
+        self._shift_chunks(self.b_data, self.a_data)
 
+    def _init_search(self):
+        """
+        Sets up the state used by _lcs, once the undiscarded lines are known.
+        """
         self.max_lines = self.a_data.undiscarded_lines + \
                          self.b_data.undiscarded_lines + 3
 
         vector_size = self.a_data.undiscarded_lines + \
                       self.b_data.undiscarded_lines + 3
-        self.fdiag = [0] * vector_size
-        self.bdiag = [0] * vector_size
+        self.fdiag = array('l', [0]) * vector_size
+        self.bdiag = array('l', [0]) * vector_size
         self.downoff = self.upoff = self.b_data.undiscarded_lines + 1
 
-        self._lcs(0, self.a_data.undiscarded_lines,
-                  0, self.b_data.undiscarded_lines,
-                  self.minimal_diff)
-        self._shift_chunks(self.a_data, self.b_data)
-        self._shift_chunks(self.b_data, self.a_data)
+        if self.max_time:
+            self.deadline = time.time() + self.max_time
 
     def _gen_diff_codes(self, lines, is_modified_file):
         """
         Converts all unique lines of text into unique numbers. Comparing
-        lists of numbers is faster than comparing lists of strings.
+        arrays of numbers is faster than comparing lists of strings.
         """
-        codes = []
+        codes = array('l')
+        add_code = codes.append
+        code_table = self.code_table
+        interesting_line_table = self.interesting_line_table
+        ignore_space = self.ignore_space
 
         linenum = 0
 
@@ -201,22 +241,21 @@ class MyersDiffer:
             raw_line = line
             stripped_line = line.lstrip()
 
-            if self.ignore_space:
+            if ignore_space:
                 # We still want to show lines that contain only whitespace.
                 if len(stripped_line) > 0:
                     line = stripped_line
 
             interesting_line_name = None
+            code = code_table.get(line)
 
-            try:
-                code = self.code_table[line]
-                interesting_line_name = \
-                    self.interesting_line_table.get(code, None)
-            except KeyError:
+            if code is not None:
+                interesting_line_name = interesting_line_table.get(code, None)
+            else:
                 # This is a new, unrecorded line, so mark it and store it.
                 self.last_code += 1
                 code = self.last_code
-                self.code_table[line] = code
+                code_table[line] = code
 
                 # Check to see if this is an interesting line that the caller
                 # wants recorded.
@@ -224,14 +263,14 @@ class MyersDiffer:
                     for name, regex in self.interesting_line_regexes:
                         if regex.match(raw_line):
                             interesting_line_name = name
-                            self.interesting_line_table[code] = name
+                            interesting_line_table[code] = name
                             break
 
             if interesting_line_name:
                 interesting_lines[interesting_line_name].append((linenum,
                                                                  raw_line))
 
-            codes.append(code)
+            add_code(code)
 
             linenum += 1
 
@@ -243,6 +282,8 @@ class MyersDiffer:
         """
         down_vector = self.fdiag # The vector for the (0, 0) to (x, y) search
         up_vector   = self.bdiag # The vector for the (u, v) to (N, M) search
+        a_undiscarded = self.a_data.undiscarded
+        b_undiscarded = self.b_data.undiscarded
 
         down_k = a_lower - b_lower # The k-line to start the forward search
         up_k   = a_upper - b_upper # The k-line to start the reverse search
@@ -258,7 +299,8 @@ class MyersDiffer:
         up_min   = up_max   = up_k
 
         cost = 0
-        max_cost = max(256, self._very_approx_sqrt(self.max_lines * 4))
+        max_cost = self.max_cost
+        deadline = self.deadline
 
         while True:
             cost += 1
@@ -292,7 +334,7 @@ class MyersDiffer:
                 # Find the end of the furthest reaching forward D-path in
                 # diagonal k
                 while x < a_upper and y < b_upper and \
-                      self.a_data.undiscarded[x] == self.b_data.undiscarded[y]:
+                      a_undiscarded[x] == b_undiscarded[y]:
                     x += 1
                     y += 1
 
@@ -331,8 +373,7 @@ class MyersDiffer:
                 old_x = x
 
                 while x > a_lower and y > b_lower and \
-                      self.a_data.undiscarded[x - 1] == \
-                      self.b_data.undiscarded[y - 1]:
+                      a_undiscarded[x - 1] == b_undiscarded[y - 1]:
                     x -= 1
                     y -= 1
 
@@ -345,6 +386,15 @@ class MyersDiffer:
 
                 up_vector[self.upoff + k] = x
 
+            # Running out of time trumps everything, including the need
+            # for a minimal diff.
+            if deadline and time.time() >= deadline:
+                self.approximate = True
+                return self._find_halfway_point(a_lower, a_upper,
+                                                b_lower, b_upper,
+                                                down_min, down_max,
+                                                up_min, up_max)
+
             if find_minimal:
                 continue
 
@@ -387,51 +437,62 @@ class MyersDiffer:
                 if best > 0:
                     return ret_x, ret_y, False, True
 
-            continue # XXX
-
             # If we've reached or gone past the max cost, just give up now
             # and report the halfway point between our best results.
-            if cost >= max_cost:
-                fx_best = bx_best = 0
-
-                # Find the forward diagonal that maximized x + y
-                fxy_best = -1
-                for d in xrange(down_max, down_min - 1, -2):
-                    x = min(down_vector[self.downoff + d], a_upper)
-                    y = x - d
-
-                    if b_upper < y:
-                        x = b_upper + d
-                        y = b_upper
-
-                    if fxy_best < x + y:
-                        fxy_best = x + y
-                        fx_best = x
-
-                # Find the backward diagonal that minimizes x + y
-                bxy_best = self.max_lines
-                for d in xrange(up_max, up_min - 1, -2):
-                    x = max(a_lower, up_vector[self.upoff + d])
-                    y = x - d
-
-                    if y < b_lower:
-                        x = b_lower + d
-                        y = b_lower
-
-                    if x + y < bxy_best:
-                        bxy_best = x + y
-                        bx_best = x
-
-                # Use the better of the two diagonals
-                if a_upper + b_upper - bxy_best < \
-                   fxy_best - (a_lower + b_lower):
-                    return fx_best, fxy_best - fx_best, True, False
-                else:
-                    return bx_best, bxy_best - bx_best, False, True
-
+            if max_cost and cost >= max_cost:
+                self.approximate = True
+                return self._find_halfway_point(a_lower, a_upper,
+                                                b_lower, b_upper,
+                                                down_min, down_max,
+                                                up_min, up_max)
 
         raise Exception("The function should not have reached here.")
 
+    def _find_halfway_point(self, a_lower, a_upper, b_lower, b_upper,
+                            down_min, down_max, up_min, up_max):
+        """
+        Returns the furthest point reached by either the forward or the
+        reverse search so far, in the same form as _find_sms.
+        """
+        down_vector = self.fdiag
+        up_vector = self.bdiag
+        fx_best = bx_best = 0
+
+        # Find the forward diagonal that maximized x + y
+        fxy_best = -1
+        for d in xrange(down_max, down_min - 1, -2):
+            x = min(down_vector[self.downoff + d], a_upper)
+            y = x - d
+
+            if b_upper < y:
+                x = b_upper + d
+                y = b_upper
+
+            if fxy_best < x + y:
+                fxy_best = x + y
+                fx_best = x
+
+        # Find the backward diagonal that minimizes x + y
+        bxy_best = self.max_lines
+        for d in xrange(up_max, up_min - 1, -2):
+            x = max(a_lower, up_vector[self.upoff + d])
+            y = x - d
+
+            if y < b_lower:
+                x = b_lower + d
+                y = b_lower
+
+            if x + y < bxy_best:
+                bxy_best = x + y
+                bx_best = x
+
+        # Use the better of the two diagonals
+        if a_upper + b_upper - bxy_best < \
+           fxy_best - (a_lower + b_lower):
+            return fx_best, fxy_best - fx_best, True, False
+        else:
+            return bx_best, bxy_best - bx_best, False, True
+
     def _find_diagonal(self, minimum, maximum, k, best, diagoff, vector,
                        vdiff_func, check_x_range, check_y_range,
                        discard_index, k_offset, cost):
@@ -462,29 +523,33 @@ class MyersDiffer:
         The divide-and-conquer implementation of the Longest Common
         Subsequence (LCS) algorithm.
         """
+        a_undiscarded = self.a_data.undiscarded
+        b_undiscarded = self.b_data.undiscarded
+
         # Fast walkthrough equal lines at the start
         while a_lower < a_upper and b_lower < b_upper and \
-              self.a_data.undiscarded[a_lower] == \
-              self.b_data.undiscarded[b_lower]:
+              a_undiscarded[a_lower] == b_undiscarded[b_lower]:
             a_lower += 1
             b_lower += 1
 
         while a_upper > a_lower and b_upper > b_lower and \
-              self.a_data.undiscarded[a_upper - 1] == \
-              self.b_data.undiscarded[b_upper - 1]:
+              a_undiscarded[a_upper - 1] == b_undiscarded[b_upper - 1]:
             a_upper -= 1
             b_upper -= 1
 
-        if a_lower == a_upper:
+        if a_lower < a_upper and b_lower < b_upper and \
+           self.deadline and time.time() >= self.deadline:
+            # We're out of time, so rather than searching any further,
+            # treat everything that's left in this range as changed.
+            self.approximate = True
+            self._mark_modified(self.a_data, a_lower, a_upper)
+            self._mark_modified(self.b_data, b_lower, b_upper)
+        elif a_lower == a_upper:
             # Inserted lines.
-            while b_lower < b_upper:
-                self.b_data.modified[self.b_data.real_indexes[b_lower]] = True
-                b_lower += 1
+            self._mark_modified(self.b_data, b_lower, b_upper)
         elif b_lower == b_upper:
             # Deleted lines
-            while a_lower < a_upper:
-                self.a_data.modified[self.a_data.real_indexes[a_lower]] = True
-                a_lower += 1
+            self._mark_modified(self.a_data, a_lower, a_upper)
         else:
             # Find the middle snake and length of an optimal path for A and B
             x, y, low_minimal, high_minimal = \
@@ -494,6 +559,13 @@ class MyersDiffer:
             self._lcs(a_lower, x, b_lower, y, low_minimal)
             self._lcs(x, a_upper, y, b_upper, high_minimal)
 
+    def _mark_modified(self, data, lower, upper):
+        modified = data.modified
+        real_indexes = data.real_indexes
+
+        for i in xrange(lower, upper):
+            modified[real_indexes[i]] = 1
+
     def _shift_chunks(self, data, other_data):
         """
         Shifts the inserts/deletes of identical lines in order to join
@@ -507,28 +579,37 @@ class MyersDiffer:
         the two lines are identical, we can shift the chunk so that the line
         appears both before and after the line, rather than only after.
         """
+        modified = data.modified
+        other_modified = other_data.modified
+        other_length = other_data.length
+        lines = data.data
+
+        # j doesn't always stay within the bounds of the other data set,
+        # so lookups for it have to be bounds-checked. Lines out of bounds
+        # are never modified.
+
         i = j = 0
         i_end = data.length
 
         while True:
             # Scan forward in order to find the start of a run of changes.
-            while i < i_end and not data.modified.get(i, False):
+            while i < i_end and not modified[i]:
                 i += 1
 
-                while other_data.modified.get(j, False):
+                while 0 <= j < other_length and other_modified[j]:
                     j += 1
 
             if i == i_end:
-                return;
+                return
 
             start = i
 
             # Find the end of these changes
             i += 1
-            while data.modified.get(i, False):
+            while modified[i]:
                 i += 1
 
-            while other_data.modified.get(j, False):
+            while 0 <= j < other_length and other_modified[j]:
                 j += 1
 
             while True:
@@ -537,43 +618,43 @@ class MyersDiffer:
                 # Move the changed chunks back as long as the previous
                 # unchanged line matches the last changed line.
                 # This merges with the previous changed chunks.
-                while start != 0 and data.data[start - 1] == data.data[i - 1]:
+                while start != 0 and lines[start - 1] == lines[i - 1]:
                     start -= 1
                     i -= 1
 
-                    data.modified[start] = True
-                    data.modified[i] = False
+                    modified[start] = 1
+                    modified[i] = 0
 
-                    while data.modified.get(start - 1, False):
+                    while modified[start - 1]:
                         start -= 1
 
                     j -= 1
-                    while other_data.modified.get(j, False):
+                    while 0 <= j < other_length and other_modified[j]:
                         j -= 1
 
                 # The end of the changed run at the last point where it
                 # corresponds to the changed run in the other data set.
                 # If it's equal to i_end, then we didn't find a corresponding
                 # point.
-                if other_data.modified.get(j - 1, False):
+                if 0 < j <= other_length and other_modified[j - 1]:
                     corresponding = i
                 else:
                     corresponding = i_end
 
                 # Move the changed region forward as long as the first
                 # changed line is the same as the following unchanged line.
-                while i != i_end and data.data[start] == data.data[i]:
-                    data.modified[start] = False
-                    data.modified[i] = True
+                while i != i_end and lines[start] == lines[i]:
+                    modified[start] = 0
+                    modified[i] = 1
 
                     start += 1
                     i += 1
 
-                    while data.modified.get(i, False):
+                    while modified[i]:
                         i += 1
 
                     j += 1
-                    while other_data.modified.get(j, False):
+                    while 0 <= j < other_length and other_modified[j]:
                         j += 1
                         corresponding = i
 
@@ -586,25 +667,27 @@ class MyersDiffer:
                 start -= 1
                 i -= 1
 
-                data.modified[start] = True
-                data.modified[i] = False
+                modified[start] = 1
+                modified[i] = 0
 
                 j -= 1
-                while other_data.modified.get(j, False):
+                while 0 <= j < other_length and other_modified[j]:
                     j -= 1
 
     def _discard_confusing_lines(self):
         def build_discard_list(data, discards, counts):
             many = 5 * self._very_approx_sqrt(data.length / 64)
+            discard_found = self.DISCARD_FOUND
+            discard_cancel = self.DISCARD_CANCEL
 
             for i, item in enumerate(data.data):
                 if item != 0:
                     num_matches = counts[item]
 
                     if num_matches == 0:
-                        discards[i] = self.DISCARD_FOUND
+                        discards[i] = discard_found
                     elif num_matches > many:
-                        discards[i] = self.DISCARD_CANCEL
+                        discards[i] = discard_cancel
 
         def scan_run(discards, i, length, index_func):
             consec = 0
@@ -688,26 +771,32 @@ class MyersDiffer:
                 i += 1
 
         def discard_lines(data, discards):
+            undiscarded = data.undiscarded
+            real_indexes = data.real_indexes
+            modified = data.modified
+            minimal_diff = self.minimal_diff
+            discard_none = self.DISCARD_NONE
+
             j = 0
             for i, item in enumerate(data.data):
-                if self.minimal_diff or discards[i] == self.DISCARD_NONE:
-                    data.undiscarded[j] = item
-                    data.real_indexes[j] = i
+                if minimal_diff or discards[i] == discard_none:
+                    undiscarded[j] = item
+                    real_indexes[j] = i
                     j += 1
                 else:
-                    data.modified[i] = True
+                    modified[i] = 1
 
             data.undiscarded_lines = j
 
 
-        self.a_data.undiscarded = [0] * self.a_data.length
-        self.b_data.undiscarded = [0] * self.b_data.length
-        self.a_data.real_indexes = [0] * self.a_data.length
-        self.b_data.real_indexes = [0] * self.b_data.length
-        a_discarded = [0] * self.a_data.length
-        b_discarded = [0] * self.b_data.length
-        a_code_counts = [0] * (1 + self.last_code)
-        b_code_counts = [0] * (1 + self.last_code)
+        self.a_data.undiscarded = array('l', [0]) * self.a_data.length
+        self.b_data.undiscarded = array('l', [0]) * self.b_data.length
+        self.a_data.real_indexes = array('l', [0]) * self.a_data.length
+        self.b_data.real_indexes = array('l', [0]) * self.b_data.length
+        a_discarded = array('B', [0]) * self.a_data.length
+        b_discarded = array('B', [0]) * self.b_data.length
+        a_code_counts = array('l', [0]) * (1 + self.last_code)
+        b_code_counts = array('l', [0]) * (1 + self.last_code)
 
         for item in self.a_data.data:
             a_code_counts[item] += 1
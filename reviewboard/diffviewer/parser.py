@@ -1,5 +1,8 @@
 import logging
+import mmap
+import os
 import re
+from array import array
 
 
 class File(object):
@@ -20,6 +23,88 @@ class DiffParserError(Exception):
         self.linenum = linenum
 
 
+class DiffLines(object):
+    """The lines in a diff, without their line endings.
+
+    Rather than splitting the diff into a list of lines up-front, only the
+    offset of each line is stored. Lines are sliced out of the diff when
+    they're accessed, and get_data slices out a whole range of lines at
+    once. This keeps the memory used for large diffs down to little more
+    than the diff itself.
+
+    Lines are split the same way as str.splitlines would split them.
+    """
+    # The offsets are found by splitting the diff a block at a time.
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, data):
+        self.data = data
+
+        # The offset of the start of each line, followed by the end of
+        # the diff.
+        self.offsets = array('l', [0])
+        append = self.offsets.append
+        size = len(data)
+        pos = 0
+
+        while pos < size:
+            block = data[pos:pos + self.BLOCK_SIZE]
+
+            if pos + len(block) < size:
+                # Only split complete lines. Ending the block on a "\n"
+                # also makes sure a "\r\n" is never split in two.
+                cut = block.rfind('\n') + 1
+
+                if cut:
+                    block = block[:cut]
+                else:
+                    end = data.find('\n', pos + len(block))
+
+                    if end == -1:
+                        block = data[pos:]
+                    else:
+                        block = data[pos:end + 1]
+
+            for length in map(len, block.splitlines(True)):
+                pos += length
+                append(pos)
+
+        self.num_lines = len(self.offsets) - 1
+
+    def __len__(self):
+        return self.num_lines
+
+    def __getitem__(self, linenum):
+        if linenum < 0:
+            linenum += self.num_lines
+
+        # A line can't contain any line ending characters, so everything
+        # stripped off is its own line ending.
+        return self.data[self.offsets[linenum]:
+                         self.offsets[linenum + 1]].rstrip('\r\n')
+
+    def get_data(self, start, end):
+        """Returns the lines from start up to end as a string.
+
+        As with the lines themselves, every line ends with a "\n", no
+        matter what line endings are in the diff.
+        """
+        end = min(end, self.num_lines)
+
+        if start >= end:
+            return ""
+
+        data = self.data[self.offsets[start]:self.offsets[end]]
+
+        if '\r' in data:
+            data = data.replace('\r\n', '\n').replace('\r', '\n')
+
+        if not data.endswith('\n'):
+            data += '\n'
+
+        return data
+
+
 class DiffParser(object):
     """
     Parses diff files into fragments, taking into account special fields
@@ -29,8 +114,40 @@ class DiffParser(object):
     INDEX_SEP = "=" * 67
 
     def __init__(self, data):
+        """Sets up the parser for a diff.
+
+        The diff can be given as a string or as a file-like object. Files
+        stored on disk are mapped into memory rather than read in, so that
+        large uploads don't need to be held in memory as a whole.
+        """
+        if hasattr(data, 'read') and not isinstance(data, mmap.mmap):
+            data = self._load_file(data)
+
         self.data = data
-        self.lines = data.splitlines()
+        self.lines = DiffLines(data)
+
+    def _load_file(self, f):
+        try:
+            fileno = f.fileno()
+            size = os.fstat(fileno).st_size
+        except (AttributeError, EnvironmentError, ValueError):
+            # This isn't a real file, such as an upload held in memory.
+            return f.read()
+
+        if size == 0:
+            # Empty files can't be mapped.
+            return ""
+
+        return mmap.mmap(fileno, size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Releases the diff's memory mapping, if it was mapped from a file.
+
+        The File objects returned by parse have copies of their own data,
+        so this should be called once the diff has been parsed.
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
 
     def parse(self):
         """
@@ -42,23 +159,30 @@ class DiffParser(object):
 
         self.files = []
         file = None
+        data_start = 0
+        num_lines = len(self.lines)
         i = 0
 
         # Go through each line in the diff, looking for diff headers.
-        while i < len(self.lines):
+        while i < num_lines:
             next_linenum, new_file = self.parse_change_header(i)
 
             if new_file:
-                # This line is the start of a new file diff.
+                # This line is the start of a new file diff. Everything
+                # since the last one belongs to the previous file.
+                if file:
+                    file.data += self.lines.get_data(data_start, i)
+
                 file = new_file
                 self.files.append(file)
                 i = next_linenum
+                data_start = i
             else:
-                if file:
-                    file.data += self.lines[i] + "\n"
-
                 i += 1
 
+        if file:
+            file.data += self.lines.get_data(data_start, num_lines)
+
         logging.debug("DiffParser.parse: Finished parsing diff.")
 
         return self.files
@@ -86,7 +210,7 @@ class DiffParser(object):
             file.origInfo = info.get('origInfo')
             file.newInfo  = info.get('newInfo')
             file.origChangesetId = info.get('origChangesetId')
-            file.data = ""
+            header = []
 
             # The header is part of the diff, so make sure it gets in the
             # diff content. But only the parts that patch will understand.
@@ -103,7 +227,9 @@ class DiffParser(object):
                     self.lines[i + 1] == self.INDEX_SEP):
 
                     # This is a valid part of a diff header. Add it.
-                    file.data += self.lines[i] + "\n"
+                    header.append(line + "\n")
+
+            file.data = "".join(header)
 
         return linenum, file
 
@@ -116,13 +242,17 @@ class DiffParser(object):
         The line number returned is the line after the special header,
         which can be multiple lines long.
         """
-        if linenum + 1 < len(self.lines) and \
-           self.lines[linenum].startswith("Index: ") and \
+        if linenum + 1 >= len(self.lines):
+            return linenum
+
+        line = self.lines[linenum]
+
+        if line.startswith("Index: ") and \
            self.lines[linenum + 1] == self.INDEX_SEP:
             # This is an Index: header, which is common in CVS and Subversion,
             # amongst other systems.
             try:
-                info['index'] = self.lines[linenum].split(None, 2)[1]
+                info['index'] = line.split(None, 2)[1]
             except ValueError:
                 raise DiffParserError("Malformed Index line", linenum)
             linenum += 2
@@ -137,18 +267,21 @@ class DiffParser(object):
         The line number returned is the line after the special header,
         which can be multiple lines long.
         """
-        if linenum + 1 < len(self.lines) and \
-           ((self.lines[linenum].startswith('--- ') and
-             self.lines[linenum + 1].startswith('+++ ')) or
-            (self.lines[linenum].startswith('*** ') and
-             self.lines[linenum + 1].startswith('--- ') and
-             not self.lines[linenum].endswith(" ****"))):
+        if linenum + 1 >= len(self.lines):
+            return linenum
+
+        line = self.lines[linenum]
+
+        if (line.startswith('--- ') and
+            self.lines[linenum + 1].startswith('+++ ')) or \
+           (line.startswith('*** ') and
+            self.lines[linenum + 1].startswith('--- ') and
+            not line.endswith(" ****")):
             # This is a unified or context diff header. Parse the
             # file and extra info.
             try:
                 info['origFile'], info['origInfo'] = \
-                    self.parse_filename_header(self.lines[linenum][4:],
-                                               linenum)
+                    self.parse_filename_header(line[4:], linenum)
                 linenum += 1
 
                 info['newFile'], info['newInfo'] = \
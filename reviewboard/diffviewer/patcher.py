@@ -0,0 +1,350 @@
+import re
+
+
+class PatchError(Exception):
+    """An error applying a diff in-process.
+
+    If the error is specific to a hunk, hunk_num contains the 1-based
+    number of that hunk and hunk_header contains its "@@" line.
+    """
+    def __init__(self, msg, hunk_num=None, hunk_header=None):
+        Exception.__init__(self, msg)
+        self.hunk_num = hunk_num
+        self.hunk_header = hunk_header
+
+
+class Hunk(object):
+    """A single hunk of a unified diff.
+
+    Each entry in lines is a tuple of (op, text, has_newline), where op is
+    one of ' ', '-' or '+', and text does not contain the line ending.
+    """
+    def __init__(self, num, header, orig_start, orig_len, new_start,
+                 new_len):
+        self.num = num
+        self.header = header
+        self.orig_start = orig_start
+        self.orig_len = orig_len
+        self.new_start = new_start
+        self.new_len = new_len
+        self.lines = []
+
+    def get_prefix_context(self):
+        """Returns the number of context lines at the start of the hunk."""
+        i = 0
+
+        while i < len(self.lines) and self.lines[i][0] == ' ':
+            i += 1
+
+        return i
+
+    def get_suffix_context(self):
+        """Returns the number of context lines at the end of the hunk."""
+        i = 0
+
+        while i < len(self.lines) and self.lines[-(i + 1)][0] == ' ':
+            i += 1
+
+        return i
+
+
+class Patcher(object):
+    """Applies a unified diff to a buffer without calling out to `patch`.
+
+    This understands enough of GNU patch's behavior to handle the diffs
+    we store: hunks that have moved (offset), hunks whose outer context
+    no longer matches (fuzz), and "\\ No newline at end of file" markers.
+
+    Anything it doesn't understand, such as context diffs, results in a
+    PatchError so the caller can fall back on the real `patch`.
+    """
+    MAX_FUZZ = 2
+
+    HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+    def __init__(self, diff, data, max_fuzz=MAX_FUZZ):
+        self.diff = diff
+        self.data = data
+        self.max_fuzz = max_fuzz
+
+    def patch(self):
+        """Returns the patched buffer.
+
+        Both the diff and the buffer are expected to have had their line
+        endings normalized to "\\n".
+        """
+        hunks = self._parse_hunks()
+
+        if not hunks:
+            raise PatchError("No unified diff hunks were found")
+
+        orig, eof_newline = self._split_lines(self.data)
+        result = []
+        orig_pos = 0
+        offset = 0
+
+        for hunk in hunks:
+            pos, prefix_fuzz, suffix_fuzz = \
+                self._find_hunk(hunk, orig, orig_pos, offset)
+            offset = pos - self._get_expected_pos(hunk)
+
+            # Any context we had to ignore is left as it is in the file.
+            lines = hunk.lines[prefix_fuzz:len(hunk.lines) - suffix_fuzz]
+            match_pos = pos + prefix_fuzz
+            num_orig = len([line for line in lines if line[0] != '+'])
+            new_lines = [line for line in lines if line[0] != '-']
+
+            result.extend(orig[orig_pos:match_pos])
+            result.extend([line[1] for line in new_lines])
+            orig_pos = match_pos + num_orig
+
+            if orig_pos == len(orig):
+                # This hunk touched the end of the file, so it decides
+                # whether the file ends in a newline.
+                if new_lines:
+                    eof_newline = new_lines[-1][2]
+                else:
+                    eof_newline = True
+
+        result.extend(orig[orig_pos:])
+
+        if not result:
+            return ""
+
+        data = "\n".join(result)
+
+        if eof_newline:
+            data += "\n"
+
+        return data
+
+    def _parse_hunks(self):
+        hunks = []
+        lines = self.diff.split("\n")
+        num_lines = len(lines)
+        i = 0
+
+        # A trailing "\n" leaves an empty string at the end, which isn't
+        # a line of its own.
+        if lines and lines[-1] == "":
+            num_lines -= 1
+
+        while i < num_lines:
+            line = lines[i]
+            i += 1
+
+            if not line.startswith("@@"):
+                if hunks and line.startswith("--- ") and i < num_lines and \
+                   lines[i].startswith("+++ "):
+                    raise PatchError("The diff contains more than one file")
+
+                # Anything else outside of a hunk is header information
+                # or garbage, both of which patch ignores.
+                continue
+
+            m = self.HUNK_HEADER_RE.match(line)
+
+            if not m:
+                raise PatchError("Malformed hunk header '%s'" % line,
+                                 len(hunks) + 1, line)
+
+            hunk = Hunk(len(hunks) + 1, line,
+                        int(m.group(1)), int(m.group(2) or 1),
+                        int(m.group(3)), int(m.group(4) or 1))
+            orig_left = hunk.orig_len
+            new_left = hunk.new_len
+
+            while orig_left > 0 or new_left > 0:
+                if i >= num_lines:
+                    raise PatchError("Hunk #%d is truncated" % hunk.num,
+                                     hunk.num, hunk.header)
+
+                line = lines[i]
+                i += 1
+
+                if line == "":
+                    # Some tools strip the trailing space from blank
+                    # context lines. patch accepts these, so we do too.
+                    op, text = ' ', ''
+                else:
+                    op, text = line[0], line[1:]
+
+                if op == ' ':
+                    orig_left -= 1
+                    new_left -= 1
+                elif op == '-':
+                    orig_left -= 1
+                elif op == '+':
+                    new_left -= 1
+                elif op == '\\':
+                    self._mark_no_newline(hunk)
+                    continue
+                else:
+                    raise PatchError("Hunk #%d has an unexpected line '%s'" %
+                                     (hunk.num, line),
+                                     hunk.num, hunk.header)
+
+                if orig_left < 0 or new_left < 0:
+                    raise PatchError("Hunk #%d has more lines than its "
+                                     "header states" % hunk.num,
+                                     hunk.num, hunk.header)
+
+                hunk.lines.append((op, text, True))
+
+            # The "\ No newline at end of file" marker for the last line
+            # comes after the line counts are satisfied.
+            if i < num_lines and lines[i].startswith("\\"):
+                self._mark_no_newline(hunk)
+                i += 1
+
+            hunks.append(hunk)
+
+        return hunks
+
+    def _mark_no_newline(self, hunk):
+        if not hunk.lines:
+            raise PatchError("Hunk #%d has a misplaced newline marker" %
+                             hunk.num, hunk.num, hunk.header)
+
+        op, text, has_newline = hunk.lines[-1]
+        hunk.lines[-1] = (op, text, False)
+
+    def _split_lines(self, data):
+        """Splits a buffer into lines.
+
+        Returns the lines, without line endings, and whether the last
+        line ended with a newline.
+        """
+        if data == "":
+            return [], True
+
+        lines = data.split("\n")
+
+        if lines[-1] == "":
+            lines.pop()
+            return lines, True
+
+        return lines, False
+
+    def _get_expected_pos(self, hunk):
+        """Returns the 0-based line where a hunk is expected to start."""
+        if hunk.orig_len == 0:
+            # An empty range means "insert after this line."
+            return hunk.orig_start
+        else:
+            return hunk.orig_start - 1
+
+    def _find_hunk(self, hunk, orig, min_pos, offset):
+        """Finds where a hunk applies.
+
+        This mimics the search in GNU patch. We first look for an exact
+        match of all the hunk's context, starting at the expected location
+        (adjusted by the offset of the previous hunk) and working outward.
+        Failing that, we ignore up to max_fuzz lines of leading and
+        trailing context and try again.
+
+        A hunk with less leading than trailing context must apply to the
+        start of the file, and one with less trailing than leading context
+        must apply to the end, just as with patch.
+
+        Returns a tuple of (line, prefix_fuzz, suffix_fuzz), where line is
+        the 0-based position of the first line of the hunk, including any
+        context that was ignored.
+        """
+        old_lines = [line[1] for line in hunk.lines if line[0] != '+']
+        num_old = len(old_lines)
+        first_guess = self._get_expected_pos(hunk) + offset
+
+        if num_old == 0:
+            # There's nothing to match against, so the hunk applies where
+            # it says it does.
+            if min_pos <= first_guess <= len(orig):
+                return first_guess, 0, 0
+
+            raise PatchError("Hunk #%d (%s) could not be applied" %
+                             (hunk.num, hunk.header),
+                             hunk.num, hunk.header)
+
+        prefix_context = hunk.get_prefix_context()
+        suffix_context = hunk.get_suffix_context()
+        context = max(prefix_context, suffix_context)
+
+        for fuzz in xrange(min(self.max_fuzz, context) + 1):
+            prefix_fuzz = fuzz + prefix_context - context
+            suffix_fuzz = fuzz + suffix_context - context
+
+            if prefix_fuzz < 0 and hunk.orig_start <= 1:
+                # This can only match the start of the file.
+                if suffix_fuzz < 0 and num_old != len(orig):
+                    # In fact, it can only match the entire file.
+                    continue
+
+                if self._matches(orig, 0, old_lines, min_pos, 0,
+                                 max(suffix_fuzz, 0)):
+                    return 0, 0, max(suffix_fuzz, 0)
+
+                continue
+
+            prefix_fuzz = max(prefix_fuzz, 0)
+
+            if suffix_fuzz < 0:
+                # This can only match the end of the file.
+                pos = len(orig) - num_old
+
+                if self._matches(orig, pos, old_lines, min_pos,
+                                 prefix_fuzz, 0):
+                    return pos, prefix_fuzz, 0
+
+                continue
+
+            # Work outward from the expected position, alternating between
+            # later and earlier lines.
+            max_pos = len(orig) - num_old + suffix_fuzz
+            min_guess = min_pos - prefix_fuzz
+            max_offset = max(max_pos - first_guess, first_guess - min_guess)
+
+            for distance in xrange(max_offset + 1):
+                pos = first_guess + distance
+
+                if (pos <= max_pos and
+                    self._matches(orig, pos, old_lines, min_pos,
+                                  prefix_fuzz, suffix_fuzz)):
+                    return pos, prefix_fuzz, suffix_fuzz
+
+                pos = first_guess - distance
+
+                if (distance > 0 and pos >= 0 and
+                    self._matches(orig, pos, old_lines, min_pos,
+                                  prefix_fuzz, suffix_fuzz)):
+                    return pos, prefix_fuzz, suffix_fuzz
+
+        raise PatchError("Hunk #%d (%s) could not be applied" %
+                         (hunk.num, hunk.header),
+                         hunk.num, hunk.header)
+
+    def _matches(self, orig, pos, old_lines, min_pos, prefix_fuzz,
+                 suffix_fuzz):
+        """Returns whether the hunk's original lines match at a position.
+
+        The first prefix_fuzz and last suffix_fuzz lines are not compared,
+        but the lines that are compared must all come after min_pos.
+        """
+        start = pos + prefix_fuzz
+        end = pos + len(old_lines) - suffix_fuzz
+
+        if start < min_pos or start < 0 or end > len(orig):
+            return False
+
+        for i in xrange(prefix_fuzz, len(old_lines) - suffix_fuzz):
+            if orig[pos + i] != old_lines[i]:
+                return False
+
+        return True
+
+
+def apply_patch(diff, data, max_fuzz=Patcher.MAX_FUZZ):
+    """Applies a unified diff to a buffer and returns the result.
+
+    A PatchError is raised if the diff can't be applied.
+    """
+    return Patcher(diff, data, max_fuzz).patch()
@@ -0,0 +1,336 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.db import connection
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard.admin.checks import get_can_enable_syntax_highlighting
+from reviewboard.diffviewer.diffutils import get_diff_files, \
+                                             prefetch_original_files
+from reviewboard.diffviewer.models import DiffSet, PrerenderJob
+from reviewboard.diffviewer.views import build_diff_fragment
+from reviewboard.reviews.signals import review_request_published
+
+
+# Finished jobs are kept around this long so their timings can be seen in
+# the administration UI.
+FINISHED_JOB_AGE = timedelta(days=7)
+
+# Jobs that have been running for longer than this are assumed to belong
+# to a worker or process that died, and are put back in the queue.
+RUNNING_JOB_TIMEOUT = timedelta(hours=1)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+class PrerenderWorker(threading.Thread):
+    """Runs pre-render jobs in the background of a Review Board process.
+
+    The worker is started when a job is queued, and keeps checking for
+    new jobs until it has been idle for a while. It also checks the queue
+    every few seconds, so that it picks up jobs queued in transactions
+    that hadn't been committed yet when it was woken up.
+    """
+    POLL_INTERVAL = 5
+    IDLE_TIMEOUT = 60
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="diff-prerender")
+        self.setDaemon(True)
+        self.wakeup = threading.Event()
+
+    def run(self):
+        global _worker
+
+        idle_since = time.time()
+
+        try:
+            while True:
+                self.wakeup.clear()
+
+                try:
+                    num_jobs = process_prerender_jobs()
+                except Exception, e:
+                    logging.error("Error processing pre-render jobs: %s" % e,
+                                  exc_info=1)
+                    num_jobs = 0
+
+                if num_jobs:
+                    idle_since = time.time()
+                elif time.time() - idle_since >= self.IDLE_TIMEOUT:
+                    _worker_lock.acquire()
+
+                    try:
+                        # Anything queued while we were checking will have
+                        # woken us up, so we only exit if nothing was.
+                        if not self.wakeup.isSet():
+                            _worker = None
+                            return
+                    finally:
+                        _worker_lock.release()
+
+                self.wakeup.wait(self.POLL_INTERVAL)
+        finally:
+            connection.close()
+
+
+def queue_prerender(diffset, history=None):
+    """Queues a new diffset to be pre-rendered.
+
+    If a diffset history is given, the interdiff between the latest earlier
+    revision in it and the new diffset is pre-rendered as well.
+
+    Nothing is queued unless pre-rendering is enabled in the site
+    configuration. If the site is set up to run jobs in-process, a worker
+    is started to run them.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    if not siteconfig.get('diffviewer_prerender_diffs'):
+        return
+
+    _queue_job(diffset, None)
+
+    if history:
+        previous_diffsets = \
+            history.diffsets.filter(revision__lt=diffset.revision)
+
+        try:
+            _queue_job(previous_diffsets.latest(), diffset)
+        except DiffSet.DoesNotExist:
+            pass
+
+    if siteconfig.get('diffviewer_prerender_in_process'):
+        start_prerender_worker()
+
+
+def _queue_job(diffset, interdiffset):
+    # A diff only needs to be pre-rendered once, unless that failed.
+    jobs = PrerenderJob.objects.filter(
+        diffset=diffset,
+        interdiffset=interdiffset,
+        status__in=(PrerenderJob.PENDING, PrerenderJob.RUNNING,
+                    PrerenderJob.DONE))
+
+    if not jobs.exists():
+        PrerenderJob.objects.create(diffset=diffset,
+                                    interdiffset=interdiffset)
+
+
+def start_prerender_worker():
+    """Starts the background worker, or wakes it up if it's running."""
+    global _worker
+
+    _worker_lock.acquire()
+
+    try:
+        if _worker is None:
+            _worker = PrerenderWorker()
+            _worker.start()
+        else:
+            _worker.wakeup.set()
+    finally:
+        _worker_lock.release()
+
+
+def process_prerender_jobs():
+    """Runs all pending pre-render jobs in the current thread.
+
+    Jobs are claimed one at a time, so this can safely run in several
+    processes at once. Returns the number of jobs that were run.
+    """
+    num_jobs = 0
+    requeue_stalled_jobs()
+
+    while True:
+        job = _claim_next_job()
+
+        if job is None:
+            break
+
+        run_prerender_job(job)
+        num_jobs += 1
+
+    if num_jobs:
+        PrerenderJob.objects.filter(
+            status__in=(PrerenderJob.DONE, PrerenderJob.FAILED),
+            time_finished__lt=datetime.now() - FINISHED_JOB_AGE).delete()
+
+    return num_jobs
+
+
+def requeue_stalled_jobs():
+    """Puts jobs that have been running for too long back in the queue.
+
+    A job stays in the running state if the worker or process running it
+    dies. Returns the number of jobs that were requeued.
+    """
+    num_jobs = _get_stalled_jobs().update(status=PrerenderJob.PENDING,
+                                          time_started=None)
+
+    if num_jobs:
+        logging.warning("Requeued %d pre-render jobs that stopped running"
+                        % num_jobs)
+
+    return num_jobs
+
+
+def _get_stalled_jobs():
+    return PrerenderJob.objects.filter(
+        status=PrerenderJob.RUNNING,
+        time_started__lt=datetime.now() - RUNNING_JOB_TIMEOUT)
+
+
+def _claim_next_job():
+    """Marks the oldest pending job as running and returns it.
+
+    Returns None if there are no pending jobs.
+    """
+    while True:
+        pending = PrerenderJob.objects.filter(status=PrerenderJob.PENDING)
+
+        try:
+            job = pending.order_by('pk')[0]
+        except IndexError:
+            return None
+
+        now = datetime.now()
+
+        # Only one process can move the job out of the pending state. If
+        # another process beat us to it, try the next job.
+        if pending.filter(pk=job.pk).update(status=PrerenderJob.RUNNING,
+                                            time_started=now):
+            job.status = PrerenderJob.RUNNING
+            job.time_started = now
+            return job
+
+
+def run_prerender_job(job):
+    """Runs a single pre-render job and records the outcome on it."""
+    start = time.time()
+
+    try:
+        job.num_files, errors = prerender_diffset(job.diffset,
+                                                  job.interdiffset)
+    except Exception, e:
+        logging.error("Unable to pre-render %s: %s" % (job, e),
+                      exc_info=1)
+        errors = [unicode(e)]
+
+    if errors:
+        job.status = PrerenderJob.FAILED
+        job.error = u"\n".join(errors)
+    else:
+        job.status = PrerenderJob.DONE
+
+    job.time_finished = datetime.now()
+    job.duration = time.time() - start
+    job.save()
+
+
+def prerender_diffset(diffset, interdiffset=None):
+    """Generates and caches the diff viewer's output for a diffset.
+
+    Each file's original contents are fetched, its chunks are generated
+    and its fragment is rendered, just as when the diff viewer loads it.
+    Fragments are rendered with the site's default settings, which is what
+    most users will see.
+
+    Returns a tuple of the number of files and a list of errors for files
+    that couldn't be rendered.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    highlighting = (siteconfig.get('diffviewer_syntax_highlighting') and
+                    get_can_enable_syntax_highlighting())
+    files = get_diff_files(diffset, None, interdiffset, highlighting, False)
+    errors = []
+
+    # Fetching the files is usually the slowest part, so they're all
+    # fetched up front, several at a time, rather than one by one below.
+    filediffs = []
+
+    for file in files:
+        for filediff in (file['filediff'], file['interfilediff']):
+            if filediff:
+                filediffs.append(filediff)
+
+    prefetch_original_files(filediffs)
+
+    for file in files:
+        filediff = file['filediff']
+
+        try:
+            if interdiffset and filediff.diffset_id == interdiffset.id:
+                temp_files = get_diff_files(interdiffset, filediff, None,
+                                            highlighting, True)
+            else:
+                temp_files = get_diff_files(diffset, filediff, interdiffset,
+                                            highlighting, True)
+
+            if temp_files:
+                temp_file = temp_files[0]
+                temp_file['index'] = file['index']
+                build_diff_fragment(None, temp_file, None, highlighting,
+                                    True, {'standalone': False})
+        except Exception, e:
+            logging.warning("Unable to pre-render %s in %s: %s" %
+                            (filediff.source_file, diffset, e),
+                            exc_info=1)
+            errors.append(u"%s: %s" % (filediff.source_file, e))
+
+    return len(files), errors
+
+
+def get_prerender_stats():
+    """Returns statistics on the pre-render queue.
+
+    This contains the number of pending, running, stalled and failed jobs,
+    and the average time taken by recently finished jobs. Stalled jobs are
+    running jobs that will be requeued the next time jobs are processed.
+    """
+    recent_jobs = PrerenderJob.objects.filter(
+        status=PrerenderJob.DONE).order_by('-time_finished')[:100]
+    durations = [job.duration for job in recent_jobs]
+
+    if durations:
+        average_duration = sum(durations) / len(durations)
+    else:
+        average_duration = None
+
+    return {
+        'pending': PrerenderJob.objects.filter(
+            status=PrerenderJob.PENDING).count(),
+        'running': PrerenderJob.objects.filter(
+            status=PrerenderJob.RUNNING).count(),
+        'stalled': _get_stalled_jobs().count(),
+        'failed': PrerenderJob.objects.filter(
+            status=PrerenderJob.FAILED).count(),
+        'average_duration': average_duration,
+    }
+
+
+def review_request_published_cb(sender, user, review_request, changedesc,
+                                **kwargs):
+    """
+    Listens to the ``review_request_published`` signal and queues the
+    newly published diff, along with its interdiff against the previous
+    revision.
+    """
+    if changedesc and 'diff' not in changedesc.fields_changed:
+        return
+
+    history = review_request.diffset_history
+
+    try:
+        diffset = history.diffsets.latest()
+    except DiffSet.DoesNotExist:
+        return
+
+    queue_prerender(diffset, history)
+
+
+def connect_signals():
+    review_request_published.connect(review_request_published_cb)
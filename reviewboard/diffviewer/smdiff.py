@@ -9,6 +9,10 @@ class SMDiffer(SequenceMatcher):
     def __init__(self, a, b):
         SequenceMatcher.__init__(self, None, a, b)
 
+        # SequenceMatcher has no cost limit, so its diffs are never
+        # approximate.
+        self.approximate = False
+
     def add_interesting_line_regex(self, name, regex):
         pass
 
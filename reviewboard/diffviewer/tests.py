@@ -1,14 +1,45 @@
 import os
+import random
+import shutil
+import tempfile
+import threading
 import unittest
+from datetime import datetime, timedelta
+from StringIO import StringIO
 
+import nose
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError
 from django.test import TestCase
 from djblets.siteconfig.models import SiteConfiguration
-
-from reviewboard.diffviewer.models import DiffSet, FileDiff
+from djblets.util.fields import Base64DecodedValue
+from djblets.util.filesystem import is_exe_in_path
+
+from reviewboard import initialize, scmtools
+from reviewboard.diffviewer.cache import SizedLRUCache
+from reviewboard.diffviewer.filecache import FileCache, get_file_cache, \
+                                           get_file_cache_stats
+from reviewboard.diffviewer.forms import UploadDiffForm
+from reviewboard.diffviewer.models import DiffSet, DiffSetHistory, \
+                                         FileDiff, FileDiffData, PrerenderJob
+from reviewboard.diffviewer.prerender import FINISHED_JOB_AGE, \
+                                             RUNNING_JOB_TIMEOUT, \
+                                             get_prerender_stats, \
+                                             process_prerender_jobs, \
+                                             queue_prerender
 from reviewboard.diffviewer.templatetags.difftags import highlightregion
 import reviewboard.diffviewer.diffutils as diffutils
+import reviewboard.diffviewer.filecache as filecache
 import reviewboard.diffviewer.parser as diffparser
-from reviewboard.scmtools.models import Repository
+import reviewboard.diffviewer.patcher as patcher
+from reviewboard.scmtools.core import PRE_CREATION
+from reviewboard.scmtools.errors import FileNotFoundError
+from reviewboard.scmtools.git import GitDiffParser
+from reviewboard.scmtools.hg import HgDiffParser
+from reviewboard.scmtools.models import Repository, Tool, _scmtool_cache
 
 
 class MyersDifferTest(TestCase):
@@ -34,12 +65,125 @@ class MyersDifferTest(TestCase):
                           ("insert",  5, 5, 5, 9),
                           ("equal",   5, 8, 9, 12)])
 
+        # Shifting chunks looks up lines outside the bounds of the other
+        # file, which must be treated as unmodified.
+        self.__test_diff(["1", "1"],
+                         ["1", "2"],
+                         [("equal",   0, 1, 0, 1),
+                          ("replace", 1, 2, 1, 2)])
+
+    def testDiffCostLimit(self):
+        """Testing myers differ with a cost limit"""
+        a, b = self.__get_random_lines()
+
+        differ = diffutils.MyersDiffer(a, b)
+        list(differ.get_opcodes())
+        self.assertFalse(differ.approximate)
+
+        differ = diffutils.MyersDiffer(a, b, max_cost=2)
+        self.__test_valid_opcodes(a, b, list(differ.get_opcodes()))
+        self.assertTrue(differ.approximate)
+
+    def testDiffTimeLimit(self):
+        """Testing myers differ with a time limit"""
+        a, b = self.__get_random_lines()
+
+        differ = diffutils.MyersDiffer(a, b, max_time=1e-9)
+        self.__test_valid_opcodes(a, b, list(differ.get_opcodes()))
+        self.assertTrue(differ.approximate)
+
+    def __get_random_lines(self):
+        r = random.Random(0)
+
+        return ([str(r.randint(0, 9)) for i in range(200)],
+                [str(r.randint(0, 9)) for i in range(200)])
+
+    def __test_valid_opcodes(self, a, b, opcodes):
+        i = j = 0
+
+        for tag, i1, i2, j1, j2 in opcodes:
+            self.assertEqual((i1, j1), (i, j))
+
+            if tag == 'equal':
+                self.assertEqual(a[i1:i2], b[j1:j2])
+
+            i, j = i2, j2
+
+        self.assertEqual((i, j), (len(a), len(b)))
 
     def __test_diff(self, a, b, expected):
         opcodes = list(diffutils.MyersDiffer(a, b).get_opcodes())
         self.assertEquals(opcodes, expected)
 
 
+class HistogramDifferTest(TestCase):
+    def testDiff(self):
+        """Testing histogram differ"""
+        self.__test_diff(["1", "2", "3"],
+                         ["1", "2", "3"],
+                         [("equal", 0, 3, 0, 3),])
+
+        self.__test_diff(["1", "2", "3"],
+                         [],
+                         [("delete", 0, 3, 0, 0),])
+
+        self.__test_diff("1\n2\n3\n7\n",
+                         "1\n2\n4\n5\n6\n7\n",
+                         [("equal",   0, 4, 0, 4),
+                          ("replace", 4, 5, 4, 5),
+                          ("insert",  5, 5, 5, 9),
+                          ("equal",   5, 8, 9, 12)])
+
+        # Where a minimal diff would split the insert up, the histogram
+        # diff keeps it together.
+        self.__test_diff(["bar();", "baz();", "{"],
+                         ["", "foo();", "{", "{", "}", "baz();"],
+                         [("replace", 0, 2, 0, 2),
+                          ("equal",   2, 3, 2, 3),
+                          ("insert",  3, 3, 3, 6)])
+
+    def testCommonLines(self):
+        """Testing histogram differ with lines too common to split on"""
+        self.__test_diff(["x"] * 100 + ["y"],
+                         ["x"] * 99 + ["z"],
+                         [("equal",   0, 99, 0, 99),
+                          ("replace", 99, 100, 99, 100),
+                          ("delete",  100, 101, 100, 100)])
+
+    def testIgnoreSpace(self):
+        """Testing histogram differ with ignore_space"""
+        differ = diffutils.Differ(["  a", "b"], ["a", "  b"],
+                                  ignore_space=True, compat_version=2)
+        self.assertTrue(isinstance(differ, diffutils.HistogramDiffer))
+        self.assertEqual(list(differ.get_opcodes()),
+                         [("equal", 0, 2, 0, 2)])
+
+    def testInterestingLines(self):
+        """Testing histogram differ's interesting lines"""
+        prefix = os.path.join(os.path.dirname(__file__), 'testdata')
+        f = open(os.path.join(prefix, "orig_src", "helloworld.py"), "r")
+        a = f.readlines()
+        f.close()
+
+        f = open(os.path.join(prefix, "new_src", "helloworld.py"), "r")
+        b = f.readlines()
+        f.close()
+
+        differ = diffutils.Differ(a, b, compat_version=2)
+        diffutils.register_interesting_lines_for_filename(differ,
+                                                          "helloworld.py")
+        list(differ.get_opcodes())
+
+        lines = differ.get_interesting_lines('header', False)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], (0, 'class HelloWorld:\n'))
+        self.assertEqual(lines[1], (1, '    def main(self):\n'))
+
+    def __test_diff(self, a, b, expected):
+        opcodes = list(diffutils.HistogramDiffer(a, b).get_opcodes())
+        self.assertEquals(opcodes, expected)
+
+
 class InterestingLinesTest(TestCase):
     PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
 
@@ -208,6 +352,57 @@ class DiffParserTest(unittest.TestCase):
         files = diffparser.DiffParser(data).parse()
         self.compareDiffs(files, "context")
 
+    def testDiffLines(self):
+        """Testing splitting a diff into lines"""
+        tests = ['', '\n', 'a', 'a\nb', 'a\n\n', 'a\r\nb\r\n',
+                 'a\rb\r\r\nc', 'abcdefgh\r\nij\n\rk']
+        old_block_size = diffparser.DiffLines.BLOCK_SIZE
+
+        try:
+            # Use tiny blocks, so lines and line endings are split across
+            # them.
+            for block_size in (old_block_size, 1, 2, 3):
+                diffparser.DiffLines.BLOCK_SIZE = block_size
+
+                for data in tests:
+                    lines = diffparser.DiffLines(data)
+                    self.assertEqual(len(lines), len(data.splitlines()))
+                    self.assertEqual(list(lines), data.splitlines())
+                    self.assertEqual(lines.get_data(0, len(lines)),
+                                     ''.join(['%s\n' % line
+                                              for line in lines]))
+        finally:
+            diffparser.DiffLines.BLOCK_SIZE = old_block_size
+
+        lines = diffparser.DiffLines('a\r\nb\rc\nd')
+        self.assertEqual(lines[-1], 'd')
+        self.assertEqual(lines.get_data(1, 3), 'b\nc\n')
+        self.assertEqual(lines.get_data(3, 10), 'd\n')
+        self.assertEqual(lines.get_data(2, 2), '')
+        self.assertRaises(IndexError, lambda: lines[4])
+
+    def testParseFile(self):
+        """Testing parse on a diff in a file"""
+        data = self.diff('-u')
+        expected = [file.data for file in diffparser.DiffParser(data).parse()]
+
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.seek(0)
+        parser = diffparser.DiffParser(f)
+        files = parser.parse()
+        parser.close()
+        f.close()
+        self.assertEqual([file.data for file in files], expected)
+        self.assertRaises(ValueError, lambda: parser.data[0])
+
+        files = diffparser.DiffParser(StringIO(data)).parse()
+        self.assertEqual([file.data for file in files], expected)
+
+        f = tempfile.TemporaryFile()
+        self.assertEqual(diffparser.DiffParser(f).parse(), [])
+        f.close()
+
     def testPatch(self):
         """Testing patching"""
 
@@ -223,6 +418,28 @@ class DiffParserTest(unittest.TestCase):
         diff = self._get_file('diffs', 'unified', 'README.diff')
         self.assertRaises(Exception, lambda: diffutils.patch(diff, old, file))
 
+    def testPatchCache(self):
+        """Testing patching reuses cached results"""
+        file = 'foo.c'
+
+        old = self._get_file('orig_src', file)
+        new = self._get_file('new_src', file)
+        diff = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_patch_cache_size', 1)
+        siteconfig.set('diffviewer_patch_cache_shared', False)
+
+        diffutils._patched_file_cache.clear()
+        self.assertEqual(diffutils.patch(diff, old, file), new)
+
+        key = diffutils.get_patched_file_cache_key(diff, old)
+        self.assertTrue(key in diffutils._patched_file_cache)
+
+        diffutils._patched_file_cache.set(key, 'cached')
+        self.assertEqual(diffutils.patch(diff, old, file), 'cached')
+        diffutils._patched_file_cache.clear()
+
     def testEmptyPatch(self):
         """Testing patching with an empty diff"""
         old = 'This is a test'
@@ -296,6 +513,31 @@ class DiffParserTest(unittest.TestCase):
         regions = diffutils.get_line_changed_regions(old, new)
         deepEqual(regions, (None, None))
 
+        # Changes are made up of whole words.
+        old = 'help="locale to be used from month names"'
+        new = 'help="locale to use for month names"'
+        regions = diffutils.get_line_changed_regions(old, new)
+        deepEqual(regions, ([(16, 28)], [(16, 23)]))
+
+        # Multi-byte characters are never split up.
+        old = 'name = "caf\xc3\xa9 cr\xc3\xa8me"'
+        new = 'name = "caf\xc3\xa8 cr\xc3\xa8me"'
+        regions = diffutils.get_line_changed_regions(old, new)
+        deepEqual(regions, ([(8, 13)], [(8, 13)]))
+
+    def testInterlineChunk(self):
+        """Testing inter-line diffs for a chunk of lines"""
+        old = ['x = foo(a)', 'x = foo(a)', 'abc', '', 'same']
+        new = ['x = foo(b)', 'x = foo(b)', 'xyz', 'added', 'same']
+        regions = diffutils.get_lines_changed_regions(old, new)
+        self.assertEqual(regions, [
+            ([(8, 9)], [(8, 9)]),
+            ([(8, 9)], [(8, 9)]),
+            (None, None),
+            ([], []),
+            ([], []),
+        ])
+
     def testMoveDetection(self):
         """Testing move detection"""
         # movetest1 has two blocks of code that would appear to be moves:
@@ -337,6 +579,23 @@ class DiffParserTest(unittest.TestCase):
             self.assertEqual(i_moves[0][j], i)
             self.assertEqual(r_moves[0][i], j)
 
+    def testMoveDetectionRepeatedLines(self):
+        """Testing move detection with repeated lines"""
+        body = ['line_%d();' % i for i in range(8)]
+        block = ['    call_a();', '    }', '}',
+                 '    call_b();', '    }', '}']
+        differ = diffutils.Differ(body + block, block + body)
+        opcodes = diffutils.opcodes_with_metadata(differ)
+
+        self.assertEqual([opcode[:5] for opcode in opcodes],
+                         [('insert', 0, 0, 0, 6),
+                          ('equal', 0, 8, 6, 14),
+                          ('delete', 8, 14, 14, 14)])
+        self.assertEqual(opcodes[0][-1]['moved'],
+                         dict(zip(range(1, 7), range(9, 15))))
+        self.assertEqual(opcodes[2][-1]['moved'],
+                         dict(zip(range(9, 15), range(1, 7))))
+        self.assertFalse('moved' in opcodes[1][-1])
 
     def _get_file(self, *relative):
         f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
@@ -345,6 +604,368 @@ class DiffParserTest(unittest.TestCase):
         return data
 
 
+class SizedLRUCacheTest(unittest.TestCase):
+    """Unit tests for SizedLRUCache."""
+    def testEviction(self):
+        """Testing SizedLRUCache evicts the least recently used items"""
+        cache = SizedLRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+
+        cache.set('c', 'cccc')
+        self.assertEqual(cache.size, 8)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+    def testReplace(self):
+        """Testing SizedLRUCache replacing a value"""
+        cache = SizedLRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('a', 'aa')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 2)
+        self.assertEqual(cache.get('a'), 'aa')
+
+    def testTooLarge(self):
+        """Testing SizedLRUCache with a value larger than the cache"""
+        cache = SizedLRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'b' * 11)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.misses, 1)
+
+    def testSetMaxSize(self):
+        """Testing SizedLRUCache.set_max_size"""
+        cache = SizedLRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.set_max_size(5)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue('b' in cache)
+
+
+class FileCacheTest(TestCase):
+    """Unit tests for FileCache."""
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='reviewboard-filecache.')
+
+        # Counts left over from other tests are flushed before clearing
+        # the cache, so they don't show up in these tests' statistics.
+        filecache._flush_stats()
+        cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testGetSet(self):
+        """Testing FileCache storing and fetching files"""
+        file_cache = FileCache(self.path, 1024)
+        self.assertEqual(file_cache.get('a'), None)
+
+        file_cache.set('a', 'aaaa\n')
+        file_cache.set('b', '')
+        self.assertEqual(file_cache.get('a'), 'aaaa\n')
+        self.assertEqual(file_cache.get('b'), '')
+        self.assertEqual(FileCache(self.path, 1024).get('a'), 'aaaa\n')
+        self.assertEqual(file_cache.get_usage()[0], 2)
+
+    def testUnicodeKey(self):
+        """Testing FileCache with non-ASCII keys"""
+        file_cache = FileCache(self.path, 1024)
+        key = u'/svn/r\u00e9po:foo.c:1'
+        self.assertFalse(file_cache.has_key(key))
+
+        file_cache.set(key, 'aaaa\n')
+        self.assertTrue(file_cache.has_key(key))
+        self.assertEqual(file_cache.get(key), 'aaaa\n')
+
+    def testCorruptFile(self):
+        """Testing FileCache with a file that doesn't match its checksum"""
+        file_cache = FileCache(self.path, 1024)
+        file_cache.set('a', 'aaaa')
+
+        filename = file_cache._get_filename('a')
+        f = open(filename, 'r+b')
+        f.seek(-1, 2)
+        f.write('b')
+        f.close()
+
+        self.assertEqual(file_cache.get('a'), None)
+        self.assertFalse(os.path.exists(filename))
+
+    def testEviction(self):
+        """Testing FileCache evicts the least recently used files"""
+        # Each file takes up 41 bytes for the checksum, plus its contents.
+        file_cache = FileCache(self.path, 150)
+        file_cache.set('a', 'a' * 9)
+        file_cache.set('b', 'b' * 9)
+        file_cache.set('c', 'c' * 9)
+
+        now = os.path.getmtime(file_cache._get_filename('a'))
+        os.utime(file_cache._get_filename('a'), (now - 20, now - 20))
+        os.utime(file_cache._get_filename('b'), (now - 30, now - 30))
+        os.utime(file_cache._get_filename('c'), (now - 10, now - 10))
+
+        # Reading a file marks it as recently used.
+        self.assertEqual(file_cache.get('b'), 'b' * 9)
+
+        file_cache.set('d', 'd' * 9)
+        self.assertEqual(file_cache.get_usage(), (2, 100))
+        self.assertEqual(file_cache.get('a'), None)
+        self.assertEqual(file_cache.get('b'), 'b' * 9)
+        self.assertEqual(file_cache.get('c'), None)
+        self.assertEqual(file_cache.get('d'), 'd' * 9)
+
+        # Files larger than the cache are never stored.
+        file_cache.set('e', 'e' * 200)
+        self.assertEqual(file_cache.get('e'), None)
+
+    def testStats(self):
+        """Testing get_file_cache_stats"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_file_cache_dir', '')
+        siteconfig.set('diffviewer_file_cache_size', 1)
+        self.assertEqual(get_file_cache(), None)
+        self.assertEqual(get_file_cache_stats(), None)
+
+        siteconfig.set('diffviewer_file_cache_dir', self.path)
+        file_cache = get_file_cache()
+        self.assertEqual(file_cache.max_size, 1024 * 1024)
+
+        file_cache.set('a', 'aaaa')
+        file_cache.get('a')
+        file_cache.get('a')
+        file_cache.get('b')
+
+        # Counts are kept in memory until there are enough to send to the
+        # cache server, or the statistics are read.
+        self.assertEqual(cache.get(filecache._get_stat_key('hits')), None)
+
+        stats = get_file_cache_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['writes'], 1)
+        self.assertEqual(stats['hit_rate'], 66)
+        self.assertEqual(stats['num_files'], 1)
+        self.assertEqual(stats['size'], 45)
+
+        siteconfig.set('diffviewer_file_cache_dir', '')
+
+
+class FetchFileOnceTest(unittest.TestCase):
+    """Unit tests for coalescing fetches of original files."""
+    def setUp(self):
+        cache.clear()
+
+    def testConcurrentFetches(self):
+        """Testing concurrent fetches of a file share one fetch"""
+        calls = []
+        started = threading.Event()
+        finish = threading.Event()
+        results = []
+
+        def fetch():
+            calls.append(True)
+            started.set()
+            finish.wait()
+            return 'data'
+
+        def run():
+            results.append(diffutils._fetch_file_once('key', fetch,
+                                                      'file', '1'))
+
+        leader = threading.Thread(target=run)
+        leader.start()
+        started.wait()
+
+        # The followers wait on the leader's event. It's wrapped so that
+        # the leader is only allowed to finish once they all are waiting.
+        waiting = []
+        all_waiting = threading.Event()
+        pending = diffutils._file_fetches['key']
+
+        class FollowedEvent(object):
+            def __init__(self, event):
+                self.event = event
+
+            def wait(self):
+                waiting.append(True)
+
+                if len(waiting) == 3:
+                    all_waiting.set()
+
+                self.event.wait()
+
+            def set(self):
+                self.event.set()
+
+        pending['event'] = FollowedEvent(pending['event'])
+
+        followers = [threading.Thread(target=run) for i in range(3)]
+
+        for t in followers:
+            t.start()
+
+        all_waiting.wait()
+        finish.set()
+
+        for t in [leader] + followers:
+            t.join()
+
+        self.assertEqual(calls, [True])
+        self.assertEqual(results, ['data'] * 4)
+
+    def testFileNotFound(self):
+        """Testing missing files are remembered"""
+        calls = []
+
+        def fetch():
+            calls.append(True)
+            raise FileNotFoundError('file', '1')
+
+        for i in range(2):
+            self.assertRaises(FileNotFoundError,
+                              lambda: diffutils._fetch_file_once('key', fetch,
+                                                                 'file', '1'))
+
+        self.assertEqual(calls, [True])
+
+    def testOtherProcessFetching(self):
+        """Testing waiting for another process fetching a file"""
+        lock_key = diffutils.make_cache_key('key:fetch-lock')
+        cache.add(lock_key, True)
+        released = []
+
+        def release_lock():
+            released.append(True)
+            cache.delete(lock_key)
+
+        def fetch():
+            self.assertEqual(released, [True])
+            return 'data'
+
+        t = threading.Timer(0.2, release_lock)
+        t.start()
+
+        try:
+            self.assertEqual(
+                diffutils._fetch_file_once('key', fetch, 'file', '1'),
+                'data')
+        finally:
+            t.join()
+
+
+class PatcherTest(unittest.TestCase):
+    """Unit tests for the in-process patcher."""
+    PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
+
+    OLD = "".join(["line %d\n" % i for i in range(1, 21)])
+
+    DIFF = (
+        "--- test.c\n"
+        "+++ test.c\n"
+        "@@ -2,3 +2,3 @@\n"
+        " line 2\n"
+        "-line 3\n"
+        "+line three\n"
+        " line 4\n"
+        "@@ -16,3 +16,4 @@\n"
+        " line 16\n"
+        " line 17\n"
+        "+line 17.5\n"
+        " line 18\n"
+    )
+
+    def testApply(self):
+        """Testing in-process patching"""
+        self.assertEqual(patcher.apply_patch(self.DIFF, self.OLD),
+                         self.OLD.replace("line 3\n", "line three\n")
+                                 .replace("line 18\n",
+                                          "line 17.5\nline 18\n"))
+
+    def testApplyWithOffset(self):
+        """Testing in-process patching with hunks at an offset"""
+        old = "new 1\nnew 2\n" + self.OLD
+        patched = patcher.apply_patch(self.DIFF, old)
+        self.assertEqual(patched,
+                         "new 1\nnew 2\n" +
+                         patcher.apply_patch(self.DIFF, self.OLD))
+
+    def testApplyWithFuzz(self):
+        """Testing in-process patching with mismatched context (fuzz)"""
+        old = self.OLD.replace("line 16\n", "line sixteen\n")
+        patched = patcher.apply_patch(self.DIFF, old)
+        self.assertTrue("line sixteen\nline 17\nline 17.5\n" in patched)
+
+    def testFailedHunk(self):
+        """Testing in-process patching reports the hunk that failed"""
+        old = self.OLD.replace("line 17\n", "line seventeen\n")
+
+        try:
+            patcher.apply_patch(self.DIFF, old, max_fuzz=0)
+            self.fail("PatchError was not raised")
+        except patcher.PatchError, e:
+            self.assertEqual(e.hunk_num, 2)
+            self.assertEqual(e.hunk_header, "@@ -16,3 +16,4 @@")
+            self.assertTrue("Hunk #2" in str(e))
+
+    def testNoNewline(self):
+        """Testing in-process patching with no newline at end of file"""
+        diff = (
+            "--- test.c\n"
+            "+++ test.c\n"
+            "@@ -1,2 +1,2 @@\n"
+            " a\n"
+            "-b\n"
+            "+c\n"
+            "\\ No newline at end of file\n"
+        )
+        self.assertEqual(patcher.apply_patch(diff, "a\nb\n"), "a\nc")
+
+    def testContextDiffFallback(self):
+        """Testing patching a context diff falls back on patch"""
+        diff = self._get_file('diffs', 'context', 'foo.c.diff')
+        self.assertRaises(patcher.PatchError,
+                          lambda: patcher.apply_patch(diff, ''))
+
+        old = self._get_file('orig_src', 'foo.c')
+        new = self._get_file('new_src', 'foo.c')
+        self.assertEqual(diffutils.patch(diff, old, 'foo.c'), new)
+
+    def _get_file(self, *relative):
+        f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
+        data = f.read()
+        f.close()
+        return data
+
+
+class ApplyPygmentsTest(TestCase):
+    def testLexerForFilename(self):
+        """Testing looking up Pygments lexers by filename"""
+        lexer_cls = diffutils.get_lexer_class_for_filename('/src/foo.py')
+        self.assertEqual(lexer_cls.__name__, 'PythonLexer')
+        self.assertEqual(diffutils.get_lexer_class_for_filename('bar.py'),
+                         lexer_cls)
+        self.assertEqual(diffutils.get_lexer_class_for_filename('foo.xyzzy'),
+                         None)
+
+    def testApplyPygments(self):
+        """Testing highlighting files with Pygments"""
+        data = 'def foo():\n    pass\n'
+
+        lines = diffutils.apply_pygments(data, 'foo.py')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue('<span' in lines[0])
+
+        # The same content in another file comes from the cache.
+        self.assertEqual(diffutils.apply_pygments(data, 'src/bar.py'), lines)
+        self.assertEqual(diffutils.apply_pygments(data, 'foo.xyzzy'), None)
+
+
 class HighlightRegionTest(TestCase):
     def setUp(self):
         siteconfig = SiteConfiguration.objects.get_current()
@@ -427,3 +1048,493 @@ class DbTests(TestCase):
 
         filediff = FileDiff.objects.get(pk=filediff.id)
         self.assertEquals(filediff.source_file, long_filename)
+
+    def testDiffDeduplication(self):
+        """Testing FileDiffs with the same diff share their data"""
+        diffset = self._create_diffset()
+        diff = '--- foo\n+++ foo\n@@ -1 +1 @@\n-a\n+b\n'
+
+        filediff1 = FileDiff(source_file='foo', dest_file='foo',
+                             diffset=diffset, diff=diff)
+        filediff1.save()
+        filediff2 = FileDiff(source_file='foo', dest_file='foo',
+                             diffset=diffset, diff=diff, parent_diff=diff)
+        filediff2.save()
+
+        self.assertEqual(FileDiffData.objects.count(), 1)
+        self.assertEqual(filediff1.diff_hash_id, filediff2.diff_hash_id)
+        self.assertEqual(filediff2.parent_diff_hash_id,
+                         filediff2.diff_hash_id)
+
+        filediff = FileDiff.objects.get(pk=filediff2.pk)
+        self.assertEqual(filediff.diff64, '')
+        self.assertEqual(filediff.diff, diff)
+        self.assertEqual(filediff.parent_diff, diff)
+
+    def testDiffDataCreateRace(self):
+        """Testing FileDiffs storing a diff another upload just stored"""
+        diff = '--- foo\n+++ foo\n@@ -1 +1 @@\n-a\n+b\n'
+        manager = FileDiffData.objects
+
+        def get_or_create(binary_hash, defaults):
+            # Store the diff the way a concurrent upload would, and fail
+            # the way the database would.
+            FileDiffData(binary_hash=binary_hash, **defaults).save()
+            raise IntegrityError('duplicate key')
+
+        manager.get_or_create = get_or_create
+
+        try:
+            filediff = FileDiff(source_file='foo', dest_file='foo',
+                                diffset=self._create_diffset(), diff=diff)
+            filediff.save()
+        finally:
+            del manager.get_or_create
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(FileDiffData.objects.count(), 1)
+        self.assertEqual(filediff.diff, diff)
+
+    def testCondenseDiffs(self):
+        """Testing the condensediffs command with legacy FileDiffs"""
+        diffset = self._create_diffset()
+        diff = '--- foo\n+++ foo\n@@ -1 +1 @@\n-a\n+b\n'
+
+        filediff = FileDiff(source_file='foo', dest_file='foo',
+                            diffset=diffset)
+        filediff.save()
+
+        # Store the diff the way older releases did.
+        FileDiff.objects.filter(pk=filediff.pk).update(
+            diff64=Base64DecodedValue(diff))
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.diff_hash, None)
+        self.assertEqual(filediff.diff, diff)
+
+        call_command('condensediffs', batch_size=1)
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertNotEqual(filediff.diff_hash, None)
+        self.assertEqual(filediff.diff64, '')
+        self.assertEqual(filediff.diff, diff)
+
+    def testChunksCacheKey(self):
+        """Testing get_chunks_cache_key with unchanged files"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        siteconfig.set('diffviewer_include_space_patterns', [])
+        diff = '--- foo\n+++ foo\n@@ -1 +1 @@\n-a\n+b\n'
+
+        filediffs = []
+
+        for diffset in (self._create_diffset(), self._create_diffset()):
+            filediff = FileDiff(source_file='foo', dest_file='foo',
+                                source_revision='1', diffset=diffset,
+                                diff=diff)
+            filediff.save()
+            filediffs.append(filediff)
+
+        key = diffutils.get_chunks_cache_key(filediffs[0], None, False, True)
+        self.assertEqual(
+            key,
+            diffutils.get_chunks_cache_key(filediffs[1], None, False, True))
+        self.assertNotEqual(
+            key,
+            diffutils.get_chunks_cache_key(filediffs[1], None, False, False))
+        self.assertNotEqual(
+            key,
+            diffutils.get_chunks_cache_key(filediffs[0], filediffs[1],
+                                           True, True))
+
+        siteconfig.set('diffviewer_context_num_lines', 10)
+        self.assertNotEqual(
+            key,
+            diffutils.get_chunks_cache_key(filediffs[0], None, False, True))
+
+        filediffs[1].diff = diff + ' c\n'
+        filediffs[1].save()
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        self.assertNotEqual(
+            key,
+            diffutils.get_chunks_cache_key(filediffs[1], None, False, True))
+
+    def testChunksCacheKeyQueries(self):
+        """Testing get_chunks_cache_key doesn't load FileDiffData"""
+        diff = '--- foo\n+++ foo\n@@ -1 +1 @@\n-a\n+b\n'
+        filediff = FileDiff(source_file='foo', dest_file='foo',
+                            source_revision='1',
+                            diffset=self._create_diffset(),
+                            diff=diff, parent_diff=diff)
+        filediff.save()
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertNotEqual(filediff.diff_hash_id, None)
+        self.assertNotEqual(filediff.parent_diff_hash_id, None)
+
+        # These would be loaded by any diff view.
+        filediff.diffset.repository
+        SiteConfiguration.objects.get_current()
+
+        self.assertNumQueries(
+            0,
+            lambda: diffutils.get_chunks_cache_key(filediff, None, False,
+                                                   True))
+
+    def testParallelChunks(self):
+        """Testing get_diff_files generating chunks in parallel"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_syntax_highlighting', False)
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        siteconfig.set('diffviewer_include_space_patterns', [])
+
+        diffset = self._create_diffset()
+
+        for name in ('b.c', 'a.h', 'a.c', 'dir/z.py'):
+            lines = ['+%s %d\n' % (name, i) for i in range(20)]
+            filediff = FileDiff(source_file=name, dest_file=name,
+                                source_revision=PRE_CREATION,
+                                diffset=diffset,
+                                diff='--- %s\n+++ %s\n@@ -0,0 +1,20 @@\n%s' %
+                                     (name, name, ''.join(lines)))
+            filediff.save()
+
+        results = []
+
+        for max_files in (1, 4):
+            siteconfig.set('diffviewer_max_parallel_files', max_files)
+            cache.clear()
+            results.append([
+                (file['depot_filename'], file['index'], file['num_changes'],
+                 [chunk['lines'] for chunk in file['chunks']])
+                for file in diffutils.get_diff_files(diffset, None, None,
+                                                     False, True)
+            ])
+
+        self.assertEqual([result[0] for result in results[1]],
+                         ['a.h', 'a.c', 'b.c', 'dir/z.py'])
+        self.assertEqual(results[0], results[1])
+
+    def testUploadHgDiff(self):
+        """Testing UploadDiffForm with Mercurial and Git-style diffs"""
+        repository = Repository.objects.create(
+            name='Hg web repo',
+            path='http://hg.example.com/repo',
+            tool=Tool.objects.get(name='Mercurial'))
+        diffs = [
+            (HgDiffParser,
+             'diff -r bf544ea505f8 readme\n'
+             '--- /dev/null\n'
+             '+++ b/readme\n'
+             '@@ -0,0 +1 @@\n'
+             '+Hello\n'),
+            (GitDiffParser,
+             '\ndiff --git a/readme b/readme\n'
+             'new file mode 100644\n'
+             'index 0000000..e965047\n'
+             '--- /dev/null\n'
+             '+++ b/readme\n'
+             '@@ -0,0 +1 @@\n'
+             '+Hello\n'),
+        ]
+
+        try:
+            tool = repository.get_scmtool()
+            form = UploadDiffForm(repository)
+
+            for parser_cls, diff in diffs:
+                parser = tool.get_parser(SimpleUploadedFile('diff', diff))
+                self.assertEqual(parser.__class__, parser_cls)
+
+                diffset = form.create(SimpleUploadedFile('diff', diff))
+                files = list(diffset.files.all())
+                self.assertEqual(len(files), 1)
+                self.assertEqual(files[0].source_file, 'readme')
+                self.assertEqual(files[0].source_revision, PRE_CREATION)
+        finally:
+            _scmtool_cache.clear()
+
+    def testUploadDiffCompatVersion(self):
+        """Testing UploadDiffForm using the site's diff compat version"""
+        if not is_exe_in_path('git'):
+            raise nose.SkipTest('git binary not found')
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_diff_compat_version', 2)
+        siteconfig.set('diffviewer_syntax_highlighting', False)
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        siteconfig.set('diffviewer_include_space_patterns', [])
+
+        repository = Repository.objects.create(
+            name='Git test repo',
+            path=os.path.join(os.path.dirname(scmtools.__file__),
+                              'testdata', 'git_repo'),
+            tool=Tool.objects.get(name='Git'))
+        diff = ('diff --git a/new b/new\n'
+                'new file mode 100644\n'
+                'index 0000000..257cc56\n'
+                '--- /dev/null\n'
+                '+++ b/new\n'
+                '@@ -0,0 +1 @@\n'
+                '+foo\n')
+        compat_versions = []
+        old_differ = diffutils.Differ
+
+        def Differ(*args, **kwargs):
+            compat_versions.append(kwargs['compat_version'])
+            return old_differ(*args, **kwargs)
+
+        try:
+            form = UploadDiffForm(repository)
+            diffset = form.create(SimpleUploadedFile('diff', diff))
+            self.assertEqual(diffset.diffcompat, 2)
+
+            cache.clear()
+            diffutils.Differ = Differ
+            files = diffutils.get_diff_files(diffset, None, None, False, True)
+        finally:
+            diffutils.Differ = old_differ
+            siteconfig.set('diffviewer_diff_compat_version', 1)
+            _scmtool_cache.clear()
+
+        self.assertEqual(len(files), 1)
+        self.assertEqual(compat_versions, [2])
+
+    def testPrefetchOriginalFiles(self):
+        """Testing prefetch_original_files"""
+        repository, filediffs = self._create_git_filediffs()
+
+        cache.clear()
+        diffutils.prefetch_original_files(filediffs)
+        self._assertOriginalFilesCached(repository, filediffs)
+
+    def testPrefetchOriginalFilesBatch(self):
+        """Testing prefetch_original_files with a tool that fetches files
+        in batches"""
+        repository, filediffs = self._create_git_filediffs()
+        tool = repository.get_scmtool()
+        tool_cls = tool.__class__
+        batches = []
+
+        def get_files(paths_and_revisions):
+            batches.append(paths_and_revisions)
+            return ['Hello there\r\n'] * len(paths_and_revisions)
+
+        cache.clear()
+        tool.get_files = get_files
+        tool_cls.supports_batch_fetches = True
+
+        try:
+            diffutils.prefetch_original_files(filediffs)
+        finally:
+            tool_cls.supports_batch_fetches = False
+
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([path for path, revision in batches[0]],
+                         ['readme', 'doc/readme'])
+        self._assertOriginalFilesCached(repository, filediffs)
+
+    def testGetDiffFilesBatch(self):
+        """Testing get_diff_files with a tool that fetches files in
+        batches"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_syntax_highlighting', False)
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        siteconfig.set('diffviewer_include_space_patterns', [])
+
+        repository, filediffs = self._create_git_filediffs()
+        tool = repository.get_scmtool()
+        tool_cls = tool.__class__
+        batches = []
+
+        def get_files(paths_and_revisions):
+            batches.append(paths_and_revisions)
+            return ['Hello there\n'] * len(paths_and_revisions)
+
+        cache.clear()
+        tool.get_files = get_files
+        tool.get_file = lambda path, revision: self.fail('File was fetched')
+        tool_cls.supports_batch_fetches = True
+
+        try:
+            files = diffutils.get_diff_files(filediffs[0].diffset, None, None,
+                                             False, True)
+        finally:
+            tool_cls.supports_batch_fetches = False
+            _scmtool_cache.clear()
+
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 2)
+        self.assertEqual([file['num_changes'] for file in files], [1, 1])
+
+    def testPrerender(self):
+        """Testing pre-rendering new diffs and interdiffs"""
+        initialize()
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_prerender_diffs', True)
+        siteconfig.set('diffviewer_prerender_in_process', False)
+        siteconfig.set('diffviewer_syntax_highlighting', False)
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        siteconfig.set('diffviewer_include_space_patterns', [])
+
+        history = DiffSetHistory.objects.create(name='test')
+        diffsets = []
+
+        for i in range(2):
+            diffset = self._create_diffset(history)
+            filediff = FileDiff(source_file='foo', dest_file='foo',
+                                source_revision=PRE_CREATION,
+                                diffset=diffset,
+                                diff='--- foo\n+++ foo\n@@ -0,0 +1 @@\n'
+                                     '+%s\n' % i)
+            filediff.save()
+            diffsets.append(diffset)
+
+        queue_prerender(diffsets[0], history)
+        queue_prerender(diffsets[1], history)
+        queue_prerender(diffsets[1], history)
+
+        jobs = PrerenderJob.objects.all()
+        self.assertEqual(
+            [(job.diffset, job.interdiffset, job.status) for job in jobs],
+            [(diffsets[0], None, PrerenderJob.PENDING),
+             (diffsets[1], None, PrerenderJob.PENDING),
+             (diffsets[0], diffsets[1], PrerenderJob.PENDING)])
+
+        self.assertEqual(process_prerender_jobs(), 3)
+
+        for job in PrerenderJob.objects.all():
+            self.assertEqual(job.status, PrerenderJob.DONE)
+            self.assertEqual(job.error, '')
+            self.assertEqual(job.num_files, 1)
+            self.assertNotEqual(job.duration, None)
+
+        self.assertEqual(process_prerender_jobs(), 0)
+
+        # Diffs that were already pre-rendered aren't queued again, but
+        # ones that failed are.
+        PrerenderJob.objects.filter(interdiffset__isnull=False).update(
+            status=PrerenderJob.FAILED)
+        queue_prerender(diffsets[1], history)
+
+        jobs = PrerenderJob.objects.filter(status=PrerenderJob.PENDING)
+        self.assertEqual(
+            [(job.diffset, job.interdiffset) for job in jobs],
+            [(diffsets[0], diffsets[1])])
+
+    def testPrerenderStalledJobs(self):
+        """Testing requeuing pre-render jobs left running by a dead worker"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_syntax_highlighting', False)
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        siteconfig.set('diffviewer_include_space_patterns', [])
+
+        diffset = self._create_diffset()
+        FileDiff(source_file='foo', dest_file='foo',
+                 source_revision=PRE_CREATION, diffset=diffset,
+                 diff='--- foo\n+++ foo\n@@ -0,0 +1 @@\n+a\n').save()
+
+        now = datetime.now()
+        stalled = PrerenderJob.objects.create(
+            diffset=diffset, status=PrerenderJob.RUNNING,
+            time_started=now - RUNNING_JOB_TIMEOUT - timedelta(minutes=1))
+        running = PrerenderJob.objects.create(
+            diffset=diffset, status=PrerenderJob.RUNNING, time_started=now)
+
+        stats = get_prerender_stats()
+        self.assertEqual(stats['running'], 2)
+        self.assertEqual(stats['stalled'], 1)
+
+        self.assertEqual(process_prerender_jobs(), 1)
+        self.assertEqual(PrerenderJob.objects.get(pk=stalled.pk).status,
+                         PrerenderJob.DONE)
+        self.assertEqual(PrerenderJob.objects.get(pk=running.pk).status,
+                         PrerenderJob.RUNNING)
+
+        stats = get_prerender_stats()
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['stalled'], 0)
+
+    def testPrerenderPurgeFinishedJobs(self):
+        """Testing purging old finished and failed pre-render jobs"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_syntax_highlighting', False)
+        siteconfig.set('diffviewer_context_num_lines', 5)
+        siteconfig.set('diffviewer_include_space_patterns', [])
+
+        diffset = self._create_diffset()
+        FileDiff(source_file='foo', dest_file='foo',
+                 source_revision=PRE_CREATION, diffset=diffset,
+                 diff='--- foo\n+++ foo\n@@ -0,0 +1 @@\n+a\n').save()
+
+        now = datetime.now()
+        old = now - FINISHED_JOB_AGE - timedelta(days=1)
+        recent = now - timedelta(days=1)
+
+        for status in (PrerenderJob.DONE, PrerenderJob.FAILED):
+            for time_finished in (old, recent):
+                PrerenderJob.objects.create(diffset=diffset, status=status,
+                                            time_finished=time_finished,
+                                            duration=1)
+
+        PrerenderJob.objects.create(diffset=diffset)
+        self.assertEqual(process_prerender_jobs(), 1)
+
+        jobs = PrerenderJob.objects.filter(time_finished__lt=recent)
+        self.assertEqual(jobs.count(), 0)
+        self.assertEqual(PrerenderJob.objects.count(), 3)
+
+    def _create_git_filediffs(self):
+        if not is_exe_in_path('git'):
+            raise nose.SkipTest('git binary not found')
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_max_parallel_files', 4)
+        siteconfig.set('diffviewer_max_repository_fetches', 4)
+        siteconfig.set('diffviewer_file_cache_dir', '')
+
+        repository = Repository.objects.create(
+            name='Git test repo',
+            path=os.path.join(os.path.dirname(scmtools.__file__),
+                              'testdata', 'git_repo'),
+            tool=Tool.objects.get(name='Git'))
+        diffset = DiffSet.objects.create(name='test', revision=1,
+                                         repository=repository)
+        filediffs = []
+
+        for name in ('readme', 'doc/readme'):
+            filediff = FileDiff(
+                source_file=name, dest_file=name,
+                source_revision='d6613f5f8b58eb6a88ee386ea140364c8645005c',
+                diffset=diffset,
+                diff='--- %s\n+++ %s\n@@ -1 +1 @@\n-Hello there\n+Bye\n' %
+                     (name, name))
+            filediff.save()
+            filediffs.append(filediff)
+
+        return repository, filediffs
+
+    def _assertOriginalFilesCached(self, repository, filediffs):
+        # The files should now come from the cache, not the repository.
+        tool = repository.get_scmtool()
+        tool.get_file = lambda path, revision: self.fail('File was fetched')
+
+        try:
+            for filediff in filediffs:
+                self.assertEqual(diffutils.get_original_file(filediff),
+                                 'Hello there\n')
+        finally:
+            _scmtool_cache.clear()
+
+    def _create_diffset(self, history=None):
+        repository = Repository.objects.get(pk=1)
+
+        if history:
+            revision = 0
+        else:
+            revision = 1
+
+        return DiffSet.objects.create(name='test', revision=revision,
+                                      history=history,
+                                      repository=repository)
@@ -53,9 +53,14 @@ def build_diff_fragment(request, file, chunkindex, highlighting, collapseall,
 
     context['file'] = file
 
+    # Fragments can be rendered without a request when pre-rendering diffs.
+    if request:
+        request_context = RequestContext(request, context)
+    else:
+        request_context = context
+
     return cache_memoize(key,
-        lambda: render_to_string(template_name,
-                                 RequestContext(request, context)))
+        lambda: render_to_string(template_name, request_context))
 
 
 def get_collapse_diff(request):
@@ -7,6 +7,7 @@ from django.utils.translation import ugettext as _
 
 from reviewboard.diffviewer import forms as diffviewer_forms
 from reviewboard.diffviewer.models import DiffSet
+from reviewboard.diffviewer.prerender import queue_prerender
 from reviewboard.reviews.errors import OwnershipError
 from reviewboard.reviews.models import DefaultReviewer, ReviewRequest, \
                                        ReviewRequestDraft, Screenshot
@@ -264,6 +265,8 @@ class UploadDiffForm(diffviewer_forms.UploadDiffForm):
 
             diffset.save()
 
+        queue_prerender(diffset, self.review_request.diffset_history)
+
         return diffset
 
 
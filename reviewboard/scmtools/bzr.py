@@ -9,6 +9,7 @@ try:
 except ImportError:
     pass
 
+from reviewboard.diffviewer.cache import SizedLRUCache
 from reviewboard.scmtools import sshutils
 from reviewboard.scmtools.core import SCMTool, PRE_CREATION
 from reviewboard.scmtools.errors import RepositoryNotFoundError, SCMError
@@ -24,10 +25,20 @@ sshutils.ssh_uri_schemes.append('bzr+ssh')
 
 class BZRTool(SCMTool):
     name = "Bazaar"
+    supports_batch_fetches = True
+
+    # bzrlib's branches and trees can't be shared between threads.
+    thread_safe = False
     dependencies = {
         'modules': ['bzrlib'],
     }
 
+    # The number of opened branches, directories looked up in them, and
+    # revision trees kept by each instance of the tool.
+    MAX_BRANCHES = 8
+    MAX_DIRS = 256
+    MAX_TREES = 16
+
     # Timestamp format in bzr diffs.
     # This isn't totally accurate: there should be a %z at the end.
     # Unfortunately, strptime() doesn't support %z.
@@ -40,31 +51,113 @@ class BZRTool(SCMTool):
     def __init__(self, repository):
         SCMTool.__init__(self, repository)
 
+        # Opening a branch and building a revision tree are much slower
+        # than reading a file from the tree, so they're kept around for the
+        # next files. Branches are keyed on their base URL, directories on
+        # their full path, and trees on the branch's base URL and revspec.
+        self._branches = SizedLRUCache(self.MAX_BRANCHES)
+        self._dirs = SizedLRUCache(self.MAX_DIRS)
+        self._trees = SizedLRUCache(self.MAX_TREES)
+
+    def close(self):
+        self._branches.clear()
+        self._dirs.clear()
+        self._trees.clear()
+
     def get_file(self, path, revision):
-        if revision == BZRTool.PRE_CREATION_TIMESTAMP:
-            return ''
+        return self.get_files([(path, revision)])[0]
 
-        revspec = self._revspec_from_revision(revision)
-        filepath = self._get_full_path(path)
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each file in a list.
+
+        Each branch is read-locked once for the whole list, and all the
+        files at one revision are read from the same revision tree.
+        """
+        files = []
+        locked = {}
 
-        branch = None
         try:
             try:
-                branch, relpath = bzrdir.BzrDir.open_containing_tree_or_branch(filepath)[1:]
-                branch.lock_read()
-                revtree = revisionspec.RevisionSpec.from_string(revspec).as_tree(branch)
-                fileid = revtree.path2id(relpath)
-                if fileid:
-                    contents = revtree.get_file_text(fileid)
-                else:
-                    contents = ""
+                for path, revision in paths_and_revisions:
+                    if revision == BZRTool.PRE_CREATION_TIMESTAMP:
+                        files.append('')
+                        continue
+
+                    branch, relpath = \
+                        self._open_branch(self._get_full_path(path))
+
+                    if id(branch) not in locked:
+                        branch.lock_read()
+                        locked[id(branch)] = branch
+
+                    revtree = self._get_revision_tree(
+                        branch, self._revspec_from_revision(revision))
+                    fileid = revtree.path2id(relpath)
+
+                    if fileid:
+                        files.append(revtree.get_file_text(fileid))
+                    else:
+                        files.append("")
             except BzrError, e:
                 raise SCMError(e)
         finally:
-            if branch:
+            for branch in locked.itervalues():
                 branch.unlock()
 
-        return contents
+        return files
+
+    def _open_branch(self, filepath):
+        """Returns the branch containing a file, and the file's path in it.
+
+        Every file in a directory is in the same branch, so the branch is
+        only looked up once for each directory.
+        """
+        dirpath, filename = filepath.rsplit('/', 1)
+        branch = None
+        entry = self._dirs.get(dirpath)
+
+        if entry:
+            base, dir_relpath = entry
+            branch = self._branches.get(base)
+
+        if branch is None:
+            new_branch, dir_relpath = \
+                bzrdir.BzrDir.open_containing_tree_or_branch(dirpath)[1:]
+
+            # Another directory in the branch may have opened it already.
+            # Keeping one object for it means it's only locked once, and
+            # its revision trees can be reused.
+            branch = self._branches.get(new_branch.base)
+
+            if branch is None:
+                branch = new_branch
+                self._branches.set(branch.base, branch, 1)
+
+            self._dirs.set(dirpath, (branch.base, dir_relpath), 1)
+
+        if dir_relpath:
+            return branch, '%s/%s' % (dir_relpath, filename)
+        else:
+            return branch, filename
+
+    def _get_revision_tree(self, branch, revspec):
+        """Returns the revision tree of a branch for a revspec.
+
+        The branch must be read-locked while the tree is used.
+        """
+        key = (branch.base, revspec)
+        entry = self._trees.get(key)
+
+        # A tree built from a branch that has since been reopened belongs
+        # to a repository object that isn't locked.
+        if entry and entry[0] is branch:
+            return entry[1]
+
+        revtree = \
+            revisionspec.RevisionSpec.from_string(revspec).as_tree(branch)
+        self._trees.set(key, (branch, revtree), 1)
+
+        return revtree
 
     def parse_diff_revision(self, file_str, revision_str):
         if revision_str == BZRTool.PRE_CREATION_TIMESTAMP:
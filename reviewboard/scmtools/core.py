@@ -1,9 +1,17 @@
 import logging
+import sys
+import threading
 import urlparse
 
+from django.core.cache import cache
+from django.db import connection
+from django.utils.http import urlquote
+from djblets.util.misc import make_cache_key
+
 import reviewboard.diffviewer.parser as diffparser
 from reviewboard.scmtools import sshutils
 from reviewboard.scmtools.errors import FileNotFoundError
+from reviewboard.scmtools.models import _scmtool_cache
 
 
 class ChangeSet:
@@ -48,6 +56,26 @@ class SCMTool(object):
     supports_authentication = False
     supports_raw_file_urls = False
 
+    # Whether files can be fetched from more than one thread at once.
+    supports_parallel_fetches = True
+
+    # Whether get_files can fetch a list of files faster than fetching
+    # them one at a time.
+    supports_batch_fetches = False
+
+    # The number of files file_exists_many checks at once, when the tool
+    # has no faster way of checking them.
+    max_file_exists_threads = 8
+
+    # Whether Repository.get_scmtool can keep instances of this tool and
+    # hand them out again, rather than creating one every time.
+    cache_instances = True
+
+    # Whether one instance of this tool can be used by several threads at
+    # once. Cached instances of tools that aren't thread-safe are kept
+    # separately for each thread.
+    thread_safe = True
+
     # A list of dependencies for this SCMTool. This should be overridden
     # by subclasses. Python module names go in dependencies['modules'] and
     # binary executables go in dependencies['executables'] (but without
@@ -60,9 +88,32 @@ class SCMTool(object):
     def __init__(self, repository):
         self.repository = repository
 
+    def close(self):
+        """Releases any connections or processes held by the tool.
+
+        This is called when a cached tool is no longer needed. The tool
+        may still be used afterward by anything that was holding on to it,
+        so it must be able to reopen whatever it closed.
+        """
+        pass
+
     def get_file(self, path, revision=None):
         raise NotImplementedError
 
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each file in a list.
+
+        paths_and_revisions is a list of (path, revision) tuples. This
+        returns a list of the contents of each file, in the same order.
+        Errors are raised just as get_file would raise them.
+
+        By default, this calls get_file for each file. Tools that can fetch
+        many files at once should override this and set
+        supports_batch_fetches.
+        """
+        return [self.get_file(path, revision)
+                for path, revision in paths_and_revisions]
+
     def file_exists(self, path, revision=HEAD):
         try:
             self.get_file(path, revision)
@@ -70,6 +121,101 @@ class SCMTool(object):
         except FileNotFoundError:
             return False
 
+    def file_exists_many(self, paths_and_revisions):
+        """Checks whether each file in a list exists.
+
+        paths_and_revisions is a list of (path, revision) tuples. This
+        returns a list of booleans, in the same order.
+
+        A file that exists at a specific revision will always be there, so
+        those results are cached. Files that were found to be missing, or
+        that were looked up at HEAD, are checked again every time.
+        """
+        paths_and_revisions = list(paths_and_revisions)
+        keys = [self._get_file_exists_cache_key(path, revision)
+                for path, revision in paths_and_revisions]
+        cached = cache.get_many([key for key in keys if key])
+        results = []
+        uncached = []
+
+        for i, key in enumerate(keys):
+            if key in cached:
+                results.append(True)
+            else:
+                results.append(False)
+                uncached.append(i)
+
+        if uncached:
+            found = self._file_exists_many([paths_and_revisions[i]
+                                            for i in uncached])
+
+            for i, exists in zip(uncached, found):
+                results[i] = exists
+
+                if exists and keys[i]:
+                    cache.set(keys[i], True)
+
+        return results
+
+    def _file_exists_many(self, paths_and_revisions):
+        """Checks whether each file in a list exists, bypassing the cache.
+
+        By default, this calls file_exists for several files at a time.
+        Each thread uses its own instance of the tool, unless the tool is
+        thread-safe. Subclasses can override this if they have a faster
+        way to check many files at once.
+        """
+        results = [False] * len(paths_and_revisions)
+
+        if self.supports_parallel_fetches:
+            max_threads = min(self.max_file_exists_threads,
+                              len(paths_and_revisions))
+        else:
+            max_threads = 1
+
+        if max_threads <= 1:
+            for i, (path, revision) in enumerate(paths_and_revisions):
+                results[i] = self.file_exists(path, revision)
+        else:
+            tools = threading.local()
+            created_tools = []
+
+            def check_file(i):
+                tool = getattr(tools, 'tool', None)
+
+                if tool is None:
+                    if self.thread_safe:
+                        tool = self
+                    else:
+                        tool = self.__class__(self.repository)
+                        created_tools.append(tool)
+
+                    tools.tool = tool
+
+                path, revision = paths_and_revisions[i]
+                results[i] = tool.file_exists(path, revision)
+
+            try:
+                run_in_threads(check_file, range(len(paths_and_revisions)),
+                               max_threads)
+            finally:
+                for tool in created_tools:
+                    tool.close()
+
+        return results
+
+    def _get_file_exists_cache_key(self, path, revision):
+        """Returns the key for caching that a file exists.
+
+        Returns None if the revision may change which files exist.
+        """
+        if revision in (HEAD, UNKNOWN, PRE_CREATION):
+            return None
+
+        return make_cache_key('file-exists:%s:%s:%s' %
+                              (urlquote(self.repository.path),
+                               urlquote(path), urlquote(revision)))
+
     def parse_diff_revision(self, file_str, revision_str):
         raise NotImplementedError
 
@@ -145,3 +291,49 @@ class SCMTool(object):
     def accept_certificate(cls, path):
         """Accepts the certificate for the given repository path."""
         raise NotImplemented
+
+
+def run_in_threads(func, items, max_threads):
+    """Calls a function with each item in a list, using a pool of threads.
+
+    This returns once every call has finished. If any of the calls raised
+    an exception, the first one is raised again here.
+    """
+    queue = list(items)
+    queue.reverse()
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                lock.acquire()
+
+                try:
+                    if not queue or errors:
+                        return
+
+                    item = queue.pop()
+                finally:
+                    lock.release()
+
+                try:
+                    func(item)
+                except Exception:
+                    lock.acquire()
+                    errors.append(sys.exc_info())
+                    lock.release()
+        finally:
+            _scmtool_cache.release_thread()
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in xrange(max_threads)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
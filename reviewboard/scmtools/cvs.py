@@ -1,5 +1,6 @@
 import os
 import re
+import shutil
 import subprocess
 import tempfile
 import urlparse
@@ -20,6 +21,8 @@ sshutils.ssh_uri_schemes.append('svn+ssh')
 class CVSTool(SCMTool):
     name = "CVS"
     supports_authentication = True
+
+    supports_batch_fetches = True
     dependencies = {
         'executables': ['cvs'],
     }
@@ -43,6 +46,17 @@ class CVSTool(SCMTool):
 
         return self.client.cat_file(path, revision)
 
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each file in a list.
+
+        Files at the same revision are checked out by a single cvs command.
+        """
+        for path, revision in paths_and_revisions:
+            if not path:
+                raise FileNotFoundError(path, revision)
+
+        return self.client.cat_files(paths_and_revisions)
+
     def parse_diff_revision(self, file_str, revision_str):
         if revision_str == "PRE-CREATION":
             return file_str, PRE_CREATION
@@ -181,9 +195,13 @@ class CVSDiffParser(DiffParser):
 
 
 class CVSClient:
+    # Which of the two paths worked for each file the last time it was
+    # fetched, keyed on the CVSROOT and the file's path outside of the
+    # Attic. The path that worked is tried first from then on.
+    _attic_files = {}
+    MAX_ATTIC_FILES = 10000
+
     def __init__(self, repository, path):
-        self.tempdir = ""
-        self.currentdir = os.getcwd()
         self.repository = repository
         self.path = path
 
@@ -192,15 +210,69 @@ class CVSClient:
             # pattern we use with all the other tools.
             raise ImportError
 
-    def cleanup(self):
-        if self.currentdir != os.getcwd():
-            # Restore current working directory
-            os.chdir(self.currentdir)
-            # Remove temporary directory
-            if self.tempdir != "":
-                os.rmdir(self.tempdir)
-
     def cat_file(self, filename, revision):
+        filename, filenameAttic = self._get_repos_filenames(filename)
+
+        if filenameAttic and \
+           self._attic_files.get((self.repository, filename)):
+            filenames = [filenameAttic, filename]
+        elif filenameAttic:
+            filenames = [filename, filenameAttic]
+        else:
+            filenames = [filename]
+
+        for i, path in enumerate(filenames):
+            try:
+                contents = self._cat_specific_file(path, revision)
+            except FileNotFoundError:
+                if i == len(filenames) - 1:
+                    raise
+
+                continue
+
+            if filenameAttic:
+                self._remember_attic(filename, path == filenameAttic)
+
+            return contents
+
+    def cat_files(self, files):
+        """Returns the contents of each file in a list.
+
+        files is a list of (filename, revision) tuples. This returns a list
+        of the contents of each file, in the same order. All the files at
+        the same revision are checked out by a single cvs command. Any that
+        can't be checked out that way, such as files in the Attic, are then
+        fetched one at a time with cat_file, which raises FileNotFoundError
+        or SCMError if they can't be fetched.
+        """
+        results = [None] * len(files)
+        revisions = {}
+
+        for i, (filename, revision) in enumerate(files):
+            revisions.setdefault(str(revision), []).append(i)
+
+        for revision, indexes in revisions.iteritems():
+            if len(indexes) < 2:
+                continue
+
+            filenames = [self._get_repos_filenames(files[i][0])[0]
+                         for i in indexes]
+            contents = self._checkout_files(filenames, revision)
+
+            for i, filename in zip(indexes, filenames):
+                results[i] = contents.get(filename)
+
+        for i, (filename, revision) in enumerate(files):
+            if results[i] is None:
+                results[i] = self.cat_file(filename, revision)
+
+        return results
+
+    def _get_repos_filenames(self, filename):
+        """Returns the path of a file in the repository and in the Attic.
+
+        The Attic path is None if the file isn't in a directory.
+        """
         # We strip the repo off of the fully qualified path as CVS does
         # not like to be given absolute paths.
         repos_path = self.path.split(":")[-1]
@@ -237,27 +309,78 @@ class CVSClient:
             # Attic path that makes any kind of sense.
             filenameAttic = None
 
+        return filename, filenameAttic
+
+    def _remember_attic(self, filename, in_attic):
+        if len(self._attic_files) >= self.MAX_ATTIC_FILES:
+            self._attic_files.clear()
+
+        self._attic_files[(self.repository, filename)] = in_attic
+
+    def _run_cvs(self, args):
+        """Runs cvs in a new temporary directory.
+
+        Somehow CVS sometimes seems to write .cvsignore files to the current
+        working directory, even when writing files to stdout, so every
+        command gets its own directory. The command is run in that
+        directory, rather than changing the directory of the whole process,
+        so that several can run at once.
+
+        Returns the temporary directory, which the caller must remove, and
+        the stdout, stderr and exit code of the command.
+        """
+        tempdir = tempfile.mkdtemp(prefix='reviewboard-cvs.')
+
         try:
-            return self._cat_specific_file(filename, revision)
-        except FileNotFoundError:
-            if filenameAttic:
-                return self._cat_specific_file(filenameAttic, revision)
-            else:
-                raise
+            p = subprocess.Popen(['cvs', '-f', '-d', self.repository] + args,
+                                 stderr=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 cwd=tempdir,
+                                 close_fds=(os.name != 'nt'))
+            contents, errmsg = p.communicate()
+        except:
+            shutil.rmtree(tempdir, True)
+            raise
+
+        return tempdir, contents, errmsg, p.returncode
+
+    def _checkout_files(self, filenames, revision):
+        """Checks out several files at one revision with a single command.
+
+        Returns a dictionary mapping each filename that was checked out to
+        its contents. Files that couldn't be checked out are left out.
+        """
+        tempdir, output, errmsg, failure = \
+            self._run_cvs(['-q', 'checkout', '-r', revision] + filenames)
+        results = {}
+
+        try:
+            for filename in filenames:
+                path = os.path.normpath(os.path.join(tempdir, filename))
+
+                # Paths come from uploaded diffs, so make sure they don't
+                # point outside of the checkout.
+                if not path.startswith(os.path.join(tempdir, '')):
+                    continue
+
+                try:
+                    f = open(path, 'rb')
+                except IOError:
+                    continue
+
+                try:
+                    results[filename] = f.read()
+                finally:
+                    f.close()
+        finally:
+            shutil.rmtree(tempdir, True)
+
+        return results
 
     def _cat_specific_file(self, filename, revision):
-        # Somehow CVS sometimes seems to write .cvsignore files to current
-        # working directory even though we force stdout with -p.
-        self.tempdir = tempfile.mkdtemp()
-        os.chdir(self.tempdir)
-
-        p = subprocess.Popen(['cvs', '-f', '-d', self.repository, 'checkout',
-                              '-r', str(revision), '-p', filename],
-                             stderr=subprocess.PIPE, stdout=subprocess.PIPE,
-                             close_fds=(os.name != 'nt'))
-        contents = p.stdout.read()
-        errmsg = p.stderr.read()
-        failure = p.wait()
+        tempdir, contents, errmsg, failure = \
+            self._run_cvs(['checkout', '-r', str(revision), '-p', filename])
+        shutil.rmtree(tempdir, True)
 
         # Unfortunately, CVS is not consistent about exiting non-zero on
         # errors.  If the file is not found at all, then CVS will print an
@@ -279,7 +402,6 @@ class CVSClient:
         if not errmsg or \
            errmsg.startswith('cvs checkout: cannot find module') or \
            errmsg.startswith('cvs checkout: could not read RCS file'):
-            self.cleanup()
             raise FileNotFoundError(filename, revision)
 
         # Otherwise, if there's an exit code, or errmsg doesn't look like
@@ -289,8 +411,6 @@ class CVSClient:
         # stating this. This is safe to ignore.
         if (failure and not errmsg.startswith('==========')) and \
            not ".cvspass does not exist - creating new file" in errmsg:
-            self.cleanup()
             raise SCMError(errmsg)
 
-        self.cleanup()
         return contents
@@ -1,7 +1,11 @@
 import logging
 import os
 import re
+import select
+import signal
 import subprocess
+import threading
+import time
 import urllib2
 import urlparse
 
@@ -21,6 +25,9 @@ from reviewboard.scmtools.errors import FileNotFoundError, \
                                         InvalidRevisionFormatError, \
                                         RepositoryNotFoundError, \
                                         SCMError
+from reviewboard.scmtools.gitobjects import UnsupportedObjectError, \
+                                            get_object_reader
+from reviewboard.scmtools.httppool import open_url
 
 
 GIT_DIFF_EMPTY_CHANGESET_SIZE = 3
@@ -73,6 +80,25 @@ class GitTool(SCMTool):
         except (FileNotFoundError, InvalidRevisionFormatError):
             return False
 
+    def _file_exists_many(self, paths_and_revisions):
+        if self.client.raw_file_url:
+            # Each file needs its own request, so check them a few at a time.
+            return super(GitTool, self)._file_exists_many(paths_and_revisions)
+
+        # Nothing exists before it's created, so there's no need to ask git.
+        results = [False] * len(paths_and_revisions)
+        indexes = [i for i, (path, revision) in enumerate(paths_and_revisions)
+                   if revision != PRE_CREATION]
+
+        if indexes:
+            found = self.client.get_files_exist([paths_and_revisions[i]
+                                                 for i in indexes])
+
+            for i, exists in zip(indexes, found):
+                results[i] = exists
+
+        return results
+
     def parse_diff_revision(self, file_str, revision_str):
         revision = revision_str
 
@@ -161,7 +187,7 @@ class GitDiffParser(DiffParser):
 
         # Now we have a diff we are going to use so get the filenames + commits
         file_info = File()
-        file_info.data = self.lines[linenum] + "\n"
+        file_info.data = self.lines.get_data(linenum, linenum + 1)
         file_info.binary = False
         diff_line = self.lines[linenum].split()
 
@@ -191,20 +217,28 @@ class GitDiffParser(DiffParser):
 
             linenum += 1
 
-        # Get the changes
+        # Get the changes. They're added to the diff all at once when we
+        # reach the end of them.
+        changes_start = linenum
+
         while linenum < len(self.lines):
             if self._is_git_diff(linenum):
-                return linenum, file_info
+                break
 
             if self._is_binary_patch(linenum):
                 file_info.binary = True
-                return linenum + 1, file_info
+                break
 
             if self._is_diff_fromfile_line(linenum):
                 if self.lines[linenum].split()[1] == "/dev/null":
                     file_info.origInfo = PRE_CREATION
 
-            file_info.data += self.lines[linenum] + "\n"
+            linenum += 1
+
+        file_info.data += self.lines.get_data(changes_start, linenum)
+
+        if file_info.binary:
+            # Skip past the binary patch line.
             linenum += 1
 
         return linenum, file_info
@@ -256,9 +290,308 @@ class GitDiffParser(DiffParser):
                 setattr(file_info, attr, '')
 
 
+class CatFileProcessError(Exception):
+    """A git cat-file process died or stopped responding properly."""
+    pass
+
+
+class CatFileTimeoutError(CatFileProcessError):
+    """A git cat-file process took too long to answer a request."""
+    pass
+
+
+class CatFileProcess(object):
+    """A long-running git cat-file --batch or --batch-check process.
+
+    Object names are written to the process one per line, and the answer
+    to each is read back before the next is sent.
+    """
+    # The header git cat-file writes for each object that was found.
+    # Objects that weren't found have a line ending in "missing" instead.
+    header_re = re.compile(r'^[0-9a-f]{40} (?P<type>\w+) (?P<size>\d+)$')
+
+    # Waiting on the process's output with select() doesn't work for pipes
+    # on Windows, so requests can't time out there.
+    can_time_out = (os.name != 'nt')
+
+    def __init__(self, git_dir, batch_option):
+        self.batch_option = batch_option
+
+        devnull = open(os.devnull, 'w')
+
+        try:
+            self.p = subprocess.Popen(
+                ['git', '--git-dir=%s' % git_dir, 'cat-file', batch_option],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+                close_fds=(os.name != 'nt')
+            )
+        finally:
+            devnull.close()
+
+        self.fd = self.p.stdout.fileno()
+        self.buffer = ''
+        self.started = time.time()
+        self.last_used = self.started
+
+    def is_alive(self):
+        return self.p.poll() is None
+
+    def request(self, obj, timeout):
+        """Looks up an object.
+
+        This returns a tuple of the object's type and, for --batch
+        processes, its contents. The type is None if the object doesn't
+        exist.
+        """
+        self.last_used = time.time()
+        deadline = self.last_used + timeout
+
+        try:
+            self.p.stdin.write('%s\n' % obj)
+            self.p.stdin.flush()
+        except (IOError, OSError), e:
+            raise CatFileProcessError(e)
+
+        header = self._read_line(deadline)
+        m = self.header_re.match(header)
+
+        if not m:
+            if header.endswith(' missing'):
+                return None, None
+
+            raise SCMError("Unexpected output from git cat-file: %s" %
+                           header)
+
+        if self.batch_option == '--batch':
+            # The contents are followed by a newline.
+            contents = self._read(int(m.group('size')) + 1, deadline)[:-1]
+        else:
+            contents = None
+
+        return m.group('type'), contents
+
+    def close(self):
+        """Stops the process."""
+        for f in (self.p.stdin, self.p.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+        if os.name != 'nt':
+            # The process exits once its input is closed, unless it's
+            # stuck. Python 2.4's Popen can't kill processes itself.
+            try:
+                os.kill(self.p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+            self.p.wait()
+
+    def _read_line(self, deadline):
+        i = self.buffer.find('\n')
+
+        while i == -1:
+            start = len(self.buffer)
+            self.buffer += self._read_chunk(deadline)
+            i = self.buffer.find('\n', start)
+
+        line = self.buffer[:i]
+        self.buffer = self.buffer[i + 1:]
+
+        return line
+
+    def _read(self, size, deadline):
+        chunks = [self.buffer]
+        num_read = len(self.buffer)
+
+        while num_read < size:
+            chunk = self._read_chunk(deadline)
+            chunks.append(chunk)
+            num_read += len(chunk)
+
+        data = ''.join(chunks)
+        self.buffer = data[size:]
+
+        return data[:size]
+
+    def _read_chunk(self, deadline):
+        if self.can_time_out:
+            remaining = deadline - time.time()
+
+            if (remaining <= 0 or
+                not select.select([self.fd], [], [], remaining)[0]):
+                raise CatFileTimeoutError("git cat-file timed out")
+
+        try:
+            chunk = os.read(self.fd, 65536)
+        except (IOError, OSError), e:
+            raise CatFileProcessError(e)
+
+        if not chunk:
+            raise CatFileProcessError("git cat-file exited unexpectedly")
+
+        return chunk
+
+
+class CatFilePool(object):
+    """A pool of git cat-file processes for a repository.
+
+    Processes are reused across requests, rather than starting git for
+    every file. A process is only used by one thread at a time. Processes
+    that have died are replaced, and ones that have been idle or running
+    for too long are stopped.
+    """
+    MAX_IDLE_PROCESSES = 4
+    IDLE_TIMEOUT = 60
+    MAX_AGE = 60 * 60
+    REQUEST_TIMEOUT = 30
+
+    def __init__(self, git_dir, batch_option):
+        self.git_dir = git_dir
+        self.batch_option = batch_option
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = os.getpid()
+
+    def request(self, obj):
+        """Looks up an object, as with CatFileProcess.request.
+
+        If the process fails, the request is retried once with a new
+        process. CatFileProcessError is raised if that fails too.
+        """
+        for attempt in range(2):
+            process = self._acquire()
+
+            try:
+                result = process.request(obj, self.REQUEST_TIMEOUT)
+            except CatFileTimeoutError:
+                process.close()
+                raise SCMError("Timed out looking up %s in %s" %
+                               (obj, self.git_dir))
+            except CatFileProcessError, e:
+                process.close()
+                error = e
+                continue
+            except:
+                # Whatever happened, the process can't be trusted to be
+                # ready for the next request.
+                process.close()
+                raise
+
+            self._release(process)
+
+            return result
+
+        raise error
+
+    def close(self):
+        """Stops all idle processes."""
+        self.lock.acquire()
+
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+
+        for process in idle:
+            process.close()
+
+    def _acquire(self):
+        now = time.time()
+        expired = []
+        process = None
+
+        self.lock.acquire()
+
+        try:
+            if self.pid != os.getpid():
+                # We've been forked. The processes belong to the parent, so
+                # they're left alone.
+                self.idle = []
+                self.pid = os.getpid()
+
+            idle = []
+
+            for p in self.idle:
+                if (now - p.last_used > self.IDLE_TIMEOUT or
+                    now - p.started > self.MAX_AGE or
+                    not p.is_alive()):
+                    expired.append(p)
+                else:
+                    idle.append(p)
+
+            if idle:
+                process = idle.pop()
+
+            self.idle = idle
+        finally:
+            self.lock.release()
+
+        for p in expired:
+            p.close()
+
+        if process is None:
+            try:
+                process = CatFileProcess(self.git_dir, self.batch_option)
+            except OSError, e:
+                raise CatFileProcessError(e)
+
+        return process
+
+    def _release(self, process):
+        self.lock.acquire()
+
+        try:
+            if (self.pid == os.getpid() and
+                len(self.idle) < self.MAX_IDLE_PROCESSES):
+                self.idle.append(process)
+                process = None
+        finally:
+            self.lock.release()
+
+        if process is not None:
+            process.close()
+
+
+_cat_file_pools = {}
+_cat_file_pools_lock = threading.Lock()
+
+
+def get_cat_file_pool(git_dir, batch_option):
+    """Returns the shared pool of git cat-file processes for a repository."""
+    key = (git_dir, batch_option)
+
+    _cat_file_pools_lock.acquire()
+
+    try:
+        try:
+            return _cat_file_pools[key]
+        except KeyError:
+            pool = CatFilePool(git_dir, batch_option)
+            _cat_file_pools[key] = pool
+            return pool
+    finally:
+        _cat_file_pools_lock.release()
+
+
 class GitClient(object):
     FULL_SHA1_LENGTH = 40
 
+    # The git cat-file --batch option used in place of each option
+    # _cat_file can be called with.
+    cat_file_batch_options = {
+        'blob': '--batch',
+        '-t': '--batch-check',
+    }
+
+    # Whether objects in local repositories are read in-process where
+    # possible, rather than by git.
+    use_object_reader = True
+
     schemeless_url_re = re.compile(
         r'^(?P<username>[A-Za-z0-9_\.-]+@)?(?P<hostname>[A-Za-z0-9_\.-]+):'
         r'(?P<path>.*)')
@@ -321,7 +654,7 @@ class GitClient(object):
             # First, try to grab the file remotely.
             try:
                 url = self._build_raw_url(path, revision)
-                return urllib2.urlopen(url).read()
+                return open_url(url).read()
             except Exception, e:
                 logging.error("Git: Error fetching file from %s: %s" % (url, e))
                 raise SCMError("Error fetching file from %s: %s" % (url, e))
@@ -335,7 +668,7 @@ class GitClient(object):
             # First, try to grab the file remotely.
             try:
                 url = self._build_raw_url(path, revision)
-                return urllib2.urlopen(url).geturl()
+                return open_url(url).geturl()
             except urllib2.HTTPError, e:
                 if e.code != 404:
                     logging.error("Git: HTTP error code %d when fetching "
@@ -348,6 +681,24 @@ class GitClient(object):
             contents = self._cat_file(path, revision, "-t")
             return contents and contents.strip() == "blob"
 
+    def get_files_exist(self, paths_and_revisions):
+        """Checks whether each file in a list exists in the local repository.
+
+        The files are all looked up by the same git-cat-file(1) process.
+        This returns a list of booleans, in the same order as the list of
+        (path, revision) tuples.
+        """
+        results = []
+
+        for path, revision in paths_and_revisions:
+            try:
+                obj_type = self._cat_file(path, revision, "-t")
+                results.append(obj_type.strip() == "blob")
+            except FileNotFoundError:
+                results.append(False)
+
+        return results
+
     def validate_sha1_format(self, path, sha1):
         """Validates that a SHA1 is of the right length for this repository."""
         if self.raw_file_url and len(sha1) != self.FULL_SHA1_LENGTH:
@@ -369,9 +720,68 @@ class GitClient(object):
 
         Otherwise, "option" can be used to pass a switch to git-cat-file,
         e.g. to test or existence or get the type of "commit".
+
+        Objects are read straight from the repository where possible. If
+        that isn't possible, they're looked up by a long-running git
+        cat-file --batch process, rather than starting git for each one.
         """
         commit = self._resolve_head(revision, path)
+        batch_option = self.cat_file_batch_options.get(option)
+
+        if batch_option is None or '\n' in commit:
+            return self._run_cat_file(commit, option)
+
+        if self.git_dir and self.use_object_reader:
+            reader = get_object_reader(self.git_dir)
+        else:
+            reader = None
+
+        if reader:
+            try:
+                if option == "-t":
+                    obj_type = reader.get_object_type(commit)
+                    contents = None
+                else:
+                    obj_type, contents = reader.read_object(commit)
+
+                return self._get_cat_file_result(commit, option, obj_type,
+                                                 contents)
+            except UnsupportedObjectError:
+                pass
+            except SCMError:
+                raise
+            except Exception, e:
+                logging.warning("Git: Unable to read %s from %s, falling "
+                                "back on git: %s" % (commit, self.git_dir, e),
+                                exc_info=1)
+
+        pool = get_cat_file_pool(self.git_dir, batch_option)
+
+        try:
+            obj_type, contents = pool.request(commit)
+        except CatFileProcessError, e:
+            logging.warning("Git: Unable to use git cat-file %s for %s: %s" %
+                            (batch_option, self.git_dir, e))
+            return self._run_cat_file(commit, option)
+
+        return self._get_cat_file_result(commit, option, obj_type, contents)
+
+    def _get_cat_file_result(self, commit, option, obj_type, contents):
+        """Returns what git-cat-file(1) would for an object that was looked
+        up in a batch.
+        """
+        if obj_type is None:
+            raise FileNotFoundError(commit)
+
+        if option == "-t":
+            return "%s\n" % obj_type
+        elif obj_type != "blob":
+            raise SCMError("fatal: git cat-file %s: bad file" % commit)
+
+        return contents
 
+    def _run_cat_file(self, commit, option):
+        """Runs git-cat-file(1) once, for a single object."""
         p = subprocess.Popen(
             ['git', '--git-dir=%s' % self.git_dir, 'cat-file', option, commit],
             stderr=subprocess.PIPE,
@@ -0,0 +1,731 @@
+"""Reads objects straight from a local Git repository.
+
+This reads loose objects and packfiles without running git, which saves
+starting a process for every file. It only understands what Review Board
+needs: looking up objects by full or abbreviated SHA1, or by a path in
+HEAD. Anything else raises UnsupportedObjectError, so that the caller can
+fall back on git itself.
+"""
+
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from binascii import hexlify, unhexlify
+
+from reviewboard.diffviewer.cache import SizedLRUCache
+
+
+# Object types, as numbered in packfiles.
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {
+    OBJ_COMMIT: 'commit',
+    OBJ_TREE: 'tree',
+    OBJ_BLOB: 'blob',
+    OBJ_TAG: 'tag',
+}
+
+# Git only accepts abbreviated SHA1s of at least this many characters.
+MIN_ABBREV_LENGTH = 4
+
+SHA1_RE = re.compile(r'^[0-9a-fA-F]{%d,40}$' % MIN_ABBREV_LENGTH)
+HEAD_PATH_RE = re.compile(r'^HEAD:(?P<path>.+)$')
+
+PACK_IDX_V2_MAGIC = '\377tOc'
+
+# The amount of compressed data inflated at a time.
+INFLATE_CHUNK_SIZE = 64 * 1024
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+class UnsupportedObjectError(Exception):
+    """The object can't be looked up without git itself.
+
+    This is raised for object names other than SHA1s and HEAD paths,
+    abbreviated SHA1s matching more than one object, and repositories
+    laid out in ways the reader doesn't understand.
+    """
+    pass
+
+
+class PackIndex(object):
+    """A packfile's index, mapping object SHA1s to offsets in the pack."""
+    def __init__(self, filename):
+        self.data = _map_file(filename)
+
+        if self.data[:4] == PACK_IDX_V2_MAGIC:
+            if struct.unpack('>L', self.data[4:8])[0] != 2:
+                raise UnsupportedObjectError('Unknown pack index version '
+                                             'in %s' % filename)
+
+            self.version = 2
+            fanout_start = 8
+            self.sha_start = fanout_start + 256 * 4
+            self.entry_size = 20
+            self.sha_offset = 0
+        else:
+            # Version 1 indexes have no header, and store each offset
+            # before its SHA1.
+            self.version = 1
+            fanout_start = 0
+            self.sha_start = 256 * 4
+            self.entry_size = 24
+            self.sha_offset = 4
+
+        self.fanout = struct.unpack('>256L',
+                                    self.data[fanout_start:self.sha_start])
+        self.num_objects = self.fanout[255]
+
+        if self.version == 2:
+            self.offsets_start = self.sha_start + self.num_objects * 24
+            self.large_offsets_start = (self.offsets_start +
+                                        self.num_objects * 4)
+
+    def find(self, sha):
+        """Returns the offset of a binary SHA1 in the pack, or None."""
+        i = self._bisect(sha)
+
+        if i < self.num_objects and self._get_sha(i) == sha:
+            return self._get_offset(i)
+
+        return None
+
+    def find_prefix(self, hex_prefix):
+        """Returns the binary SHA1s of the objects with a hex prefix.
+
+        At most two are returned, which is enough to tell whether the
+        prefix is ambiguous.
+        """
+        padded = hex_prefix + '0' * (40 - len(hex_prefix))
+        i = self._bisect(unhexlify(padded))
+        shas = []
+
+        while i < self.num_objects and len(shas) < 2:
+            sha = self._get_sha(i)
+
+            if not hexlify(sha).startswith(hex_prefix):
+                break
+
+            shas.append(sha)
+            i += 1
+
+        return shas
+
+    def _bisect(self, sha):
+        """Returns the index of the first entry not less than sha."""
+        first_byte = ord(sha[0])
+
+        if first_byte == 0:
+            lo = 0
+        else:
+            lo = self.fanout[first_byte - 1]
+
+        hi = self.fanout[first_byte]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._get_sha(mid) < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _get_sha(self, i):
+        start = self.sha_start + i * self.entry_size + self.sha_offset
+        return self.data[start:start + 20]
+
+    def _get_offset(self, i):
+        if self.version == 1:
+            start = self.sha_start + i * self.entry_size
+            return struct.unpack('>L', self.data[start:start + 4])[0]
+
+        start = self.offsets_start + i * 4
+        offset = struct.unpack('>L', self.data[start:start + 4])[0]
+
+        if offset & 0x80000000:
+            # The offset is stored in the table of 8-byte offsets.
+            start = self.large_offsets_start + (offset & 0x7fffffff) * 8
+            offset = struct.unpack('>Q', self.data[start:start + 8])[0]
+
+        return offset
+
+
+class Pack(object):
+    """A packfile and its index."""
+    def __init__(self, pack_filename, index_filename):
+        self.filename = pack_filename
+        self.index = PackIndex(index_filename)
+        self.data = _map_file(pack_filename)
+
+        if self.data[:4] != 'PACK':
+            raise UnsupportedObjectError('%s is not a packfile' %
+                                         pack_filename)
+
+    def read_header(self, offset):
+        """Reads the header of the entry at an offset.
+
+        This returns a tuple of the entry's type, the size of its data once
+        inflated, the base of a delta (an offset for OBJ_OFS_DELTA, or a
+        binary SHA1 for OBJ_REF_DELTA, otherwise None) and the offset of
+        the compressed data.
+        """
+        data = self.data
+        entry_offset = offset
+        c = ord(data[offset])
+        offset += 1
+        obj_type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+
+        while c & 0x80:
+            c = ord(data[offset])
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        base = None
+
+        if obj_type == OBJ_OFS_DELTA:
+            c = ord(data[offset])
+            offset += 1
+            base_distance = c & 0x7f
+
+            while c & 0x80:
+                c = ord(data[offset])
+                offset += 1
+                base_distance = ((base_distance + 1) << 7) | (c & 0x7f)
+
+            base = entry_offset - base_distance
+        elif obj_type == OBJ_REF_DELTA:
+            base = data[offset:offset + 20]
+            offset += 20
+
+        return obj_type, size, base, offset
+
+    def inflate(self, offset, size):
+        """Inflates the compressed data at an offset."""
+        decompressor = zlib.decompressobj()
+        chunks = []
+        num_inflated = 0
+
+        # Most objects compress to less than their size, so this usually
+        # takes a single chunk.
+        chunk_size = min(size + 1024, INFLATE_CHUNK_SIZE)
+
+        while num_inflated < size:
+            compressed = self.data[offset:offset + chunk_size]
+
+            if not compressed:
+                raise zlib.error('Unexpected end of %s' % self.filename)
+
+            offset += len(compressed)
+            chunk = decompressor.decompress(compressed)
+            chunks.append(chunk)
+            num_inflated += len(chunk)
+
+            if decompressor.unused_data:
+                break
+
+            chunk_size = INFLATE_CHUNK_SIZE
+
+        data = ''.join(chunks)
+
+        if len(data) != size:
+            raise zlib.error('Corrupt object in %s' % self.filename)
+
+        return data
+
+
+class GitObjectReader(object):
+    """Reads objects from a local Git repository.
+
+    Packs are memory-mapped, so reading a packed object costs no more than
+    inflating it and applying its deltas. The bases of deltas are cached,
+    since many objects tend to be deltas against the same few bases.
+
+    The reader is safe to use from multiple threads.
+    """
+    # The total size of the delta bases kept in memory.
+    DELTA_BASE_CACHE_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.objects_dir = os.path.join(git_dir, 'objects')
+        self.pack_dir = os.path.join(self.objects_dir, 'pack')
+
+        if not os.path.isdir(self.objects_dir):
+            raise UnsupportedObjectError('%s has no objects directory' %
+                                         git_dir)
+
+        if os.path.exists(os.path.join(self.objects_dir, 'info',
+                                       'alternates')):
+            raise UnsupportedObjectError('%s uses alternate object '
+                                         'directories' % git_dir)
+
+        self._lock = threading.Lock()
+        self._packs = []
+        self._pack_names = None
+        self._delta_base_cache = SizedLRUCache(self.DELTA_BASE_CACHE_SIZE)
+
+    def read_object(self, name):
+        """Reads an object by name.
+
+        This returns a tuple of the object's type and contents. Both are
+        None if the object doesn't exist.
+        """
+        sha = self.resolve(name)
+
+        if sha is None:
+            return None, None
+
+        return self._read_sha(sha)
+
+    def get_object_type(self, name):
+        """Returns the type of an object, or None if it doesn't exist.
+
+        Objects aren't inflated, except for the header of loose objects.
+        """
+        sha = self.resolve(name)
+
+        if sha is None:
+            return None
+
+        location = self._find(sha)
+
+        if location is None:
+            return None
+
+        pack, offset = location
+
+        if pack is not None:
+            return self._get_packed_type(pack, offset)
+
+        # The header is at the start of the object, and is small.
+        data = self._read_loose_object(location[1], 512)
+        header = zlib.decompressobj().decompress(data, 64)
+
+        return header.split(' ', 1)[0]
+
+    def resolve(self, name):
+        """Returns the binary SHA1 for an object name, or None."""
+        if SHA1_RE.match(name):
+            name = name.lower()
+
+            if len(name) == 40:
+                sha = unhexlify(name)
+
+                if self._find(sha) is not None:
+                    return sha
+
+                return None
+
+            return self._resolve_prefix(name)
+
+        m = HEAD_PATH_RE.match(name)
+
+        if m:
+            return self._resolve_path(self._resolve_head(), m.group('path'))
+
+        raise UnsupportedObjectError('Unsupported object name %s' % name)
+
+    def _read_sha(self, sha):
+        location = self._find(sha)
+
+        if location is None:
+            return None, None
+
+        pack, offset = location
+
+        if pack is not None:
+            return self._read_packed(pack, offset)
+
+        data = zlib.decompress(self._read_loose_object(location[1]))
+        i = data.index('\0')
+        obj_type, size = data[:i].split(' ')
+
+        return obj_type, data[i + 1:]
+
+    def _find(self, sha):
+        """Finds an object by its binary SHA1.
+
+        This returns a tuple of the pack and the offset of a packed object,
+        or None and the filename of a loose object. Returns None if the
+        object doesn't exist.
+        """
+        while True:
+            for pack in self._get_packs():
+                offset = pack.index.find(sha)
+
+                if offset is not None:
+                    return pack, offset
+
+            filename = self._get_loose_filename(sha)
+
+            if os.path.exists(filename):
+                return None, filename
+
+            # The object may have just been packed, removing the loose one.
+            if not self._reload_packs():
+                return None
+
+    def _read_packed(self, pack, offset):
+        """Reads an object from a pack, applying any deltas."""
+        deltas = []
+
+        # Follow the chain of deltas back to a full object, or to a base
+        # that's been cached.
+        while True:
+            cached = self._delta_base_cache.get((pack.filename, offset))
+
+            if cached is not None:
+                obj_type, data = cached
+                break
+
+            obj_type, size, base, data_offset = pack.read_header(offset)
+
+            if obj_type == OBJ_OFS_DELTA:
+                deltas.append((offset, pack.inflate(data_offset, size)))
+                offset = base
+            elif obj_type == OBJ_REF_DELTA:
+                deltas.append((offset, pack.inflate(data_offset, size)))
+                base_pack, offset = self._find_packed(base)
+
+                if base_pack is not pack:
+                    # Thin packs aren't kept on disk, so this shouldn't
+                    # happen.
+                    raise UnsupportedObjectError(
+                        'Delta base %s is not in %s' %
+                        (hexlify(base), pack.filename))
+            else:
+                obj_type = TYPE_NAMES[obj_type]
+                data = pack.inflate(data_offset, size)
+                break
+
+        deltas.reverse()
+
+        for delta_offset, delta in deltas:
+            # Each base is only worth keeping if something is built on it.
+            self._delta_base_cache.set((pack.filename, offset),
+                                       (obj_type, data), len(data))
+            data = _apply_delta(data, delta)
+            offset = delta_offset
+
+        return obj_type, data
+
+    def _get_packed_type(self, pack, offset):
+        while True:
+            obj_type, size, base, data_offset = pack.read_header(offset)
+
+            if obj_type == OBJ_OFS_DELTA:
+                offset = base
+            elif obj_type == OBJ_REF_DELTA:
+                pack, offset = self._find_packed(base)
+            else:
+                return TYPE_NAMES[obj_type]
+
+    def _find_packed(self, sha):
+        for pack in self._get_packs():
+            offset = pack.index.find(sha)
+
+            if offset is not None:
+                return pack, offset
+
+        raise UnsupportedObjectError('Delta base %s is not in a pack' %
+                                     hexlify(sha))
+
+    def _resolve_prefix(self, hex_prefix):
+        shas = {}
+
+        for pack in self._get_packs():
+            for sha in pack.index.find_prefix(hex_prefix):
+                shas[sha] = True
+
+        loose_dir = os.path.join(self.objects_dir, hex_prefix[:2])
+
+        try:
+            names = os.listdir(loose_dir)
+        except OSError:
+            names = []
+
+        for name in names:
+            if (len(name) == 38 and
+                (hex_prefix[:2] + name).startswith(hex_prefix)):
+                shas[unhexlify(hex_prefix[:2] + name)] = True
+
+        if len(shas) > 1:
+            # Let git report the ambiguity.
+            raise UnsupportedObjectError('%s is ambiguous' % hex_prefix)
+        elif shas:
+            return shas.keys()[0]
+        elif self._reload_packs():
+            return self._resolve_prefix(hex_prefix)
+        else:
+            return None
+
+    def _resolve_head(self):
+        ref = 'HEAD'
+
+        # Follow symbolic refs, such as HEAD pointing to a branch.
+        for i in range(5):
+            value = self._read_ref(ref)
+
+            if value is None:
+                raise UnsupportedObjectError('Unable to resolve %s' % ref)
+
+            if value.startswith('ref: '):
+                ref = value[5:].strip()
+            elif SHA1_RE.match(value) and len(value) == 40:
+                return unhexlify(value.lower())
+            else:
+                break
+
+        raise UnsupportedObjectError('Unable to resolve HEAD')
+
+    def _read_ref(self, ref):
+        try:
+            f = open(os.path.join(self.git_dir, ref), 'r')
+
+            try:
+                return f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            pass
+
+        try:
+            f = open(os.path.join(self.git_dir, 'packed-refs'), 'r')
+        except IOError:
+            return None
+
+        try:
+            for line in f:
+                parts = line.strip().split(' ', 1)
+
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+        finally:
+            f.close()
+
+        return None
+
+    def _resolve_path(self, commit_sha, path):
+        """Returns the SHA1 of the object at a path in a commit, or None."""
+        obj_type, data = self._read_sha(commit_sha)
+
+        if obj_type != 'commit' or not data.startswith('tree '):
+            raise UnsupportedObjectError('Unexpected commit %s' %
+                                         hexlify(commit_sha))
+
+        sha = unhexlify(data[5:45])
+
+        for name in path.strip('/').split('/'):
+            obj_type, data = self._read_sha(sha)
+
+            if obj_type != 'tree':
+                return None
+
+            sha = _find_tree_entry(data, name)
+
+            if sha is None:
+                return None
+
+        return sha
+
+    def _get_loose_filename(self, sha):
+        hex_sha = hexlify(sha)
+        return os.path.join(self.objects_dir, hex_sha[:2], hex_sha[2:])
+
+    def _read_loose_object(self, filename, size=-1):
+        try:
+            f = open(filename, 'rb')
+
+            try:
+                return f.read(size)
+            finally:
+                f.close()
+        except IOError, e:
+            # The object was packed and removed after it was found.
+            raise UnsupportedObjectError('Unable to read %s: %s' %
+                                         (filename, e))
+
+    def _get_packs(self):
+        if self._pack_names is None:
+            self._reload_packs()
+
+        return self._packs
+
+    def _reload_packs(self):
+        """Picks up packs added since the last time the packs were loaded.
+
+        Returns whether the set of packs changed.
+        """
+        try:
+            names = [name for name in os.listdir(self.pack_dir)
+                     if name.startswith('pack-') and name.endswith('.pack')]
+        except OSError:
+            names = []
+
+        names.sort()
+
+        self._lock.acquire()
+
+        try:
+            if names == self._pack_names:
+                return False
+
+            packs_by_name = dict([(os.path.basename(pack.filename), pack)
+                                  for pack in self._packs])
+            packs = []
+
+            for name in names:
+                pack = packs_by_name.get(name)
+
+                if pack is None:
+                    index_name = name[:-len('.pack')] + '.idx'
+
+                    try:
+                        pack = Pack(os.path.join(self.pack_dir, name),
+                                    os.path.join(self.pack_dir, index_name))
+                    except (IOError, OSError, mmap.error):
+                        # The pack is still being written, or was just
+                        # removed.
+                        continue
+
+                packs.append(pack)
+
+            self._packs = packs
+            self._pack_names = names
+
+            return True
+        finally:
+            self._lock.release()
+
+
+def get_object_reader(git_dir):
+    """Returns the shared GitObjectReader for a repository.
+
+    Returns None if the repository can't be read without git.
+    """
+    _readers_lock.acquire()
+
+    try:
+        try:
+            return _readers[git_dir]
+        except KeyError:
+            try:
+                reader = GitObjectReader(git_dir)
+            except UnsupportedObjectError:
+                reader = None
+
+            _readers[git_dir] = reader
+
+            return reader
+    finally:
+        _readers_lock.release()
+
+
+def _map_file(filename):
+    f = open(filename, 'rb')
+
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def _find_tree_entry(data, name):
+    """Returns the binary SHA1 of an entry in a tree object, or None.
+
+    Each entry is the mode and the name, separated by a space, followed by
+    a null byte and the entry's binary SHA1.
+    """
+    i = 0
+
+    while i < len(data):
+        space = data.index(' ', i)
+        null = data.index('\0', space)
+
+        if data[space + 1:null] == name:
+            return data[null + 1:null + 21]
+
+        i = null + 21
+
+    return None
+
+
+def _read_delta_size(delta, i):
+    size = 0
+    shift = 0
+
+    while True:
+        c = ord(delta[i])
+        i += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+
+        if not c & 0x80:
+            return size, i
+
+
+def _apply_delta(base, delta):
+    """Builds an object from its base and a delta against it.
+
+    A delta starts with the sizes of the base and the result. Each
+    instruction after that either copies a range of the base, or inserts
+    the bytes that follow it.
+    """
+    base_size, i = _read_delta_size(delta, 0)
+    result_size, i = _read_delta_size(delta, i)
+
+    if base_size != len(base):
+        raise zlib.error('Delta does not match its base')
+
+    chunks = []
+    delta_len = len(delta)
+
+    while i < delta_len:
+        c = ord(delta[i])
+        i += 1
+
+        if c & 0x80:
+            offset = 0
+            size = 0
+
+            for bit in range(4):
+                if c & (1 << bit):
+                    offset |= ord(delta[i]) << (bit * 8)
+                    i += 1
+
+            for bit in range(3):
+                if c & (0x10 << bit):
+                    size |= ord(delta[i]) << (bit * 8)
+                    i += 1
+
+            if size == 0:
+                size = 0x10000
+
+            chunks.append(base[offset:offset + size])
+        elif c:
+            chunks.append(delta[i:i + c])
+            i += c
+        else:
+            raise zlib.error('Invalid delta instruction')
+
+    result = ''.join(chunks)
+
+    if len(result) != result_size:
+        raise zlib.error('Delta produced the wrong size')
+
+    return result
@@ -10,11 +10,15 @@ from reviewboard.diffviewer.parser import DiffParser, DiffParserError
 from reviewboard.scmtools.git import GitDiffParser
 from reviewboard.scmtools.core import \
     FileNotFoundError, SCMTool, HEAD, PRE_CREATION, UNKNOWN
+from reviewboard.scmtools.httppool import open_url
 
 
 class HgTool(SCMTool):
     name = "Mercurial"
     supports_authentication = True
+
+    # Mercurial's repository objects can't be shared between threads.
+    thread_safe = False
     dependencies = {
         'modules': ['mercurial'],
     }
@@ -49,10 +53,19 @@ class HgTool(SCMTool):
         return ['diff_path', 'parent_diff_path']
 
     def get_parser(self, data):
-        if data.lstrip().startswith('diff --git'):
-            return GitDiffParser(data)
-        else:
-            return HgDiffParser(data)
+        parser = HgDiffParser(data)
+
+        # Diffs made with "hg diff --git" need the Git parser. The data may
+        # be an uploaded file, so the check is made on the loaded diff,
+        # which the Git parser can then share.
+        for line in parser.lines:
+            if line.strip():
+                if line.lstrip().startswith('diff --git'):
+                    return GitDiffParser(parser.data)
+
+                break
+
+        return parser
 
 
 class HgDiffParser(DiffParser):
@@ -108,6 +121,12 @@ class HgDiffParser(DiffParser):
 
 class HgWebClient(object):
     FULL_FILE_URL = '%(url)s/%(rawpath)s/%(revision)s/%(quoted_path)s'
+    RAW_PATHS = ['raw-file', 'raw']
+
+    # The raw path that worked last for each hgweb URL. Servers only
+    # accept one of them, so once one has worked, a 404 from it means
+    # the file doesn't exist and the other doesn't need to be tried.
+    _raw_paths = {}
 
     def __init__(self, repoPath, username, password):
         self.url = repoPath
@@ -122,39 +141,41 @@ class HgWebClient(object):
         elif rev == PRE_CREATION:
             rev = ""
 
-        found = False
+        known_rawpath = self._raw_paths.get(self.url)
 
-        for rawpath in ["raw-file", "raw"]:
-            full_url = ''
+        if known_rawpath:
+            rawpaths = [known_rawpath]
+        else:
+            rawpaths = self.RAW_PATHS
 
-            try:
-                passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passman.add_password(None, self.url, self.username,
-                                     self.password)
-                authhandler = urllib2.HTTPBasicAuthHandler(passman)
-                opener = urllib2.build_opener(authhandler)
-                full_url = self.FULL_FILE_URL % {
-                    'url': self.url.rstrip('/'),
-                    'rawpath': rawpath,
-                    'revision': rev,
-                    'quoted_path': urllib_quote(path.lstrip('/')),
-                }
-                f = opener.open(full_url)
-                return f.read()
+        error = ''
+
+        for rawpath in rawpaths:
+            full_url = self.FULL_FILE_URL % {
+                'url': self.url.rstrip('/'),
+                'rawpath': rawpath,
+                'revision': rev,
+                'quoted_path': urllib_quote(path.lstrip('/')),
+            }
 
+            try:
+                data = open_url(full_url, self.username,
+                                self.password).read()
+                self._raw_paths[self.url] = rawpath
+                return data
             except urllib2.HTTPError, e:
+                error = str(e)
 
                 if e.code != 404:
                     logging.error("%s: HTTP error code %d when fetching "
                                   "file from %s: %s", self.__class__.__name__,
                                   e.code, full_url, e)
-
-            except Exception:
+            except Exception, e:
+                error = str(e)
                 logging.exception('%s: Non-HTTP error when fetching %r: ',
                                   self.__class__.__name__, full_url)
 
-        if not found:
-            raise FileNotFoundError(path, rev, str(e))
+        raise FileNotFoundError(path, rev, error)
 
     def get_filenames(self, rev):
         raise NotImplemented
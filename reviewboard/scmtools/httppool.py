@@ -0,0 +1,225 @@
+import base64
+import httplib
+import os
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+
+class PooledResponse(object):
+    """The response to a request made through an HTTPConnectionPool.
+
+    This provides the parts of the interface of urllib2's responses that
+    the SCMTools use.
+    """
+    def __init__(self, url, code, headers, data):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+
+class HTTPConnectionPool(object):
+    """A pool of persistent HTTP connections, shared by a whole process.
+
+    Connections are kept open between requests to the same host, so that
+    fetching many files from a server doesn't need a new TCP connection
+    and TLS handshake for each one. A connection is only used by one
+    thread at a time.
+
+    Errors are raised as urllib2.HTTPError and urllib2.URLError, just as
+    urllib2.urlopen would. Requests that need to go through a proxy are
+    made with urllib2.
+    """
+    MAX_IDLE_CONNECTIONS = 4
+    IDLE_TIMEOUT = 30
+    MAX_REDIRECTS = 5
+    REDIRECT_CODES = (301, 302, 303, 307)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def open(self, url, username=None, password=None):
+        """Fetches a URL, returning a PooledResponse.
+
+        If a username is given, it's sent along with the password using
+        HTTP Basic authentication.
+        """
+        netloc = urlparse.urlparse(url)[1]
+
+        for i in range(self.MAX_REDIRECTS + 1):
+            scheme, url_netloc, path, params, query = \
+                urlparse.urlparse(url)[:5]
+
+            if (scheme not in ('http', 'https') or
+                urllib.getproxies().get(scheme)):
+                return self._open_with_urllib2(url, username, password)
+
+            selector = path or '/'
+
+            if params:
+                selector += ';' + params
+
+            if query:
+                selector += '?' + query
+
+            headers = {}
+
+            # Credentials are only sent to the host they were given for.
+            if username and url_netloc == netloc:
+                headers['Authorization'] = 'Basic %s' % \
+                    base64.encodestring('%s:%s' % (username, password or ''))\
+                          .replace('\n', '')
+
+            code, reason, response_headers, data = \
+                self._request(scheme, url_netloc, selector, headers)
+            location = response_headers.getheader('location')
+
+            if code in self.REDIRECT_CODES and location:
+                url = urlparse.urljoin(url, location)
+            elif code >= 400:
+                raise urllib2.HTTPError(url, code, reason, response_headers,
+                                        None)
+            else:
+                return PooledResponse(url, code, response_headers, data)
+
+        raise urllib2.HTTPError(url, code, 'Too many redirects',
+                                response_headers, None)
+
+    def close(self):
+        """Closes all idle connections."""
+        self._lock.acquire()
+
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+        for connections in idle.itervalues():
+            for conn, last_used in connections:
+                conn.close()
+
+    def _request(self, scheme, netloc, selector, headers):
+        key = (scheme, netloc)
+
+        while True:
+            conn, reused = self._acquire(key)
+
+            try:
+                conn.request('GET', selector, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+
+                if reused:
+                    # The server probably closed the connection while it
+                    # was idle. Try again on another one.
+                    continue
+
+                raise urllib2.URLError(e)
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+
+            return response.status, response.reason, response.msg, data
+
+    def _acquire(self, key):
+        now = time.time()
+        expired = []
+        conn = None
+
+        self._lock.acquire()
+
+        try:
+            if self._pid != os.getpid():
+                # We've been forked. The connections belong to the parent,
+                # so they're left alone.
+                self._idle = {}
+                self._pid = os.getpid()
+
+            connections = self._idle.get(key, [])
+
+            while connections:
+                conn, last_used = connections.pop()
+
+                if now - last_used < self.IDLE_TIMEOUT:
+                    break
+
+                expired.append(conn)
+                conn = None
+        finally:
+            self._lock.release()
+
+        for expired_conn in expired:
+            expired_conn.close()
+
+        if conn is not None:
+            return conn, True
+
+        scheme, netloc = key
+
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc)
+        else:
+            conn = httplib.HTTPConnection(netloc)
+
+        return conn, False
+
+    def _release(self, key, conn):
+        self._lock.acquire()
+
+        try:
+            connections = self._idle.setdefault(key, [])
+
+            if (self._pid == os.getpid() and
+                len(connections) < self.MAX_IDLE_CONNECTIONS):
+                connections.append((conn, time.time()))
+                conn = None
+        finally:
+            self._lock.release()
+
+        if conn is not None:
+            conn.close()
+
+    def _open_with_urllib2(self, url, username, password):
+        if username:
+            passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
+            passman.add_password(None, url, username, password)
+            opener = urllib2.build_opener(
+                urllib2.HTTPBasicAuthHandler(passman))
+        else:
+            opener = urllib2.build_opener()
+
+        f = opener.open(url)
+
+        try:
+            return PooledResponse(f.geturl(), getattr(f, 'code', 200),
+                                  f.info(), f.read())
+        finally:
+            f.close()
+
+
+_http_pool = HTTPConnectionPool()
+
+
+def open_url(url, username=None, password=None):
+    """Fetches a URL using the process's shared HTTPConnectionPool."""
+    return _http_pool.open(url, username, password)
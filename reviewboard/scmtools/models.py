@@ -1,7 +1,182 @@
+import logging
+import thread
+import threading
+import time
+
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 
 
+class SCMToolCache(object):
+    """A cache of SCMTool instances, shared by the whole process.
+
+    Tools are cached for each repository and its configuration, so a tool
+    is never reused after the repository has been changed, even if the
+    change was made by another process. Tools that aren't thread-safe are
+    cached separately for each thread. When a short-lived thread is done,
+    its tools are kept in a small pool for the next thread that needs one.
+    Tools that haven't been used for a while are closed and dropped.
+    """
+    IDLE_TIMEOUT = 10 * 60
+    REAP_INTERVAL = 60
+    MAX_POOLED_TOOLS = 4
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tools = {}
+        self.pooled_tools = {}
+        self.tool_classes = {}
+        self.last_reaped = time.time()
+
+    def get_tool(self, repository):
+        """Returns a tool for a repository, creating one if needed."""
+        cls = self.get_tool_class(repository)
+
+        if not cls.cache_instances or repository.pk is None:
+            return cls(repository)
+
+        key = (repository.pk, repository.get_scmtool_fingerprint())
+
+        if not cls.thread_safe:
+            key += (thread.get_ident(),)
+
+        now = time.time()
+        expired = []
+
+        self.lock.acquire()
+
+        try:
+            if now - self.last_reaped >= self.REAP_INTERVAL:
+                expired = self._pop_tools(
+                    lambda k, v: now - v[1] >= self.IDLE_TIMEOUT)
+                self.last_reaped = now
+
+            entry = self.tools.get(key)
+
+            if entry is None and not cls.thread_safe:
+                pool = self.pooled_tools.get(key[:2])
+
+                if pool:
+                    entry = pool.pop()
+                    self.tools[key] = entry
+
+            if entry is not None:
+                entry[1] = now
+        finally:
+            self.lock.release()
+
+        self._close_tools(expired)
+
+        if entry is not None:
+            return entry[0]
+
+        # Creating a tool can be slow, so it's done without holding the
+        # lock. If another thread created one in the meantime, that one
+        # wins.
+        tool = cls(repository)
+
+        self.lock.acquire()
+
+        try:
+            entry = self.tools.setdefault(key, [tool, now])
+        finally:
+            self.lock.release()
+
+        if entry[0] is not tool:
+            self._close_tools([tool])
+
+        return entry[0]
+
+    def get_tool_class(self, repository):
+        """Returns the SCMTool class for a repository."""
+        try:
+            return self.tool_classes[repository.tool_id]
+        except KeyError:
+            cls = repository.tool.get_scmtool_class()
+            self.tool_classes[repository.tool_id] = cls
+            return cls
+
+    def release_thread(self):
+        """Moves the calling thread's tools into the pool.
+
+        Threads that only live for a short while call this before they
+        exit, so that their tools, and any connections they hold, are
+        reused by other threads instead of sitting idle until they time
+        out.
+        """
+        ident = thread.get_ident()
+        extra = []
+
+        self.lock.acquire()
+
+        try:
+            for key, entry in self.tools.items():
+                if len(key) == 3 and key[2] == ident:
+                    del self.tools[key]
+                    pool = self.pooled_tools.setdefault(key[:2], [])
+
+                    if len(pool) < self.MAX_POOLED_TOOLS:
+                        pool.append(entry)
+                    else:
+                        extra.append(entry[0])
+        finally:
+            self.lock.release()
+
+        self._close_tools(extra)
+
+    def invalidate(self, repository_id):
+        """Closes and drops all cached tools for a repository."""
+        self.lock.acquire()
+
+        try:
+            tools = self._pop_tools(lambda k, v: k[0] == repository_id)
+        finally:
+            self.lock.release()
+
+        self._close_tools(tools)
+
+    def clear(self):
+        """Closes and drops all cached tools."""
+        self.lock.acquire()
+
+        try:
+            tools = self._pop_tools(lambda k, v: True)
+            self.tool_classes = {}
+        finally:
+            self.lock.release()
+
+        self._close_tools(tools)
+
+    def _pop_tools(self, should_pop):
+        tools = []
+
+        for key, entry in self.tools.items():
+            if should_pop(key, entry):
+                del self.tools[key]
+                tools.append(entry[0])
+
+        for key, pool in self.pooled_tools.items():
+            for entry in pool[:]:
+                if should_pop(key, entry):
+                    pool.remove(entry)
+                    tools.append(entry[0])
+
+            if not pool:
+                del self.pooled_tools[key]
+
+        return tools
+
+    def _close_tools(self, tools):
+        for tool in tools:
+            try:
+                tool.close()
+            except Exception, e:
+                logging.warning("Unable to close SCMTool %r: %s" % (tool, e))
+
+
+_scmtool_cache = SCMToolCache()
+
+
 class Tool(models.Model):
     name = models.CharField(max_length=32, unique=True)
     class_name = models.CharField(max_length=128, unique=True)
@@ -14,6 +189,10 @@ class Tool(models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, **kwargs):
+        super(Tool, self).save(**kwargs)
+        _scmtool_cache.clear()
+
     def get_scmtool_class(self):
         path = self.class_name
         i = path.rfind('.')
@@ -48,8 +227,26 @@ class Repository(models.Model):
     visible = models.BooleanField(default=True)
 
     def get_scmtool(self):
-        cls = self.tool.get_scmtool_class()
-        return cls(self)
+        """Returns the SCMTool for this repository.
+
+        Tools are cached and shared across requests, unless the tool's
+        class has cache_instances turned off.
+        """
+        return _scmtool_cache.get_tool(self)
+
+    def get_scmtool_fingerprint(self):
+        """Returns the parts of the repository's settings the tool uses."""
+        return (self.tool_id, self.path, self.mirror_path, self.raw_file_url,
+                self.username, self.password, self.encoding)
+
+    def save(self, **kwargs):
+        super(Repository, self).save(**kwargs)
+        _scmtool_cache.invalidate(self.pk)
+
+    def delete(self):
+        pk = self.pk
+        super(Repository, self).delete()
+        _scmtool_cache.invalidate(pk)
 
 
     def __unicode__(self):
@@ -1,5 +1,9 @@
+import logging
 import os
+import signal
 import subprocess
+import threading
+import time
 
 from djblets.util.filesystem import is_exe_in_path
 
@@ -10,6 +14,7 @@ from reviewboard.scmtools.errors import FileNotFoundError, SCMError
 
 class MonotoneTool(SCMTool):
     name = "Monotone"
+    supports_batch_fetches = True
     dependencies = {
         'executables': ['mtn'],
     }
@@ -30,6 +35,29 @@ class MonotoneTool(SCMTool):
 
         return self.client.get_file(revision)
 
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each file in a list.
+
+        All the files are fetched in one round of commands to the
+        database's mtn automate stdio session.
+        """
+        fileids = [revision for path, revision in paths_and_revisions
+                   if revision]
+
+        if fileids:
+            contents = self.client.get_files(fileids)
+            contents.reverse()
+
+        files = []
+
+        for path, revision in paths_and_revisions:
+            if revision:
+                files.append(contents.pop())
+            else:
+                files.append("")
+
+        return files
+
     def file_exists(self, path, revision=None):
         # revision is actually the file id here...
         if not revision:
@@ -70,6 +98,268 @@ class MonotoneDiffParser(DiffParser):
         return linenum
 
 
+class StdioSessionError(Exception):
+    """An mtn automate stdio process died or sent output that couldn't be
+    understood.
+    """
+    pass
+
+
+class StdioSession(object):
+    """A long-running mtn automate stdio process for a database.
+
+    Commands are written to the process in mtn's stdio encoding, and their
+    results are read back in order. Several commands are sent before any
+    results are read, so that a batch of files doesn't wait on a round
+    trip for each one. Both version 1 of the output format and version 2,
+    used by Monotone 0.46 and later, are understood.
+
+    The session is used by one thread at a time. If the process dies, a
+    new one is started and the commands are sent again. A process that
+    has been idle for a while is replaced before it's used again.
+    """
+    IDLE_TIMEOUT = 60
+
+    # How long a process may take to exit after its input is closed before
+    # it's killed.
+    STOP_TIMEOUT = 2
+
+    # The most commands written before reading their results. This keeps
+    # the pipes from filling up in both directions at once.
+    MAX_PENDING_COMMANDS = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.p = None
+        self.pid = os.getpid()
+        self.format_version = None
+        self.last_used = 0
+
+    def run(self, commands):
+        """Runs a list of commands, each given as a list of strings.
+
+        This returns a list of (error, output) tuples, in the same order.
+        error is 0 if the command succeeded. Otherwise, output is the error
+        message. StdioSessionError is raised if the process fails twice.
+        """
+        self.lock.acquire()
+
+        try:
+            for attempt in range(2):
+                try:
+                    self._start()
+                    results = []
+
+                    for i in range(0, len(commands),
+                                   self.MAX_PENDING_COMMANDS):
+                        results.extend(self._run_batch(
+                            commands[i:i + self.MAX_PENDING_COMMANDS]))
+
+                    self.last_used = time.time()
+
+                    return results
+                except StdioSessionError, e:
+                    self._stop()
+                    error = e
+                except:
+                    # Whatever happened, the process can't be trusted to be
+                    # ready for the next command.
+                    self._stop()
+                    raise
+
+            raise error
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Stops the process."""
+        self.lock.acquire()
+
+        try:
+            self._stop()
+        finally:
+            self.lock.release()
+
+    def _start(self):
+        if self.pid != os.getpid():
+            # We've been forked. The process belongs to the parent, so it's
+            # left alone.
+            self.p = None
+            self.pid = os.getpid()
+
+        if (self.p is not None and
+            (self.p.poll() is not None or
+             time.time() - self.last_used > self.IDLE_TIMEOUT)):
+            self._stop()
+
+        if self.p is None:
+            devnull = open(os.devnull, 'w')
+
+            try:
+                try:
+                    self.p = subprocess.Popen(
+                        ['mtn', '-d', self.path, 'automate', 'stdio'],
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=devnull,
+                        close_fds=(os.name != 'nt'))
+                except OSError, e:
+                    raise StdioSessionError(e)
+            finally:
+                devnull.close()
+
+            self.format_version = None
+
+    def _stop(self):
+        if self.p is None:
+            return
+
+        for f in (self.p.stdin, self.p.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+        # The process exits once its input is closed, unless it's stuck.
+        # It's given a moment to do so before it's killed.
+        deadline = time.time() + self.STOP_TIMEOUT
+
+        while self.p.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        if self.p.poll() is None and os.name != 'nt':
+            # Python 2.4's Popen can't kill processes itself.
+            try:
+                os.kill(self.p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        self.p.wait()
+        self.p = None
+
+    def _run_batch(self, commands):
+        data = []
+
+        for command in commands:
+            data.append('l')
+            data.extend(['%d:%s' % (len(arg), arg) for arg in command])
+            data.append('e')
+
+        try:
+            self.p.stdin.write(''.join(data))
+            self.p.stdin.flush()
+        except (IOError, OSError), e:
+            raise StdioSessionError(e)
+
+        return [self._read_result() for command in commands]
+
+    def _read_result(self):
+        field = self._read_field()
+
+        if self.format_version is None:
+            # Version 2 of the format starts with a header, followed by a
+            # blank line. Version 1 has no header.
+            if field == 'format-version':
+                self.format_version = int(self._read_line())
+                self._read_line()
+                field = self._read_field()
+            else:
+                self.format_version = 1
+
+        output = []
+        errors = []
+
+        while True:
+            if self.format_version == 1:
+                # <command>:<error>:<last>:<size>:<output>
+                error = self._read_int()
+                last = self._read_field()
+                output.append(self._read(self._read_int()))
+
+                if last == 'l':
+                    return error, ''.join(output)
+            else:
+                # <command>:<stream>:<size>:<output>, where the "l" stream
+                # holds the error code and ends the results.
+                stream = self._read_field()
+                data = self._read(self._read_int())
+
+                if stream == 'm':
+                    output.append(data)
+                elif stream == 'e':
+                    errors.append(data)
+                elif stream == 'l':
+                    error = int(data)
+
+                    if error:
+                        return error, ''.join(errors) or ''.join(output)
+
+                    return error, ''.join(output)
+
+            # The next chunk starts with the command number.
+            field = self._read_field()
+
+    def _read_field(self):
+        chars = []
+
+        while True:
+            c = self.p.stdout.read(1)
+
+            if not c:
+                raise StdioSessionError("mtn exited unexpectedly")
+            elif c == ':':
+                return ''.join(chars)
+            elif len(chars) > 32:
+                raise StdioSessionError("Unexpected output from mtn: %s" %
+                                        ''.join(chars))
+
+            chars.append(c)
+
+    def _read_int(self):
+        field = self._read_field()
+
+        try:
+            return int(field)
+        except ValueError:
+            raise StdioSessionError("Unexpected output from mtn: %s" % field)
+
+    def _read_line(self):
+        line = self.p.stdout.readline()
+
+        if not line.endswith('\n'):
+            raise StdioSessionError("mtn exited unexpectedly")
+
+        return line.strip()
+
+    def _read(self, size):
+        data = self.p.stdout.read(size)
+
+        if len(data) != size:
+            raise StdioSessionError("mtn exited unexpectedly")
+
+        return data
+
+
+_stdio_sessions = {}
+_stdio_sessions_lock = threading.Lock()
+
+
+def get_stdio_session(path):
+    """Returns the shared mtn automate stdio session for a database."""
+    _stdio_sessions_lock.acquire()
+
+    try:
+        try:
+            return _stdio_sessions[path]
+        except KeyError:
+            session = StdioSession(path)
+            _stdio_sessions[path] = session
+            return session
+    finally:
+        _stdio_sessions_lock.release()
+
+
 class MonotoneClient:
     def __init__(self, path):
         if not is_exe_in_path('mtn'):
@@ -83,6 +373,33 @@ class MonotoneClient:
             raise SCMError("Repository %s does not exist" % path)
 
     def get_file(self, fileid):
+        return self.get_files([fileid])[0]
+
+    def get_files(self, fileids):
+        """Returns the contents of each file ID in a list.
+
+        The files are fetched by the database's mtn automate stdio session,
+        rather than starting mtn for each one.
+        """
+        try:
+            results = get_stdio_session(self.path).run(
+                [['get_file', fileid] for fileid in fileids])
+        except StdioSessionError, e:
+            logging.warning("Monotone: Unable to use mtn automate stdio for "
+                            "%s: %s" % (self.path, e))
+            return [self._run_get_file(fileid) for fileid in fileids]
+
+        files = []
+
+        for fileid, (error, output) in zip(fileids, results):
+            if error:
+                self._raise_error(fileid, output)
+
+            files.append(output)
+
+        return files
+
+    def _run_get_file(self, fileid):
         args = ['mtn', '-d', self.path, 'automate', 'get_file', fileid]
 
         p = subprocess.Popen(args,
@@ -97,7 +414,10 @@ class MonotoneClient:
         if not failure:
             return out
 
-        if "mtn: misuse: no file" in err:
+        self._raise_error(fileid, err)
+
+    def _raise_error(self, fileid, err):
+        if "misuse: no file" in err:
             raise FileNotFoundError(fileid)
         else:
             raise SCMError(err)
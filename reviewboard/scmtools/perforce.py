@@ -1,21 +1,27 @@
 import re
-import subprocess
 
 try:
     from P4 import P4Error
 except ImportError:
     pass
 
+from djblets.log import log_timed
+
 from reviewboard.diffviewer.parser import DiffParser
 from reviewboard.scmtools.core import SCMTool, ChangeSet, \
                                       HEAD, PRE_CREATION
-from reviewboard.scmtools.errors import SCMError, EmptyChangeSetError
+from reviewboard.scmtools.errors import SCMError, EmptyChangeSetError, \
+                                        FileNotFoundError
 
 
 class PerforceTool(SCMTool):
     name = "Perforce"
     uses_atomic_revisions = True
     supports_authentication = True
+    supports_batch_fetches = True
+
+    # A P4 connection can only run one command at a time.
+    thread_safe = False
     dependencies = {
         'modules': ['P4'],
     }
@@ -43,6 +49,9 @@ class PerforceTool(SCMTool):
             # This is totally safe to ignore.
             pass
 
+    def close(self):
+        self._disconnect()
+
     def _connect(self):
         if not self.p4.connected():
             self.p4.connect()
@@ -54,16 +63,53 @@ class PerforceTool(SCMTool):
         except AttributeError:
             pass
 
+    def _run(self, command, *args):
+        """Runs a command over the P4 connection, connecting if needed.
+
+        The connection is left open for the next command. If the server
+        dropped it while it was idle, it's reopened and the command is
+        tried once more.
+        """
+        log_timer = log_timed("Perforce: Running p4 %s %s on %s" %
+                              (command, ' '.join(args)[:200], self.p4.port))
+
+        try:
+            try:
+                self._connect()
+                return self.p4.run(command, *args)
+            except P4Error:
+                if self.p4.connected():
+                    raise
+
+                self._connect()
+                return self.p4.run(command, *args)
+        finally:
+            log_timer.done()
+
     def get_pending_changesets(self, userid):
-        self._connect()
-        return map(self.get_changeset,
-                   [x.split()[1] for x in
-                       self.p4.run_changes('-s', 'pending', '-u', userid)])
+        changenums = []
+
+        for change in self._run('changes', '-s', 'pending', '-u', userid):
+            if isinstance(change, dict):
+                changenums.append(change['change'])
+            else:
+                changenums.append(change.split()[1])
+
+        if not changenums:
+            return []
+
+        # All the changes are described by a single command.
+        descs = {}
+
+        for desc in self._run('describe', '-s', *changenums):
+            if isinstance(desc, dict) and 'change' in desc:
+                descs[desc['change']] = desc
+
+        return [self.parse_change_desc(descs.get(changenum), changenum)
+                for changenum in changenums]
 
     def get_changeset(self, changesetid):
-        self._connect()
-        changeset = self.p4.run_describe('-s', str(changesetid))
-        self._disconnect()
+        changeset = self._run('describe', '-s', str(changesetid))
 
         if changeset:
             return self.parse_change_desc(changeset[0], changesetid)
@@ -73,51 +119,127 @@ class PerforceTool(SCMTool):
         return True
 
     def get_file(self, path, revision=HEAD):
-        if revision == PRE_CREATION:
-            return ''
+        return self.get_files([(path, revision)])[0]
+
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each file in a list.
+
+        All the files are printed by a single p4 print command. If any of
+        them can't be found, FileNotFoundError is raised.
+        """
+        specs = [self._get_file_spec(path, revision)
+                 for path, revision in paths_and_revisions]
+        print_specs = []
+
+        for spec in specs:
+            if spec and spec not in print_specs:
+                print_specs.append(spec)
+
+        # p4 print returns a dictionary describing each file, followed by
+        # the file's contents, which may be split into several strings.
+        # Files that don't exist are only reported as warnings, and are
+        # left out of the results.
+        printed = []
+        contents = {}
+
+        if print_specs:
+            try:
+                results = self._run('print', *print_specs)
+            except P4Error, e:
+                raise SCMError('\n'.join(self.p4.errors) or str(e))
+
+            current = None
+
+            for result in results:
+                if isinstance(result, dict):
+                    current = []
+                    printed.append(current)
+
+                    if 'depotFile' in result:
+                        contents[(result['depotFile'], result.get('rev'))] = \
+                            current
+                        contents.setdefault((result['depotFile'], None),
+                                            current)
+                elif current is not None:
+                    current.append(result)
+
+        # Files are printed in the order they were given, so if they all
+        # exist, they match up even when a path is spelled differently
+        # from the depot path.
+        if len(printed) == len(print_specs):
+            contents.update(zip(print_specs, printed))
+
+        files = []
+
+        for spec, (path, revision) in zip(specs, paths_and_revisions):
+            if spec is None:
+                files.append('')
+                continue
+
+            data = contents.get(spec)
+
+            if data is None and revision == HEAD:
+                data = contents.get((path, None))
+            elif data is None:
+                data = contents.get((path, str(revision)))
+
+            if data is None:
+                raise FileNotFoundError(path, revision)
+
+            files.append(''.join(data))
+
+        return files
+
+    def _file_exists_many(self, paths_and_revisions):
+        specs = [self._get_file_spec(path, revision)
+                 for path, revision in paths_and_revisions]
+
+        # Every file can be looked up with a single fstat. Files that don't
+        # exist are only reported as warnings, and are left out of the
+        # results.
+        existing = {}
+        lookup_specs = [spec for spec in specs if spec]
 
-        if revision == HEAD:
-            file = path
-        else:
-            file = '%s#%s' % (path, revision)
+        if lookup_specs:
+            for stat in self._run('fstat', *lookup_specs):
+                if 'depotFile' not in stat:
+                    continue
 
-        cmdline = ['p4', '-p', self.p4.port]
-        if self.p4.user:
-            cmdline.extend(['-u', self.p4.user])
-        if self.p4.password:
-            cmdline.extend(['-P', self.p4.password])
-        cmdline.extend(['print', '-q', file])
+                # A file is still listed at the revision it was deleted in.
+                exists = not stat.get('headAction', '').endswith('delete')
+                existing[(stat['depotFile'], stat.get('headRev'))] = exists
+                existing[(stat['depotFile'], None)] = exists
 
-        p = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        results = []
 
-        (res, errdata) = p.communicate()
-        failure = p.poll()
+        for spec, (path, revision) in zip(specs, paths_and_revisions):
+            if spec is None:
+                results.append(False)
+            elif revision == HEAD:
+                results.append(existing.get((path, None), False))
+            else:
+                results.append(existing.get((path, str(revision)), False))
 
-        if failure:
-            error = errdata.splitlines()
-            # The command-line output is the same as the contents of a P4Error
-            # except they're prefixed with a line that says "Perforce client
-            # error:", and the lines of the error are indented with tabs.
-            if error[0].startswith("Perforce client error:"):
-                error = error[1:]
+        return results
 
-            raise SCMError('\n'.join(line.lstrip("\t") for line in error))
+    def _get_file_spec(self, path, revision):
+        """Returns the p4 file spec for a file, or None for a new file."""
+        if revision == PRE_CREATION:
+            return None
+        elif revision == HEAD:
+            return path
         else:
-            return res
+            return '%s#%s' % (path, revision)
 
     def parse_diff_revision(self, file_str, revision_str):
         # Perforce has this lovely idiosyncracy that diffs show revision #1 both
         # for pre-creation and when there's an actual revision.
-        self._connect()
-
         filename, revision = revision_str.rsplit('#', 1)
-        files = self.p4.run_files(revision_str)
+        files = self._run('files', revision_str)
 
         if len(files) == 0:
             revision = PRE_CREATION
 
-        self._disconnect()
-
         return filename, revision
 
     def get_filenames_in_revision(self, revision):
@@ -1,6 +1,7 @@
 import logging
 import os
 import re
+import threading
 import urllib
 import urlparse
 
@@ -9,12 +10,16 @@ try:
 except ImportError:
     pass
 
+from django.core.cache import cache
 from django.utils.translation import ugettext as _
+from djblets.siteconfig.models import SiteConfiguration
+from djblets.util.misc import make_cache_key
 
 from reviewboard.diffviewer.parser import DiffParser
 from reviewboard.scmtools import sshutils
 from reviewboard.scmtools.certs import Certificate
-from reviewboard.scmtools.core import SCMTool, HEAD, PRE_CREATION, UNKNOWN
+from reviewboard.scmtools.core import SCMTool, HEAD, PRE_CREATION, UNKNOWN, \
+                                      run_in_threads
 from reviewboard.scmtools.errors import SCMError, \
                                         FileNotFoundError, \
                                         UnverifiedCertificateError, \
@@ -40,6 +45,15 @@ class SVNTool(SCMTool):
     name = "Subversion"
     uses_atomic_revisions = True
     supports_authentication = True
+    supports_batch_fetches = True
+
+    # pysvn.Client objects can't be shared between threads.
+    thread_safe = False
+
+    # The number of files get_files fetches at once, each with its own
+    # client. This is lowered to the site's limit on fetches from one
+    # repository, if that's lower.
+    MAX_CAT_THREADS = 4
     dependencies = {
         'modules': ['pysvn'],
     }
@@ -74,12 +88,13 @@ class SVNTool(SCMTool):
 
         SCMTool.__init__(self, repository)
 
-        import pysvn
-        self.client = pysvn.Client()
-        if repository.username:
-            self.client.set_default_username(str(repository.username))
-        if repository.password:
-            self.client.set_default_password(str(repository.password))
+        self.client = self._create_client()
+
+        # Clients that get_files can hand to its threads. These are kept
+        # for the next call, since creating a client loads the Subversion
+        # configuration.
+        self._idle_clients = [self.client]
+        self._clients_lock = threading.Lock()
 
         # svnlook uses 'rev 0', while svn diff uses 'revision 0'
         self.revision_re = re.compile("""
@@ -98,50 +113,215 @@ class SVNTool(SCMTool):
                                             # uses 'revision 0'
             """, re.VERBOSE)
 
+    def close(self):
+        self._idle_clients = [self.client]
+
     def get_file(self, path, revision=HEAD):
-        if not path:
-            raise FileNotFoundError(path, revision)
+        return self.get_files([(path, revision)])[0]
 
-        try:
-            normpath = self.__normalize_path(path)
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each file in a list.
 
-            # SVN expects to have URLs escaped. Take care to only
-            # escape the path part of the URL.
-            if self.client.is_url(normpath):
-                pathtuple = urlparse.urlsplit(normpath)
-                normpath = urlparse.urlunsplit((pathtuple[0],
-                                                pathtuple[1],
-                                                urllib.quote(pathtuple[2]),
-                                                '',''))
+        The files are fetched several at a time, each by its own client.
+        Their svn:keywords properties are then looked up with one propget
+        for each directory, and cached for files at specific revisions.
+        """
+        files = []
 
-            normrev  = self.__normalize_revision(revision)
+        for path, revision in paths_and_revisions:
+            if not path:
+                raise FileNotFoundError(path, revision)
 
-            data = self.client.cat(normpath, normrev)
+            files.append((path, revision, self._get_file_url(path),
+                          self.__normalize_revision(revision)))
 
-            # Find out if this file has any keyword expansion set.
-            # If it does, collapse these keywords. This is because SVN
-            # will return the file expanded to us, which would break patching.
-            keywords = self.client.propget("svn:keywords", normpath, normrev,
-                                           recurse=True)
+        results = [None] * len(files)
 
-            if normpath in keywords:
-                data = self.collapse_keywords(data, keywords[normpath])
+        def cat_file(i):
+            path, revision, url, normrev = files[i]
+            client = self._acquire_client()
 
-            return data
-        except ClientError, e:
-            stre = str(e)
-            if 'File not found' in stre or 'path not found' in stre:
-                raise FileNotFoundError(path, revision, str(e))
-            elif 'callback_ssl_server_trust_prompt required' in stre:
-                home = os.path.expanduser('~')
-                raise SCMError(
-                    'HTTPS certificate not accepted.  Please ensure that '
-                    'the proper certificate exists in %s/.subversion/auth '
-                    'for the user that reviewboard is running as.' % home)
-            elif 'callback_get_login required' in stre:
-                raise SCMError('Login to the SCM server failed.')
-            else:
-                raise SCMError(e)
+            try:
+                try:
+                    results[i] = client.cat(url, normrev)
+                except ClientError, e:
+                    self._raise_client_error(e, path, revision)
+            finally:
+                self._release_client(client)
+
+        max_threads = min(self._get_max_cat_threads(), len(files))
+
+        if max_threads > 1:
+            run_in_threads(cat_file, range(len(files)), max_threads)
+        else:
+            for i in range(len(files)):
+                cat_file(i)
+
+        # If a file has any keyword expansion set, collapse the keywords.
+        # This is because SVN will return the file expanded to us, which
+        # would break patching.
+        for i, keywords in enumerate(self._get_keywords(files)):
+            if keywords:
+                results[i] = self.collapse_keywords(results[i], keywords)
+
+        return results
+
+    def _get_max_cat_threads(self):
+        siteconfig = SiteConfiguration.objects.get_current()
+        limit = siteconfig.get('diffviewer_max_repository_fetches')
+
+        if limit:
+            return min(self.MAX_CAT_THREADS, limit)
+
+        return self.MAX_CAT_THREADS
+
+    def _get_keywords(self, files):
+        """Returns the svn:keywords property of each file in a list.
+
+        files is a list of (path, revision, url, normalized revision)
+        tuples. Files without the property have an empty string. Files in
+        the same directory at the same revision are looked up together.
+        """
+        import pysvn
+
+        results = [None] * len(files)
+        dirs = {}
+
+        for i, (path, revision, url, normrev) in enumerate(files):
+            key = self._get_keywords_cache_key(url, revision)
+
+            if key:
+                keywords = cache.get(key)
+
+                if keywords is not None:
+                    results[i] = keywords
+                    continue
+
+            dirs.setdefault((url.rsplit('/', 1)[0], str(revision)),
+                            []).append(i)
+
+        for (dir_url, revision), indexes in dirs.iteritems():
+            props = None
+
+            # Older versions of pysvn can't limit the depth of a propget.
+            if len(indexes) > 1 and hasattr(pysvn, 'depth'):
+                try:
+                    props = self.client.propget('svn:keywords', dir_url,
+                                                files[indexes[0]][3],
+                                                depth=pysvn.depth.files)
+                except ClientError, e:
+                    logging.warning("SVN: Unable to get keywords for "
+                                    "files in %s: %s" % (dir_url, e))
+
+            for i in indexes:
+                path, revision, url, normrev = files[i]
+
+                if props is None:
+                    try:
+                        file_props = self.client.propget('svn:keywords', url,
+                                                         normrev,
+                                                         recurse=True)
+                    except ClientError, e:
+                        self._raise_client_error(e, path, revision)
+                else:
+                    file_props = props
+
+                results[i] = self._get_prop(file_props, url)
+                key = self._get_keywords_cache_key(url, revision)
+
+                if key:
+                    cache.set(key, results[i])
+
+        return results
+
+    def _get_prop(self, props, url):
+        """Returns the value for a URL in the results of a propget.
+
+        The URLs in the results may be escaped differently than the ones
+        given to propget.
+        """
+        if url in props:
+            return props[url]
+
+        url = urllib.unquote(url)
+
+        for prop_url, value in props.iteritems():
+            if urllib.unquote(prop_url) == url:
+                return value
+
+        return ''
+
+    def _get_keywords_cache_key(self, url, revision):
+        """Returns the key for caching a file's svn:keywords property.
+
+        Returns None if the revision may change the property.
+        """
+        if revision in (HEAD, UNKNOWN, PRE_CREATION):
+            return None
+
+        return make_cache_key('svn-keywords:%s:%s' % (url, revision))
+
+    def _get_file_url(self, path):
+        normpath = self.__normalize_path(path)
+
+        # SVN expects to have URLs escaped. Take care to only
+        # escape the path part of the URL.
+        if self.client.is_url(normpath):
+            pathtuple = urlparse.urlsplit(normpath)
+            normpath = urlparse.urlunsplit((pathtuple[0],
+                                            pathtuple[1],
+                                            urllib.quote(pathtuple[2]),
+                                            '',''))
+
+        return normpath
+
+    def _raise_client_error(self, e, path, revision):
+        stre = str(e)
+        if 'File not found' in stre or 'path not found' in stre:
+            raise FileNotFoundError(path, revision, str(e))
+        elif 'callback_ssl_server_trust_prompt required' in stre:
+            home = os.path.expanduser('~')
+            raise SCMError(
+                'HTTPS certificate not accepted.  Please ensure that '
+                'the proper certificate exists in %s/.subversion/auth '
+                'for the user that reviewboard is running as.' % home)
+        elif 'callback_get_login required' in stre:
+            raise SCMError('Login to the SCM server failed.')
+        else:
+            raise SCMError(e)
+
+    def _create_client(self):
+        import pysvn
+
+        client = pysvn.Client()
+
+        if self.repository.username:
+            client.set_default_username(str(self.repository.username))
+
+        if self.repository.password:
+            client.set_default_password(str(self.repository.password))
+
+        return client
+
+    def _acquire_client(self):
+        self._clients_lock.acquire()
+
+        try:
+            if self._idle_clients:
+                return self._idle_clients.pop()
+        finally:
+            self._clients_lock.release()
+
+        return self._create_client()
+
+    def _release_client(self, client):
+        self._clients_lock.acquire()
+
+        try:
+            if len(self._idle_clients) < self.MAX_CAT_THREADS:
+                self._idle_clients.append(client)
+        finally:
+            self._clients_lock.release()
 
     def collapse_keywords(self, data, keyword_str):
         """
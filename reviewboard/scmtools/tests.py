@@ -1,8 +1,21 @@
+import BaseHTTPServer
+import SocketServer
 import imp
 import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
 import nose
 
 from django.test import TestCase as DjangoTestCase
+from djblets.siteconfig.models import SiteConfiguration
+from djblets.util.filesystem import is_exe_in_path
 try:
     imp.find_module("P4")
     from P4 import P4Error
@@ -11,10 +24,20 @@ except ImportError:
 
 from reviewboard.diffviewer.diffutils import patch
 from reviewboard.diffviewer.parser import DiffParserError
-from reviewboard.scmtools.core import HEAD, PRE_CREATION, ChangeSet, Revision
+from reviewboard.scmtools import bzr, cvs, mtn, svn
+from reviewboard.scmtools.core import HEAD, PRE_CREATION, ChangeSet, \
+                                      Revision, SCMTool, run_in_threads
+from reviewboard.scmtools.cvs import CVSClient
 from reviewboard.scmtools.errors import SCMError, FileNotFoundError
-from reviewboard.scmtools.git import ShortSHA1Error
-from reviewboard.scmtools.models import Repository, Tool
+from reviewboard.scmtools.git import GitTool, ShortSHA1Error, \
+                                     get_cat_file_pool
+from reviewboard.scmtools.gitobjects import GitObjectReader, \
+                                            UnsupportedObjectError
+from reviewboard.scmtools.hg import HgWebClient
+from reviewboard.scmtools.httppool import HTTPConnectionPool
+from reviewboard.scmtools.models import Repository, Tool, _scmtool_cache
+from reviewboard.scmtools.mtn import MonotoneClient, StdioSessionError, \
+                                     get_stdio_session
 
 
 class CoreTests(DjangoTestCase):
@@ -32,6 +55,186 @@ class CoreTests(DjangoTestCase):
         self.assert_(len(cs.bugs_closed) == 0)
         self.assert_(len(cs.files) == 0)
 
+    def testFileExistsMany(self):
+        """Testing SCMTool.file_exists_many"""
+        checked = []
+
+        class DummyTool(SCMTool):
+            def get_file(self, path, revision=HEAD):
+                checked.append((path, revision))
+
+                if path.startswith('missing'):
+                    raise FileNotFoundError(path, revision)
+
+                return ''
+
+        repository = Repository(name='Dummy', path='/dummy/file-exists')
+        tool = DummyTool(repository)
+        paths_and_revisions = [
+            ('a', '1'),
+            ('missing', '1'),
+            ('b', HEAD),
+            ('c', '2'),
+            ('missing2', HEAD),
+        ]
+
+        self.assertEqual(tool.file_exists_many(paths_and_revisions),
+                         [True, False, True, True, False])
+        self.assertEqual(sorted(checked), sorted(paths_and_revisions))
+
+        # Only files that exist at a specific revision are cached.
+        checked[:] = []
+        self.assertEqual(tool.file_exists_many(paths_and_revisions),
+                         [True, False, True, True, False])
+        self.assertEqual(sorted(checked),
+                         [('b', HEAD), ('missing', '1'), ('missing2', HEAD)])
+
+        # Tools that can't be used from several threads check one file at a
+        # time.
+        DummyTool.supports_parallel_fetches = False
+        tool = DummyTool(Repository(name='Dummy', path='/dummy/serial'))
+        self.assertEqual(tool.file_exists_many(paths_and_revisions),
+                         [True, False, True, True, False])
+
+
+class RepositoryTests(DjangoTestCase):
+    """Tests for the Repository model"""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        self.repository = Repository.objects.create(
+            name='Git test repo',
+            path=os.path.join(os.path.dirname(__file__), 'testdata',
+                              'git_repo'),
+            tool=Tool.objects.get(name='Git'))
+
+        try:
+            self.tool = self.repository.get_scmtool()
+        except ImportError:
+            raise nose.SkipTest('git binary not found')
+
+    def tearDown(self):
+        _scmtool_cache.clear()
+
+    def testGetSCMToolCached(self):
+        """Testing Repository.get_scmtool reuses tools"""
+        self.assert_(self.repository.get_scmtool() is self.tool)
+
+        repository = Repository.objects.get(pk=self.repository.pk)
+        self.assert_(repository.get_scmtool() is self.tool)
+
+        # Tools are never reused once the repository has changed.
+        repository.raw_file_url = 'http://example.com/<revision>'
+        tool = repository.get_scmtool()
+        self.assert_(tool is not self.tool)
+        self.assertEqual(tool.client.raw_file_url, repository.raw_file_url)
+
+        closed = []
+        tool.close = lambda: closed.append(True)
+        repository.save()
+        self.assertEqual(closed, [True])
+        self.assert_(repository.get_scmtool() is not tool)
+
+    def testGetSCMToolNotThreadSafe(self):
+        """Testing Repository.get_scmtool with tools that aren't thread-safe"""
+        GitTool.thread_safe = False
+
+        try:
+            tool = self.repository.get_scmtool()
+            self.assert_(tool is not self.tool)
+            self.assert_(self.repository.get_scmtool() is tool)
+
+            tools = []
+            t = threading.Thread(
+                target=lambda: tools.append(self.repository.get_scmtool()))
+            t.start()
+            t.join()
+
+            self.assertEqual(len(tools), 1)
+            self.assert_(tools[0] is not tool)
+        finally:
+            GitTool.thread_safe = True
+
+    def testGetSCMToolPooledBetweenThreads(self):
+        """Testing Repository.get_scmtool reusing tools of finished threads"""
+        GitTool.thread_safe = False
+
+        try:
+            tools = []
+            run_in_threads(
+                lambda i: tools.append(self.repository.get_scmtool()),
+                [1], 1)
+            self.assertEqual(len(tools), 1)
+            self.assertEqual(len(_scmtool_cache.tools), 1)
+
+            run_in_threads(
+                lambda i: tools.append(self.repository.get_scmtool()),
+                [1], 1)
+            self.assert_(tools[1] is tools[0])
+            self.assertEqual(len(_scmtool_cache.tools), 1)
+        finally:
+            GitTool.thread_safe = True
+
+    def testGetSCMToolNotCached(self):
+        """Testing Repository.get_scmtool with tools that aren't cached"""
+        GitTool.cache_instances = False
+
+        try:
+            tool = self.repository.get_scmtool()
+            self.assert_(tool is not self.tool)
+            self.assert_(self.repository.get_scmtool() is not tool)
+        finally:
+            GitTool.cache_instances = True
+
+    def testGetSCMToolReapsIdleTools(self):
+        """Testing Repository.get_scmtool closes idle tools"""
+        closed = []
+        self.tool.close = lambda: closed.append(True)
+
+        for entry in _scmtool_cache.tools.values():
+            entry[1] -= _scmtool_cache.IDLE_TIMEOUT
+
+        _scmtool_cache.last_reaped -= _scmtool_cache.REAP_INTERVAL
+
+        self.assert_(self.repository.get_scmtool() is not self.tool)
+        self.assertEqual(closed, [True])
+
+
+class RunInThreadsTest(unittest.TestCase):
+    def testRunInThreads(self):
+        """Testing running functions in a pool of threads"""
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+        results = []
+
+        def func(item):
+            lock.acquire()
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'],
+                                       state['running'])
+            lock.release()
+
+            time.sleep(0.01)
+            results.append(item * 2)
+
+            lock.acquire()
+            state['running'] -= 1
+            lock.release()
+
+        run_in_threads(func, range(10), 3)
+
+        self.assertEqual(sorted(results), range(0, 20, 2))
+        self.assertTrue(state['max_running'] <= 3)
+
+    def testRunInThreadsError(self):
+        """Testing errors when running functions in a pool of threads"""
+        def func(item):
+            if item == 5:
+                raise ValueError('Bad item')
+
+        self.assertRaises(ValueError,
+                          run_in_threads, func, range(10), 3)
+
 
 class CVSTests(DjangoTestCase):
     """Unit tests for CVS."""
@@ -100,6 +303,22 @@ class CVSTests(DjangoTestCase):
         self.assertRaises(FileNotFoundError,
                           lambda: self.tool.get_file('hello', PRE_CREATION))
 
+    def testGetFiles(self):
+        """Testing CVSTool.get_files"""
+        expected = "test content\n"
+
+        self.assertEqual(
+            self.tool.get_files([('test/testfile', Revision('1.1')),
+                                 ('test/testfile,v', Revision('1.1')),
+                                 (self.tool.repopath + '/test/testfile',
+                                  Revision('1.1'))]),
+            [expected] * 3)
+
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_files(
+                              [('test/testfile', Revision('1.1')),
+                               ('test/testfile2', Revision('1.1'))]))
+
     def testRevisionParsing(self):
         """Testing revision number parsing"""
         self.assertEqual(self.tool.parse_diff_revision('', 'PRE-CREATION')[1],
@@ -197,6 +416,388 @@ class CVSTests(DjangoTestCase):
         self.assertRaises(SCMError, lambda: badtool.get_file(file, rev))
 
 
+class StubCVSClient(CVSClient):
+    """A CVSClient that checks files out of a dictionary, not a server."""
+    def __init__(self, path, files, tempdir):
+        CVSClient.__init__(self, ':local:' + path, path)
+        self.files = files
+        self.tempdir = tempdir
+        self.commands = []
+
+    def _run_cvs(self, args):
+        self.commands.append(args)
+        tempdir = tempfile.mkdtemp(dir=self.tempdir)
+
+        if '-p' in args:
+            revision, filename = args[2], args[4]
+
+            if (filename, revision) not in self.files:
+                return (tempdir, '',
+                        'cvs checkout: cannot find module `%s\'' % filename,
+                        1)
+
+            return (tempdir, self.files[(filename, revision)],
+                    '=' * 67 + '\nChecking out %s\n' % filename, 0)
+
+        revision, filenames = args[3], args[4:]
+
+        for filename in filenames:
+            if (filename, revision) in self.files:
+                path = os.path.join(tempdir, filename)
+
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+                f = open(path, 'wb')
+                f.write(self.files[(filename, revision)])
+                f.close()
+
+        return tempdir, '', '', 0
+
+
+class CVSClientTests(unittest.TestCase):
+    """Unit tests for CVSClient that don't need the cvs binary."""
+    def setUp(self):
+        if not is_exe_in_path('cvs'):
+            # CVSClient refuses to be created without cvs. The stub never
+            # runs it, so pretend it's there.
+            self.old_is_exe_in_path = cvs.is_exe_in_path
+            cvs.is_exe_in_path = lambda name: True
+        else:
+            self.old_is_exe_in_path = None
+
+        self.tempdir = tempfile.mkdtemp(prefix='reviewboard-cvstest.')
+        StubCVSClient._attic_files = {}
+
+    def tearDown(self):
+        if self.old_is_exe_in_path:
+            cvs.is_exe_in_path = self.old_is_exe_in_path
+
+        shutil.rmtree(self.tempdir)
+
+    def testCatFilesBatched(self):
+        """Testing CVSClient.cat_files with a file missing from the checkout"""
+        client = StubCVSClient('/cvsroot', {
+            ('dir/a.c', '1.2'): 'a',
+            ('dir/b.c', '1.2'): 'b',
+            ('dir/Attic/c.c', '1.2'): 'c',
+        }, self.tempdir)
+
+        self.assertEqual(
+            client.cat_files([('/cvsroot/dir/a.c', '1.2'),
+                              ('/cvsroot/dir/b.c', '1.2'),
+                              ('/cvsroot/dir/c.c', '1.2')]),
+            ['a', 'b', 'c'])
+        self.assertEqual(client.commands, [
+            ['-q', 'checkout', '-r', '1.2', 'dir/a.c', 'dir/b.c',
+             'dir/c.c'],
+            ['checkout', '-r', '1.2', '-p', 'dir/c.c'],
+            ['checkout', '-r', '1.2', '-p', 'dir/Attic/c.c'],
+        ])
+
+    def testCatFileAtticRemembered(self):
+        """Testing CVSClient.cat_file trying a file's known Attic path first"""
+        client = StubCVSClient('/cvsroot', {
+            ('dir/Attic/c.c', '1.2'): 'c',
+        }, self.tempdir)
+
+        self.assertEqual(client.cat_file('/cvsroot/dir/c.c', '1.2'), 'c')
+        self.assertEqual(len(client.commands), 2)
+
+        client.commands = []
+        self.assertEqual(client.cat_file('/cvsroot/dir/c.c', '1.2'), 'c')
+        self.assertEqual(client.commands,
+                         [['checkout', '-r', '1.2', '-p', 'dir/Attic/c.c']])
+
+    def testCheckoutFilesOutsideCheckout(self):
+        """Testing CVSClient ignoring checked out paths outside the checkout"""
+        client = StubCVSClient('/cvsroot', {
+            ('a.c', '1.2'): 'a',
+        }, self.tempdir)
+
+        # The stub checks files out into directories under self.tempdir, so
+        # a path escaping the checkout would find this file.
+        f = open(os.path.join(self.tempdir, 'secret'), 'wb')
+        f.write('secret')
+        f.close()
+
+        self.assertEqual(client._checkout_files(['a.c', '../secret'], '1.2'),
+                         {'a.c': 'a'})
+
+
+class MonotoneStdioTests(unittest.TestCase):
+    """Unit tests for mtn automate stdio sessions.
+
+    These run against testdata/fake_mtn/mtn, which speaks enough of the
+    stdio protocol to test with.
+    """
+    def setUp(self):
+        if os.name == 'nt':
+            raise nose.SkipTest('The fake mtn needs a Unix shell')
+
+        self.old_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = os.pathsep.join([
+            os.path.join(os.path.dirname(__file__), 'testdata', 'fake_mtn'),
+            self.old_path])
+
+        fd, self.db_path = tempfile.mkstemp(prefix='reviewboard-mtn.')
+        os.close(fd)
+
+        self.session = get_stdio_session(self.db_path)
+
+    def tearDown(self):
+        self.session.close()
+        del mtn._stdio_sessions[self.db_path]
+        os.environ['PATH'] = self.old_path
+        os.environ.pop('FAKE_MTN_FORMAT', None)
+        os.unlink(self.db_path)
+
+    def testFormatVersion1(self):
+        """Testing StdioSession with version 1 of the output format"""
+        os.environ['FAKE_MTN_FORMAT'] = '1'
+        self.assertEqual(
+            self.session.run([['get_file', 'a'], ['get_file', 'b']]),
+            [(0, 'contents of a\n'), (0, 'contents of b\n')])
+        self.assertEqual(self.session.format_version, 1)
+
+    def testFormatVersion2(self):
+        """Testing StdioSession with version 2 of the output format"""
+        self.assertEqual(
+            self.session.run([['get_file', 'a'], ['get_file', 'b']]),
+            [(0, 'contents of a\n'), (0, 'contents of b\n')])
+        self.assertEqual(self.session.format_version, 2)
+
+        # The process is reused.
+        p = self.session.p
+        self.assertEqual(self.session.run([['get_file', 'c']]),
+                         [(0, 'contents of c\n')])
+        self.assert_(self.session.p is p)
+
+    def testError(self):
+        """Testing StdioSession with a command that fails"""
+        for format_version in ('1', '2'):
+            os.environ['FAKE_MTN_FORMAT'] = format_version
+            self.session.close()
+
+            self.assertEqual(
+                self.session.run([['get_file', 'missing'],
+                                  ['get_file', 'a']]),
+                [(2, "misuse: no file 'missing' found"),
+                 (0, 'contents of a\n')])
+
+        client = MonotoneClient(self.db_path)
+        self.assertRaises(FileNotFoundError,
+                          lambda: client.get_files(['a', 'missing']))
+
+    def testDeadProcess(self):
+        """Testing StdioSession replacing a process that died"""
+        self.session.run([['get_file', 'a']])
+        p = self.session.p
+        os.kill(p.pid, signal.SIGKILL)
+        p.wait()
+
+        self.assertEqual(self.session.run([['get_file', 'b']]),
+                         [(0, 'contents of b\n')])
+        self.assert_(self.session.p is not p)
+
+        # A process that dies while running the commands is restarted once.
+        self.assertRaises(StdioSessionError,
+                          lambda: self.session.run([['get_file', 'crash']]))
+        self.assertEqual(self.session.p, None)
+
+        # MonotoneClient falls back on running mtn for each file.
+        client = MonotoneClient(self.db_path)
+        self.assertEqual(client.get_files(['a', 'crash']),
+                         ['contents of a\n', 'contents of crash\n'])
+
+    def testClose(self):
+        """Testing StdioSession.close letting the process exit"""
+        self.session.run([['get_file', 'a']])
+        p = self.session.p
+        self.session.close()
+
+        self.assertEqual(self.session.p, None)
+        self.assertEqual(p.returncode, 0)
+
+
+class StubBzrError(Exception):
+    pass
+
+
+class StubBzrLib(object):
+    """Stands in for bzrlib's BzrDir and RevisionSpec classes.
+
+    Each branch is a dictionary of file contents, keyed on the file's path
+    in the branch and a revspec. Files with None as their contents can't
+    be read. Every branch opened and tree built is recorded.
+    """
+    def __init__(self, branches):
+        self.BzrDir = self
+        self.RevisionSpec = self
+        self.branches = branches
+        self.opened = []
+        self.trees = []
+
+    def open_containing_tree_or_branch(self, url):
+        for base, files in self.branches.iteritems():
+            if url == base or url.startswith(base + '/'):
+                branch = StubBranch(base, files)
+                self.opened.append(branch)
+                return None, branch, url[len(base) + 1:]
+
+        raise StubBzrError('Not a branch: %s' % url)
+
+    def from_string(self, revspec):
+        return StubRevisionSpec(self, revspec)
+
+
+class StubBranch(object):
+    def __init__(self, base, files):
+        self.base = base
+        self.files = files
+        self.locks = 0
+        self.num_locks = 0
+
+    def lock_read(self):
+        self.locks += 1
+        self.num_locks += 1
+
+    def unlock(self):
+        self.locks -= 1
+
+
+class StubRevisionSpec(object):
+    def __init__(self, bzrlib, revspec):
+        self.bzrlib = bzrlib
+        self.revspec = revspec
+
+    def as_tree(self, branch):
+        revtree = StubRevisionTree(branch, self.revspec)
+        self.bzrlib.trees.append(revtree)
+        return revtree
+
+
+class StubRevisionTree(object):
+    def __init__(self, branch, revspec):
+        self.branch = branch
+        self.revspec = revspec
+
+    def path2id(self, relpath):
+        if (relpath, self.revspec) in self.branch.files:
+            return relpath
+
+        return None
+
+    def get_file_text(self, fileid):
+        # Like bzrlib, reading a tree requires its branch to be locked.
+        assert self.branch.locks > 0
+
+        data = self.branch.files[(fileid, self.revspec)]
+
+        if data is None:
+            raise StubBzrError('Unable to read %s' % fileid)
+
+        return data
+
+
+class BZRToolTests(unittest.TestCase):
+    """Unit tests for BZRTool, run against a stub of bzrlib."""
+    def setUp(self):
+        self.bzrlib = StubBzrLib({
+            'file:///bzr/trunk': {
+                ('a.c', 'revid:1'): 'a1',
+                ('a.c', 'revid:2'): 'a2',
+                ('b.c', 'revid:1'): 'b1',
+                ('sub/c.c', 'revid:1'): 'c1',
+                ('bad.c', 'revid:1'): None,
+            },
+            'file:///bzr/branch': {
+                ('a.c', 'revid:1'): 'branch a1',
+            },
+        })
+
+        self.old_globals = {}
+
+        for name, value in (('bzrdir', self.bzrlib),
+                            ('revisionspec', self.bzrlib),
+                            ('BzrError', StubBzrError)):
+            self.old_globals[name] = getattr(bzr, name, None)
+            setattr(bzr, name, value)
+
+        self.tool = bzr.BZRTool(Repository(name='Bazaar', path='/bzr'))
+
+    def tearDown(self):
+        for name, value in self.old_globals.iteritems():
+            if value is None:
+                delattr(bzr, name)
+            else:
+                setattr(bzr, name, value)
+
+    def testGetFilesLocksBranchOnce(self):
+        """Testing BZRTool.get_files opening and locking a branch once"""
+        self.assertEqual(
+            self.tool.get_files([('trunk/a.c', 'revid:1'),
+                                 ('trunk/b.c', 'revid:1'),
+                                 ('trunk/sub/c.c', 'revid:1'),
+                                 ('trunk/new.c',
+                                  bzr.BZRTool.PRE_CREATION_TIMESTAMP),
+                                 ('trunk/a.c', 'revid:2')]),
+            ['a1', 'b1', 'c1', '', 'a2'])
+
+        # The branch is looked up again for the new directory, but the
+        # branch that was already open is used.
+        self.assertEqual(len(self.bzrlib.opened), 2)
+        branch = self.bzrlib.opened[0]
+        self.assertEqual(branch.num_locks, 1)
+        self.assertEqual(branch.locks, 0)
+        self.assertEqual([(revtree.branch, revtree.revspec)
+                          for revtree in self.bzrlib.trees],
+                         [(branch, 'revid:1'), (branch, 'revid:2')])
+
+    def testRevisionTreesReused(self):
+        """Testing BZRTool reusing revision trees between batches"""
+        self.assertEqual(self.tool.get_file('trunk/a.c', 'revid:1'), 'a1')
+        self.assertEqual(self.tool.get_file('trunk/b.c', 'revid:1'), 'b1')
+
+        self.assertEqual(len(self.bzrlib.opened), 1)
+        self.assertEqual(len(self.bzrlib.trees), 1)
+        self.assertEqual(self.bzrlib.opened[0].num_locks, 2)
+
+        self.assertEqual(self.tool.get_file('trunk/a.c', 'revid:2'), 'a2')
+        self.assertEqual(len(self.bzrlib.trees), 2)
+
+    def testEvictedBranchTreeRebuilt(self):
+        """Testing BZRTool rebuilding trees when their branch is reopened"""
+        self.tool._branches.set_max_size(1)
+
+        self.assertEqual(self.tool.get_file('trunk/a.c', 'revid:1'), 'a1')
+        self.assertEqual(self.tool.get_file('branch/a.c', 'revid:1'),
+                         'branch a1')
+
+        # The trunk branch was evicted, so it's opened again. The tree
+        # cached for it belongs to the old, unlocked branch, and has to be
+        # built again from the new one.
+        self.assertEqual(self.tool.get_file('trunk/a.c', 'revid:1'), 'a1')
+
+        self.assertEqual(len(self.bzrlib.opened), 3)
+        self.assertEqual(len(self.bzrlib.trees), 3)
+        self.assert_(self.bzrlib.trees[2].branch is self.bzrlib.opened[2])
+
+    def testGetFilesUnlocksOnError(self):
+        """Testing BZRTool.get_files unlocking branches after an error"""
+        self.assertRaises(SCMError,
+                          lambda: self.tool.get_files([
+                              ('trunk/a.c', 'revid:1'),
+                              ('branch/a.c', 'revid:1'),
+                              ('trunk/bad.c', 'revid:1')]))
+
+        self.assertEqual(len(self.bzrlib.opened), 2)
+
+        for branch in self.bzrlib.opened:
+            self.assertEqual(branch.num_locks, 1)
+            self.assertEqual(branch.locks, 0)
+
+
 class SubversionTests(DjangoTestCase):
     """Unit tests for subversion."""
     fixtures = ['test_scmtools.json']
@@ -243,6 +844,47 @@ class SubversionTests(DjangoTestCase):
                           lambda: self.tool.get_file('hello',
                                                      PRE_CREATION))
 
+    def testGetFiles(self):
+        """Testing SVNTool.get_files"""
+        expected = self.tool.get_file('trunk/doc/misc-docs/Makefile',
+                                      Revision('2'))
+
+        files = self.tool.get_files([
+            ('trunk/doc/misc-docs/Makefile', Revision('2')),
+            ('/trunk/doc/misc-docs/Makefile', Revision('2')),
+            ('trunk/doc/misc-docs/Makefile', HEAD),
+        ])
+        self.assertEqual(files[:2], [expected, expected])
+        self.assertEqual(len(files), 3)
+
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_files([
+                              ('trunk/doc/misc-docs/Makefile', Revision('2')),
+                              ('trunk/doc/misc-docs/Makefile2',
+                               Revision('2')),
+                          ]))
+
+    def testGetFilesFetchLimit(self):
+        """Testing SVNTool.get_files with a limit on repository fetches"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        old_limit = siteconfig.get('diffviewer_max_repository_fetches')
+        siteconfig.set('diffviewer_max_repository_fetches', 1)
+
+        def fail(*args, **kwargs):
+            self.fail('Files were fetched in parallel')
+
+        svn.run_in_threads = fail
+
+        try:
+            files = self.tool.get_files([
+                ('trunk/doc/misc-docs/Makefile', Revision('2')),
+                ('/trunk/doc/misc-docs/Makefile', Revision('2')),
+            ])
+            self.assertEqual(files[0], files[1])
+        finally:
+            svn.run_in_threads = run_in_threads
+            siteconfig.set('diffviewer_max_repository_fetches', old_limit)
+
     def testRevisionParsing(self):
         """Testing revision number parsing"""
         self.assertEqual(self.tool.parse_diff_revision('', '(working copy)')[1],
@@ -390,6 +1032,30 @@ class PerforceTests(DjangoTestCase):
                 raise
         self.assertEqual(hash(file), -6079245147730624701)
 
+    def testGetFiles(self):
+        """Testing PerforceTool.get_files"""
+        path = '//public/perforce/api/python/P4Client/p4.py'
+
+        try:
+            files = self.tool.get_files([(path, 1), ('//depot/foo',
+                                                     PRE_CREATION),
+                                         (path, 1)])
+        except Exception, e:
+            if str(e).startswith('Connect to server failed'):
+                raise nose.SkipTest(
+                    'Connection to public.perforce.com failed.  No internet?')
+            else:
+                raise
+
+        self.assertEqual(len(files), 3)
+        self.assertEqual(hash(files[0]), -6079245147730624701)
+        self.assertEqual(files[1], '')
+        self.assertEqual(files[2], files[0])
+
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_files([(path, 1),
+                                                       (path + 'x', 1)]))
+
     def testEmptyDiff(self):
         """Testing Perforce empty diff parsing"""
         diff = "==== //depot/foo/proj/README#2 ==M== /src/proj/README ====\n"
@@ -886,6 +1552,19 @@ class GitTests(DjangoTestCase):
         self.assert_(not self.tool.file_exists("readme", "a62df6c"))
         self.assert_(not self.tool.file_exists("readme2", "ccffbb4"))
 
+    def testFileExistsMany(self):
+        """Testing GitTool.file_exists_many"""
+        self.assertEqual(
+            self.tool.file_exists_many([("readme", "e965047"),
+                                        ("readme", PRE_CREATION),
+                                        ("readme", "fffffff"),
+                                        ("readme", "d6613f5"),
+                                        ("readme", "a62df6c"),
+                                        ("readme2", "ccffbb4"),
+                                        ("readme", HEAD),
+                                        ("readme2", HEAD)]),
+            [True, False, False, True, False, False, True, False])
+
     def testGetFile(self):
         """Testing GitTool.get_file"""
 
@@ -904,6 +1583,56 @@ class GitTests(DjangoTestCase):
         self.assertRaises(FileNotFoundError,
                           lambda: self.tool.get_file("readme", "0000000"))
 
+    def testGetFileReusesProcess(self):
+        """Testing GitTool.get_file reuses git cat-file processes"""
+        self.tool.client.use_object_reader = False
+        pool = get_cat_file_pool(self.tool.client.git_dir, '--batch')
+        pool.close()
+
+        self.assertEqual(self.tool.get_file("readme", "e965047"), 'Hello\n')
+        self.assertEqual(len(pool.idle), 1)
+        pid = pool.idle[0].p.pid
+
+        self.assertEqual(self.tool.get_file("readme", "d6613f5"),
+                         'Hello there\n')
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_file("readme", "0000000"))
+        self.assertRaises(SCMError,
+                          lambda: self.tool.get_file("readme", "a62df6c"))
+        self.assertEqual(self.tool.get_file("readme"), 'Hello there\n')
+        self.assertEqual(len(pool.idle), 1)
+        self.assertEqual(pool.idle[0].p.pid, pid)
+
+    def testGetFileAfterProcessDies(self):
+        """Testing GitTool.get_file replaces dead git cat-file processes"""
+        if os.name == 'nt':
+            raise nose.SkipTest('signals are not supported')
+
+        self.tool.client.use_object_reader = False
+        pool = get_cat_file_pool(self.tool.client.git_dir, '--batch')
+        pool.close()
+
+        self.assertEqual(self.tool.get_file("readme", "e965047"), 'Hello\n')
+        process = pool.idle[0]
+        os.kill(process.p.pid, signal.SIGKILL)
+        process.p.wait()
+
+        self.assertEqual(self.tool.get_file("readme", "d6613f5"),
+                         'Hello there\n')
+        self.assertEqual(len(pool.idle), 1)
+        self.assertNotEqual(pool.idle[0], process)
+
+        # A process that dies without the pool noticing is replaced when
+        # its request fails, and the request is retried.
+        process = pool.idle[0]
+        os.kill(process.p.pid, signal.SIGKILL)
+        process.p.wait()
+        process.is_alive = lambda: True
+
+        self.assertEqual(self.tool.get_file("readme", "e965047"), 'Hello\n')
+        self.assertEqual(len(pool.idle), 1)
+        self.assertNotEqual(pool.idle[0], process)
+
     def testParseDiffRevisionWithRemoteAndShortSHA1Error(self):
         """Testing GitTool.parse_diff_revision with remote files and short SHA1 error"""
         self.assertRaises(
@@ -915,3 +1644,230 @@ class GitTests(DjangoTestCase):
         self.assertRaises(
             ShortSHA1Error,
             lambda: self.remote_tool.get_file('README', 'd7e96b3'))
+
+    def testGetFileWithObjectReader(self):
+        """Testing GitTool.get_file reads objects without running git"""
+        pool = get_cat_file_pool(self.tool.client.git_dir, '--batch')
+        pool.close()
+
+        self.assertEqual(self.tool.get_file("readme", "e965047"), 'Hello\n')
+        self.assertEqual(self.tool.get_file("readme"), 'Hello there\n')
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_file("readme", "0000000"))
+        self.assertRaises(SCMError,
+                          lambda: self.tool.get_file("readme", "a62df6c"))
+        self.assert_(not self.tool.file_exists("readme", "ccffbb4"))
+        self.assertEqual(pool.idle, [])
+
+        # Names the reader doesn't understand are passed on to git.
+        self.assertEqual(self.tool.client._cat_file("", "HEAD^{tree}", "-t"),
+                         "tree\n")
+
+
+class GitObjectReaderTests(unittest.TestCase):
+    """Unit tests for reading Git objects without git"""
+
+    def setUp(self):
+        if not is_exe_in_path('git'):
+            raise nose.SkipTest('git binary not found')
+
+        self.git_dir = tempfile.mkdtemp(prefix='reviewboard-git.')
+        self._git('init', '--bare', '-q')
+
+        # Each version of the file is similar to the one before, so that
+        # git stores most of them as deltas.
+        lines = ['Line %d of a file that changes a little each time\n' % i
+                 for i in range(2000)]
+        self.blobs = {}
+
+        for i in range(10):
+            lines[i * 97] = 'Changed in version %d\n' % i
+            lines.insert(i * 13, 'Added in version %d\n' % i)
+            data = ''.join(lines)
+            sha = self._git('hash-object', '-w', '--stdin', input=data)
+            self.blobs[sha.strip()] = data
+
+    def tearDown(self):
+        shutil.rmtree(self.git_dir)
+
+    def testLooseObjects(self):
+        """Testing GitObjectReader with loose objects"""
+        self._assertReadsBlobs()
+
+    def testOfsDeltas(self):
+        """Testing GitObjectReader with packed offset deltas"""
+        self._pack('--delta-base-offset')
+        self._assertReadsBlobs()
+
+    def testRefDeltas(self):
+        """Testing GitObjectReader with packed SHA1 deltas"""
+        self._pack()
+        self._assertReadsBlobs()
+
+    def testObjectNames(self):
+        """Testing GitObjectReader with different object names"""
+        repo_dir = os.path.join(os.path.dirname(__file__), 'testdata',
+                                'git_repo')
+        reader = GitObjectReader(repo_dir)
+
+        self.assertEqual(reader.read_object('e965047'), ('blob', 'Hello\n'))
+        self.assertEqual(reader.read_object('HEAD:readme'),
+                         ('blob', 'Hello there\n'))
+        self.assertEqual(reader.read_object('HEAD:missing'), (None, None))
+        self.assertEqual(reader.read_object('fffffff'), (None, None))
+        self.assertEqual(reader.get_object_type('a62df6c'), 'commit')
+        self.assertEqual(reader.get_object_type('ccffbb4'), 'tree')
+        self.assertRaises(UnsupportedObjectError,
+                          lambda: reader.read_object('HEAD~1'))
+
+    def testNewPack(self):
+        """Testing GitObjectReader with objects packed after it started"""
+        reader = GitObjectReader(self.git_dir)
+        sha = self.blobs.keys()[0]
+        self.assertEqual(reader.read_object(sha),
+                         ('blob', self.blobs[sha]))
+
+        self._pack('--delta-base-offset')
+        self.assertEqual(reader.read_object(sha[:7]),
+                         ('blob', self.blobs[sha]))
+
+    def _assertReadsBlobs(self):
+        reader = GitObjectReader(self.git_dir)
+
+        for sha, data in self.blobs.iteritems():
+            self.assertEqual(reader.read_object(sha), ('blob', data))
+            self.assertEqual(reader.read_object(sha[:10]), ('blob', data))
+            self.assertEqual(reader.get_object_type(sha), 'blob')
+
+    def _pack(self, *args):
+        self._git('pack-objects', '-q', *(args + ('objects/pack/pack',)),
+                  **{'input': '\n'.join(self.blobs.keys()) + '\n'})
+        self._git('prune-packed')
+
+    def _git(self, *args, **kwargs):
+        p = subprocess.Popen(['git'] + list(args),
+                             cwd=self.git_dir,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        output, errors = p.communicate(kwargs.get('input', ''))
+        self.assertEqual(p.returncode, 0, errors)
+
+        return output
+
+
+class TestHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address,
+                                     self.headers.getheader('authorization')))
+
+        if self.path == '/redirect':
+            self._respond(302, '', {'Location': '/file'})
+        elif self.path in self.server.files:
+            self._respond(200, self.server.files[self.path])
+        else:
+            self._respond(404, 'Not found')
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, code, data, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class HTTPConnectionPoolTests(unittest.TestCase):
+    """Unit tests for fetching files over pooled HTTP connections"""
+
+    def setUp(self):
+        self.old_proxies = {}
+
+        for name in ('http_proxy', 'HTTP_PROXY'):
+            if name in os.environ:
+                self.old_proxies[name] = os.environ.pop(name)
+
+        self.server = TestHTTPServer(('127.0.0.1', 0), TestHTTPRequestHandler)
+        self.server.requests = []
+        self.server.files = {
+            '/file': 'contents',
+            '/repo/raw/tip/doc/readme': 'Hello\n',
+        }
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+        self.pool = HTTPConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        os.environ.update(self.old_proxies)
+
+    def testReusesConnection(self):
+        """Testing HTTPConnectionPool reusing connections"""
+        for i in range(3):
+            response = self.pool.open(self.url + '/file', 'user', 'pass')
+            self.assertEqual(response.read(), 'contents')
+            self.assertEqual(response.geturl(), self.url + '/file')
+
+        clients = [client for path, client, auth in self.server.requests]
+        self.assertEqual(len(clients), 3)
+        self.assertEqual(clients[0], clients[1])
+        self.assertEqual(clients[0], clients[2])
+        self.assertEqual(self.server.requests[0][2], 'Basic dXNlcjpwYXNz')
+
+    def testClosedConnection(self):
+        """Testing HTTPConnectionPool with a connection closed by the server"""
+        self.pool.open(self.url + '/file')
+
+        for conn, last_used in self.pool._idle.values()[0]:
+            conn.sock.close()
+
+        self.assertEqual(self.pool.open(self.url + '/file').read(),
+                         'contents')
+
+    def testErrors(self):
+        """Testing HTTPConnectionPool with redirects and HTTP errors"""
+        response = self.pool.open(self.url + '/redirect')
+        self.assertEqual(response.read(), 'contents')
+        self.assertEqual(response.geturl(), self.url + '/file')
+
+        try:
+            self.pool.open(self.url + '/missing')
+            self.fail('HTTPError was not raised')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+
+        self.assertRaises(urllib2.URLError,
+                          lambda: self.pool.open('http://127.0.0.1:1/file'))
+
+    def testHgWebRawPath(self):
+        """Testing HgWebClient remembering which raw path works"""
+        client = HgWebClient(self.url + '/repo', '', '')
+
+        self.assertEqual(client.cat_file('doc/readme'), 'Hello\n')
+        self.assertEqual(client.cat_file('doc/readme'), 'Hello\n')
+        self.assertRaises(FileNotFoundError,
+                          lambda: client.cat_file('doc/missing'))
+
+        self.assertEqual(
+            [path for path, client, auth in self.server.requests],
+            ['/repo/raw-file/tip/doc/readme',
+             '/repo/raw/tip/doc/readme',
+             '/repo/raw/tip/doc/readme',
+             '/repo/raw/tip/doc/missing'])